@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decision latency micro-benchmark for the RL policies, the quote ladder and tick rounding.
+
+    python -m agent.benchmark [--model path] [--iterations 100000] [--batch 100000] [--levels 1,10,40]
+"""
+
+import argparse
+import timeit
+import numpy as np
+from decimal import Decimal
+from exchange.chart import BAR
+from config.settings import settings
+from agent.quoting import QuoteLadder, ladder_orders
+from utils.math import toNearest, toNearestArray
+from agent.policy import N_ACTIONS, N_FEATURES, LinearPolicy, ZeroPolicy, load_policy
+
+
+def random_linear_policy(seed=0):
+    rng = np.random.RandomState(seed)
+    return LinearPolicy(rng.randn(2 * N_ACTIONS, N_FEATURES), rng.randn(2 * N_ACTIONS),
+                        rng.randn(N_FEATURES), rng.rand(N_FEATURES) + 0.5)
+
+
+def bench_policy(name, policy, iterations, batch):
+    candle = BAR(0, 9000.0, 1)
+    candle.vpinShort, candle.vpinLong, candle.bounceShort, candle.bounceLong = 12.5, -3.0, 4.0, 1.5
+
+    policy.act(candle, 100)
+    single = min(timeit.repeat(lambda: policy.act(candle, 100), number=iterations, repeat=5)) / iterations
+
+    features = np.random.RandomState(1).randn(batch, N_FEATURES)
+    batched = min(timeit.repeat(lambda: policy.act_batch(features), number=1, repeat=5)) / batch
+
+    print('%-12s act: %8.3f us/decision   act_batch: %8.3f us/decision' % (name, single * 1e6, batched * 1e6))
+
+
+def bench_quotes(levels, iterations):
+    quotes = QuoteLadder(0.5, levels, settings.ORDER_START_SIZE, settings.ORDER_STEP_SIZE, settings.INTERVAL,
+                         settings.MIN_SPREAD, settings.MIN_POSITION, settings.MAX_POSITION, True,
+                         settings.QUOTE_INVENTORY_SKEW, settings.QUOTE_VPIN_WIDEN, settings.QUOTE_VPIN_SKEW,
+                         settings.QUOTE_BOUNCE_SKEW, settings.QUOTE_BOUNCE_SCALE)
+
+    def quote():
+        return quotes.ladder(9000.0, 9000.5, 1200, 0.125, 4.0, 1, 2)
+
+    ladder = min(timeit.repeat(quote, number=iterations, repeat=5)) / iterations
+    orders = min(timeit.repeat(lambda: ladder_orders(*quote()), number=iterations, repeat=5)) / iterations
+
+    print('ladder %3d levels   ladder: %8.3f us   with order dicts: %8.3f us' % (levels, ladder * 1e6, orders * 1e6))
+
+
+def decimal_to_nearest(num, tickSize):
+    """ the Decimal based toNearest utils.math used to have, as the reference """
+
+    tickDec = Decimal(str(tickSize))
+    return float((Decimal(round(num / tickSize, 0)) * tickDec))
+
+
+def bench_rounding(tick_size, iterations, batch):
+    prices = np.random.RandomState(2).uniform(1000.0, 20000.0, batch)
+    values = prices.tolist()
+
+    rounded = toNearestArray(prices, tick_size)
+    reference = np.array([decimal_to_nearest(p, tick_size) for p in values])
+    scalar = np.array([toNearest(p, tick_size) for p in values])
+    mismatches = np.count_nonzero(rounded.view(np.int64) != reference.view(np.int64)) + \
+        np.count_nonzero(scalar.view(np.int64) != reference.view(np.int64))
+
+    decimal = min(timeit.repeat(lambda: decimal_to_nearest(9000.26, tick_size), number=iterations, repeat=5))
+    fast = min(timeit.repeat(lambda: toNearest(9000.26, tick_size), number=iterations, repeat=5))
+    array = min(timeit.repeat(lambda: toNearestArray(prices, tick_size), number=1, repeat=5)) / batch
+
+    print('tick %-6g Decimal: %6.3f us   toNearest: %6.3f us   toNearestArray: %6.4f us/price   mismatches %d' %
+          (tick_size, decimal / iterations * 1e6, fast / iterations * 1e6, array * 1e6, mismatches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark RL policy decision latency.')
+    parser.add_argument('--model', default='', help='model file to benchmark (.npz or .onnx)')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100000)
+    parser.add_argument('--levels', default='1,10,40', help='comma separated ORDER_PAIRS to benchmark the ladder with')
+    args = parser.parse_args()
+
+    bench_policy('zero', ZeroPolicy(), args.iterations, args.batch)
+    bench_policy('linear', random_linear_policy(), args.iterations, args.batch)
+    if args.model:
+        bench_policy(args.model, load_policy(args.model), args.iterations, args.batch)
+    for levels in args.levels.split(','):
+        bench_quotes(int(levels), args.iterations // 10)
+    for tick_size in (0.5, 0.01):
+        bench_rounding(tick_size, args.iterations, args.batch)
+
+
+if __name__ == '__main__':
+    main()
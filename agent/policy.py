@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# Action space shared by the trading loop, the policies and the simulator.
+# Each side gets an action in [0, N_ACTIONS): 0..8 backs that side's quotes off by that many ticks,
+# ACTION_STOP (only meaningful as sell action) stops trading.
+N_ACTIONS = 10
+ACTION_STOP = 9
+
+# Feature vector layout, taken from the latest CHART candle plus the current position.
+FEATURES = ['vpinShort', 'vpinLong', 'bounceShort', 'bounceLong', 'priceShort', 'priceLong', 'position']
+N_FEATURES = len(FEATURES)
+
+
+def fill_features(candle, position, out):
+    """
+    Write the features of one CHART candle (BAR) and position into out
+    """
+
+    out[0] = candle.vpinShort
+    out[1] = candle.vpinLong
+    out[2] = candle.bounceShort
+    out[3] = candle.bounceLong
+    out[4] = candle.priceShort
+    out[5] = candle.priceLong
+    out[6] = position
+    return out
+
+
+def features_from_columns(columns, positions, out=None):
+    """
+    Build a (n, N_FEATURES) feature matrix from columnar candle history.
+    columns maps candle field names to equally long arrays, positions is a scalar or an array of length n.
+    """
+
+    n = len(columns['vpinShort'])
+    if out is None:
+        out = np.empty((n, N_FEATURES))
+    for i, name in enumerate(FEATURES[:-1]):
+        out[:, i] = columns[name]
+    out[:, -1] = positions
+    return out
+
+
+def candle_columns(candles):
+    """
+    Columnar view of a list of CHART candles (BAR objects)
+    """
+
+    return {name: np.fromiter((getattr(c, name) for c in candles), dtype=float, count=len(candles))
+            for name in FEATURES[:-1]}
+
+
+class Policy(object):
+    """
+    Maps the latest candle and position to a (sell_action, buy_action) pair.
+
+    Subclasses implement infer(), which reads self.features and returns the two actions.
+    act() fills the preallocated feature buffer in place, so a decision does not allocate arrays.
+    """
+
+    def __init__(self):
+        self.features = np.zeros(N_FEATURES)
+
+    def act(self, candle, position):
+        fill_features(candle, position, self.features)
+        return self.infer()
+
+    def infer(self):
+        raise NotImplementedError()
+
+    def act_batch(self, features):
+        """
+        Score a whole (n, N_FEATURES) feature matrix at once, e.g. a replayed session.
+        Returns (sell_actions, buy_actions) integer arrays.
+        """
+
+        raise NotImplementedError()
+
+    def score_session(self, columns, positions):
+        return self.act_batch(features_from_columns(columns, positions))
+
+
+class ZeroPolicy(Policy):
+    """
+    Always quotes at the default ladder. Used when no model is configured.
+    """
+
+    def infer(self):
+        return 0, 0
+
+    def act_batch(self, features):
+        n = len(features)
+        return np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+
+
+class LinearPolicy(Policy):
+    """
+    Linear scorer over standardized features.
+    weights has shape (2 * N_ACTIONS, N_FEATURES); the first N_ACTIONS rows score sell actions, the rest buy actions.
+    """
+
+    def __init__(self, weights, bias, mean=None, scale=None):
+        super(LinearPolicy, self).__init__()
+
+        self.weights = np.ascontiguousarray(weights, dtype=float)
+        self.bias = np.ascontiguousarray(bias, dtype=float)
+        if self.weights.shape != (2 * N_ACTIONS, N_FEATURES) or self.bias.shape != (2 * N_ACTIONS,):
+            raise ValueError("LinearPolicy expects weights %s and bias %s, got %s and %s" %
+                             ((2 * N_ACTIONS, N_FEATURES), (2 * N_ACTIONS,), self.weights.shape, self.bias.shape))
+        self.mean = np.zeros(N_FEATURES) if mean is None else np.asarray(mean, dtype=float)
+        self.invScale = 1.0 / (np.ones(N_FEATURES) if scale is None else np.asarray(scale, dtype=float))
+
+        self.scores = np.zeros(2 * N_ACTIONS)
+        self.sellScores = self.scores[:N_ACTIONS]
+        self.buyScores = self.scores[N_ACTIONS:]
+
+    @classmethod
+    def load(cls, path):
+        model = np.load(path)
+        return cls(model['weights'], model['bias'], model.get('mean'), model.get('scale'))
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, mean=self.mean, scale=1.0 / self.invScale)
+
+    def infer(self):
+        features = self.features
+        np.subtract(features, self.mean, out=features)
+        np.multiply(features, self.invScale, out=features)
+        np.dot(self.weights, features, out=self.scores)
+        np.add(self.scores, self.bias, out=self.scores)
+        return int(self.sellScores.argmax()), int(self.buyScores.argmax())
+
+    def act_batch(self, features):
+        scores = np.dot((features - self.mean) * self.invScale, self.weights.T)
+        scores += self.bias
+        return scores[:, :N_ACTIONS].argmax(axis=1), scores[:, N_ACTIONS:].argmax(axis=1)
+
+
+class OnnxPolicy(Policy):
+    """
+    ONNX model run on the CPU with onnxruntime.
+    The model takes a float32 (batch, N_FEATURES) input and returns (batch, 2 * N_ACTIONS) scores.
+    """
+
+    def __init__(self, path):
+        super(OnnxPolicy, self).__init__()
+
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.inputName = self.session.get_inputs()[0].name
+        self.input = np.zeros((1, N_FEATURES), dtype=np.float32)
+
+    def infer(self):
+        self.input[0] = self.features
+        scores = self.session.run(None, {self.inputName: self.input})[0][0]
+        return int(scores[:N_ACTIONS].argmax()), int(scores[N_ACTIONS:].argmax())
+
+    def act_batch(self, features):
+        scores = self.session.run(None, {self.inputName: np.asarray(features, dtype=np.float32)})[0]
+        return scores[:, :N_ACTIONS].argmax(axis=1), scores[:, N_ACTIONS:].argmax(axis=1)
+
+
+def load_policy(path=None):
+    """
+    Load the policy configured by path: '' -> ZeroPolicy, *.npz -> LinearPolicy, *.onnx -> OnnxPolicy
+    """
+
+    if not path:
+        return ZeroPolicy()
+    if path.endswith('.npz'):
+        return LinearPolicy.load(path)
+    if path.endswith('.onnx'):
+        return OnnxPolicy(path)
+    raise ValueError("Unknown policy model format: %s" % path)
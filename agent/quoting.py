@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+from utils.math import tick_grid
+
+
+class QuoteLadder(object):
+    """
+    Desired orders of the market maker, pairs levels per side, computed in one vectorized step.
+
+    Each side starts one tick inside the touch (at the touch when MAINTAIN_SPREADS finds our own order there),
+    backed off to min_spread around the mid like the sample market maker. The start prices are then moved by
+    fractions of the mid:
+
+        shift    vpin_skew * vpin + bounce_skew * tanh(bounce / bounce_scale) - inventory_skew * inventory
+        widen    vpin_widen * |vpin|, away from the mid on both sides
+
+    vpin is the signed VPIN imbalance in [-1, 1] (vpinShort / 100), inventory the position as a fraction of
+    max_position (long) or -min_position (short). The agent's actions back each side off by that many ticks.
+    Level i lies interval * i further out, geometrically, and orders start_size + i * step_size contracts.
+
+    Sizes on the side that adds to the inventory shrink with it, and the cumulative size of a side is capped at
+    the room left to its position limit, so a full ladder passes the risk engine. Prices are worked out in integer
+    ticks of the instrument's utils.math.TickGrid, the same floats toNearest returns.
+    """
+
+    def __init__(self, tick_size, pairs, start_size, step_size, interval, min_spread, min_position, max_position,
+                 check_position=True, inventory_skew=0.0, vpin_widen=0.0, vpin_skew=0.0, bounce_skew=0.0,
+                 bounce_scale=1.0):
+        self.tickSize = tick_size
+        self.grid = tick_grid(tick_size)
+
+        self.pairs = pairs
+        self.minSpread = min_spread
+        self.minPosition = min_position
+        self.maxPosition = max_position
+        self.checkPosition = check_position
+        self.inventorySkew = inventory_skew
+        self.vpinWiden = vpin_widen
+        self.vpinSkew = vpin_skew
+        self.bounceSkew = bounce_skew
+        self.bounceScale = bounce_scale
+
+        # Shift and widening (price) of the last ladder
+        self.shift = 0.0
+        self.widen = 0.0
+
+        levels = np.arange(pairs)
+        self.factors = (1.0 + interval) ** levels
+        self.sizes = (start_size + levels * step_size).astype(np.float64)
+
+    def inventory(self, position):
+        """ position as a fraction of the limit on its side, in [-1, 1] """
+
+        if position > 0:
+            return min(float(position) / self.maxPosition, 1.0) if self.maxPosition > 0 else 1.0
+        if position < 0:
+            return max(float(position) / -self.minPosition, -1.0) if self.minPosition < 0 else -1.0
+        return 0.0
+
+    def start_prices(self, bid, ask, highest_buy=None, lowest_sell=None):
+        """ innermost buy and sell price before the skew """
+
+        tick = self.tickSize
+        buy, sell = bid + tick, ask - tick
+        # Don't step in front of our own order at the touch
+        if highest_buy is not None and highest_buy >= bid:
+            buy = bid
+        if lowest_sell is not None and lowest_sell <= ask:
+            sell = ask
+        if buy >= sell:
+            buy, sell = bid, ask
+
+        # Back off if our spread is too small.
+        if buy * (1.0 + self.minSpread) > sell:
+            buy *= 1.0 - self.minSpread / 2
+            sell *= 1.0 + self.minSpread / 2
+        return buy, sell
+
+    def ladder(self, bid, ask, position, vpin=0.0, bounce=0.0, sell_action=0, buy_action=0, highest_buy=None,
+               lowest_sell=None, sizes=None):
+        """
+        (buy_prices, buy_sizes, sell_prices, sell_sizes), innermost level first, levels without size dropped.
+        sizes replaces the start_size / step_size ladder, e.g. with random sizes.
+        """
+
+        tick = self.tickSize
+        mid = (bid + ask) / 2
+        buy, sell = self.start_prices(bid, ask, highest_buy, lowest_sell)
+
+        inventory = self.inventory(position)
+        shift = mid * (self.vpinSkew * vpin + self.bounceSkew * math.tanh(bounce / self.bounceScale) -
+                       self.inventorySkew * inventory)
+        widen = mid * self.vpinWiden * abs(vpin)
+        self.shift, self.widen = shift, widen
+        buy += shift - widen - buy_action * tick
+        sell += shift + widen + sell_action * tick
+
+        # Integer ticks, never crossing the book
+        buy_ticks = np.rint(buy / self.factors / tick)
+        sell_ticks = np.rint(sell * self.factors / tick)
+        np.minimum(buy_ticks, np.rint(ask / tick) - 1, out=buy_ticks)
+        np.maximum(sell_ticks, np.rint(bid / tick) + 1, out=sell_ticks)
+
+        sizes = self.sizes if sizes is None else sizes
+        buy_sizes = sizes * (1.0 - max(inventory, 0.0))
+        sell_sizes = sizes * (1.0 + min(inventory, 0.0))
+        if self.checkPosition:
+            buy_sizes = self.cap(buy_sizes, self.maxPosition - position)
+            sell_sizes = self.cap(sell_sizes, position - self.minPosition)
+        buy_sizes = np.floor(buy_sizes)
+        sell_sizes = np.floor(sell_sizes)
+
+        buys = buy_sizes > 0
+        sells = sell_sizes > 0
+        return (self.grid.to_prices(buy_ticks[buys]), buy_sizes[buys],
+                self.grid.to_prices(sell_ticks[sells]), sell_sizes[sells])
+
+    def skew(self):
+        """ (shift, widen) of the last ladder, in price """
+
+        return self.shift, self.widen
+
+    def cap(self, sizes, room):
+        """ cut the ladder where its cumulative size reaches room """
+
+        # room left before each level, clipped to [0, size]
+        left = sizes - np.cumsum(sizes)
+        left += room
+        return np.minimum(np.maximum(left, 0.0, out=left), sizes, out=left)
+
+
+def ladder_orders(buy_prices, buy_sizes, sell_prices, sell_sizes):
+    """ order dicts for create_bulk_orders, buys first """
+
+    buys = [{'price': p, 'orderQty': int(q), 'side': 'Buy'} for p, q in zip(buy_prices.tolist(), buy_sizes.tolist())]
+    sells = [{'price': p, 'orderQty': int(q), 'side': 'Sell'} for p, q in zip(sell_prices.tolist(), sell_sizes.tolist())]
+    return buys + sells
+
+
+class QuoteThrottle(object):
+    """
+    Change detection between the quote ladder and the exchange: a new ladder only goes out when it differs
+    materially from the last one sent. The reason of every ladder sent is counted:
+
+        new      nothing sent yet, or reset
+        orders   a side has a different number of levels than is open (fills, cancels, rejects)
+        levels   a side has a different number of levels than sent
+        cross    a sent order now sits at or through the other side of the book
+        skew     the VPIN / bounce / inventory shift or the VPIN widening changed by more than the price tolerance
+        price    a level's price moved more than the price tolerance
+        size     a level's size changed by more than size_tolerance (fraction of the size)
+
+    The price tolerance is relist_ticks ticks, widened by relist_distance times how far the sent price sits behind
+    the touch (a level 90 ticks back needn't follow every tick), and at most relist_interval of the price. The skew
+    tolerance is the plain tick one. Both have to stay below the smallest skew step worth quoting on, see
+    QUOTE_RELIST_TICKS; a tolerance wider than the skews keeps the quotes still until the price walks into them.
+
+    VPIN goes through a hysteresis band before it reaches the ladder: the value quoted on only follows the
+    signal once it moved more than vpin_hysteresis away, so flickering around a level does not move the skew.
+    """
+
+    REASONS = ('new', 'orders', 'levels', 'cross', 'skew', 'price', 'size')
+
+    def __init__(self, tick_size, relist_ticks, relist_distance, relist_interval, size_tolerance, vpin_hysteresis):
+        self.tickSize = tick_size
+        self.relistTicks = relist_ticks
+        self.relistDistance = relist_distance
+        self.relistInterval = relist_interval
+        self.sizeTolerance = size_tolerance
+        self.vpinHysteresis = vpin_hysteresis
+
+        self.vpin = None
+        self.last = None
+        self.lastSkew = None
+        self.cycles = 0
+        self.sent = 0
+        self.reasons = dict((reason, 0) for reason in self.REASONS)
+
+    def filter_vpin(self, vpin):
+        if self.vpin is None or abs(vpin - self.vpin) > self.vpinHysteresis:
+            self.vpin = vpin
+        return self.vpin
+
+    def material(self, ladder, skew, bid, ask, open_buys, open_sells):
+        """
+        True if ladder, quoted with skew (QuoteLadder.skew()), has to be sent, given the touch and the number of
+        open orders per side
+        """
+
+        self.cycles += 1
+        reason = self.change(ladder, skew, bid, ask, open_buys, open_sells)
+        if reason is None:
+            return False
+        self.reasons[reason] += 1
+        return True
+
+    def change(self, ladder, skew, bid, ask, open_buys, open_sells):
+        last = self.last
+        if last is None:
+            return 'new'
+
+        buy_prices, buy_sizes, sell_prices, sell_sizes = ladder
+        last_buy_prices, last_buy_sizes, last_sell_prices, last_sell_sizes = last
+        if len(buy_prices) != open_buys or len(sell_prices) != open_sells:
+            return 'orders'
+        if len(buy_prices) != len(last_buy_prices) or len(sell_prices) != len(last_sell_prices):
+            return 'levels'
+        if len(last_buy_prices) and last_buy_prices[0] >= ask:
+            return 'cross'
+        if len(last_sell_prices) and last_sell_prices[0] <= bid:
+            return 'cross'
+
+        tolerance = self.relistTicks * self.tickSize
+        if any(abs(value - last_value) > min(tolerance, self.relistInterval * (bid + ask) / 2)
+               for value, last_value in zip(skew, self.lastSkew)):
+            return 'skew'
+        if (self.price_moved(buy_prices, last_buy_prices, tolerance, bid - last_buy_prices) or
+                self.price_moved(sell_prices, last_sell_prices, tolerance, last_sell_prices - ask)):
+            return 'price'
+        if self.size_moved(buy_sizes, last_buy_sizes) or self.size_moved(sell_sizes, last_sell_sizes):
+            return 'size'
+        return None
+
+    def price_moved(self, prices, last_prices, tolerance, distance):
+        """ distance of the sent prices behind the touch widens their tolerance by relist_distance of it """
+
+        tolerance = np.maximum(tolerance, self.relistDistance * distance)
+        return bool(np.any(np.abs(prices - last_prices) > np.minimum(tolerance, self.relistInterval * last_prices)))
+
+    def size_moved(self, sizes, last_sizes):
+        return bool(np.any(np.abs(sizes - last_sizes) > self.sizeTolerance * last_sizes))
+
+    def on_sent(self, ladder, skew):
+        self.last = ladder
+        self.lastSkew = skew
+        self.sent += 1
+
+    def reset(self):
+        """ forget the last ladder, e.g. after every order was canceled or a batch failed """
+
+        self.last = None
+        self.lastSkew = None
+
+    def report(self):
+        """ ladders sent and why, as a log line """
+
+        return "Quotes sent: %d of %d cycles (%s)" % (self.sent, self.cycles,
+                                                      ', '.join('%s %d' % (reason, self.reasons[reason])
+                                                                for reason in self.REASONS))
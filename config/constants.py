@@ -19,6 +19,18 @@ BITHUMB_BASE_URL = "https://api.bithumb.com"
 BITHUMB_API_KEY = "api-key"
 BITHUMB_API_SECRET = "secret-key"
 BITHUMB_BTC_SYMBOL = "BTC"
+BITHUMB_CURL_POOL_SIZE = 2
+BITHUMB_API_TIMEOUT = 3
+BITHUMB_DNS_CACHE_TIMEOUT = 300
+
+# REFERENCE PRICE (BITHUMB KRW -> USD)
+REFERENCE_PRICE_ENABLED = True
+REFERENCE_PRICE_INTERVAL = 0.5
+REFERENCE_PRICE_MAX_LEN = 7200
+REFERENCE_PREMIUM_WINDOW_SIZE = 120
+FX_RATE_URL = "https://api.exchangerate-api.com/v4/latest/USD"
+FX_KRW_PER_USD = 1170.0
+FX_RATE_TTL = 600
 
 # BITMEX EXCHANGE_INFO
 BITMEX_BASE_URL = "https://www.bitmex.com/api/v1"
@@ -45,17 +57,114 @@ MIN_SPREAD = 0.01
 MAINTAIN_SPREADS = True
 RELIST_INTERVAL = 0.01
 
+# QUOTING (agent.quoting.QuoteLadder): the ladder moves by these fractions of the mid, per unit of the signed VPIN
+# imbalance (vpinShort / 100), of tanh(bounceShort / QUOTE_BOUNCE_SCALE) and of the inventory at its position limit
+QUOTE_INVENTORY_SKEW = 0.002
+QUOTE_VPIN_WIDEN = 0.002
+QUOTE_VPIN_SKEW = 0.001
+QUOTE_BOUNCE_SKEW = 0.0005
+QUOTE_BOUNCE_SCALE = 5.0
+# QUOTE THROTTLE (agent.quoting.QuoteThrottle): a ladder is only sent when the skew moved more than
+# QUOTE_RELIST_TICKS ticks, a level's price more than QUOTE_RELIST_TICKS ticks or QUOTE_RELIST_DISTANCE of its
+# distance behind the touch (at most RELIST_INTERVAL of the price) or a size more than QUOTE_SIZE_TOLERANCE, and
+# VPIN only moves the skew once it changed by more than QUOTE_VPIN_HYSTERESIS.
+# Keep the tick tolerance below the skew steps, which at a 9000 mid and a 0.5 tick are
+#   QUOTE_VPIN_WIDEN * QUOTE_VPIN_HYSTERESIS * mid = 3.6 ticks per VPIN step,
+#   QUOTE_INVENTORY_SKEW * ORDER_START_SIZE / MAX_POSITION * mid = 2.2 ticks per filled order,
+# so both requote on their own; RELIST_INTERVAL (1% = 180 ticks) alone would hide them.
+QUOTE_RELIST_TICKS = 2
+QUOTE_RELIST_DISTANCE = 0.1
+QUOTE_SIZE_TOLERANCE = 0.1
+QUOTE_VPIN_HYSTERESIS = 0.1
+
 CHECK_POSITION_LIMITS = True
 MIN_POSITION = -5000
 MAX_POSITION = 5000
 
+# RISK: exchange.risk.RiskEngine checks every order batch against the position limits above (worst case, every
+# open order filled), the cost of the open orders (XBT) and a price band (fraction) around the mid
+RISK_ENABLED = True
+RISK_MAX_OPEN_NOTIONAL = 1.0
+RISK_PRICE_BAND = 0.02
+
+# WEBSOCKET CONNECTION (seconds; reconnect backoff doubles from WS_RECONNECT_DELAY up to WS_RECONNECT_MAX_DELAY)
+WS_CONNECT_TIMEOUT = 5
+WS_RECONNECT_DELAY = 0.5
+WS_RECONNECT_MAX_DELAY = 30
+WS_RECONNECT_ATTEMPTS = 10
+
+# WEBSOCKET HEARTBEAT (seconds): ping after WS_PING_INTERVAL of silence, reconnect without pong in WS_PONG_TIMEOUT.
+# Pongs only keep the connection alive. The feed is stale (no quoting) when no data message arrived in
+# WS_FEED_MAX_AGE, or a table in WS_TABLE_MAX_AGE is older. orderBook10 of an active contract like XBTUSD
+# changes several times a second, so a second without a snapshot means a frozen book or route; raise it for
+# instruments with a quieter book.
+WS_HEARTBEAT_CHECK = 0.1
+WS_PING_INTERVAL = 2
+WS_PONG_TIMEOUT = 3
+WS_FEED_MAX_AGE = 0.75
+WS_TABLE_MAX_AGE = {'orderBook10': 1.0}
+
+# REDUNDANT MARKET DATA: one more public connection per url ('' for BITMEX_WSS_URL) carrying WS_REDUNDANT_TABLES,
+# merged by trdMatchID (trades) and first arrival of a timestamp (snapshots). WS_REDUNDANT_INTERFACES binds
+# the connection of the same index to a local interface (SO_BINDTODEVICE, needs CAP_NET_RAW; '' for the default route)
+WS_REDUNDANT_URLS = []
+WS_REDUNDANT_INTERFACES = []
+WS_REDUNDANT_TABLES = ['trade', 'orderBook10', 'quote']
+WS_DEDUP_TRADE_IDS = 100000
+
+# WEBSOCKET TABLES
+# Topics subscribed (exchange.subscriptions.PROFILES: market_maker, market_data, full)
+WS_SUBSCRIPTION_PROFILE = 'market_maker'
+# Snapshot tables keep only the latest row per symbol (exchange.conflated_table.ConflatedTable).
+# Rows kept per table; tables not listed (order, position, margin, instrument) are never trimmed.
+# Trades are kept in columns by exchange.tick_store.TickStore.
+WS_CONFLATED_TABLES = ['quote', 'orderBook10']
+WS_TABLE_RETENTION = {'trade': 200, 'execution': 1000, 'funding': 100, 'liquidation': 100}
+TICK_STORE_RETENTION = 1000000
+
 # INTERVAL
 LOOP_INTERVAL = 5
 API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
 
+# SIMULATION (backtest / training environment)
+SIM_ORDER_LATENCY = 0.05
+SIM_CANCEL_LATENCY = 0.05
+SIM_MAKER_FEE = -0.00025
+SIM_TAKER_FEE = 0.00075
+SIM_DEFAULT_QUEUE = 50000
+
 # CHART
 CHART_UNITS = 1000000
+CHART_RESOLUTIONS = [100000, 1000000, 10000000]
+CHART_TIME_UNITS = [60]
 LONG_WINDOW_SIZE = 30
 MID_WINDOW_SIZE = 10
 SHORT_WINDOW_SIZE = 5
+# Candle objects kept per chart, completed candles kept in memory for history queries
+# (exchange.candle_store.CandleHistory) and where older ones are archived per day ('' disables the archive).
+# The archive writes its candles in batches of CANDLE_ARCHIVE_BATCH, or once the oldest one waited
+# CANDLE_ARCHIVE_FLUSH seconds.
+CHART_HOT_CANDLES = 200
+CHART_MAX_CANDLES = 20000
+CANDLE_ARCHIVE_DIR = 'data/candles'
+CANDLE_ARCHIVE_BATCH = 64
+CANDLE_ARCHIVE_FLUSH = 30
+
+# VPIN (rolling window over completed buckets, CDF over past VPIN values; 0 keeps the whole history)
+VPIN_WINDOW_SIZE = 50
+VPIN_CDF_BINS = 1000
+VPIN_CDF_WINDOW = 0
+
+# FILL ANALYTICS (exchange.fill_analytics): markout horizons in seconds, equal width buckets of the VPIN percentile
+FILL_MARKOUT_HORIZONS = [1, 10, 60]
+FILL_VPIN_BUCKETS = 5
+FILL_STORE_RETENTION = 100000
+
+# BULK VOLUME CLASSIFICATION (split bucket volume by Phi(dP / sigma) instead of the trade side)
+BVC_ENABLED = False
+BVC_WINDOW_SIZE = 50
+
+# REINFORCEMENT LEARNING AGENT
+# '' keeps the default ladder, *.npz loads a LinearPolicy, *.onnx an onnxruntime model
+RL_MODEL_PATH = ''
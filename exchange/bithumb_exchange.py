@@ -11,22 +11,102 @@ import urllib.parse
 import pycurl
 import json
 import certifi
-import os
+import queue
+from io import BytesIO
 
 
-class BithumbExchange(object):
-    contents = ""
+class CurlPool(object):
+    """
+    Pool of reusable curl handles.
+
+    Each handle keeps its own connection cache, so a handle taken back out of the pool
+    talks over the already established TCP+TLS connection. DNS answers and TLS sessions
+    are shared between all handles of the pool.
+    """
+
+    def __init__(self, size=2, timeout=3, dns_cache_timeout=300, keep_alive_idle=30):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.dns_cache_timeout = dns_cache_timeout
+        self.keep_alive_idle = keep_alive_idle
+
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+        # LIFO, so the most recently used (and therefore warm) handle is reused first
+        self.handles = queue.LifoQueue()
+        for _ in range(self.size):
+            self.handles.put(self.create_handle())
+
+    def create_handle(self):
+        """
+        Create a curl handle configured for persistent connections
+        """
+
+        curl_handle = pycurl.Curl()
+        curl_handle.setopt(pycurl.SHARE, self.share)
+        curl_handle.setopt(pycurl.CAINFO, certifi.where())
+        curl_handle.setopt(pycurl.NOSIGNAL, 1)
+        curl_handle.setopt(pycurl.TCP_NODELAY, 1)
+        curl_handle.setopt(pycurl.TCP_KEEPALIVE, 1)
+        curl_handle.setopt(pycurl.TCP_KEEPIDLE, self.keep_alive_idle)
+        curl_handle.setopt(pycurl.TCP_KEEPINTVL, self.keep_alive_idle)
+        curl_handle.setopt(pycurl.DNS_CACHE_TIMEOUT, self.dns_cache_timeout)
+        curl_handle.setopt(pycurl.CONNECTTIMEOUT_MS, int(self.timeout * 1000))
+        curl_handle.setopt(pycurl.TIMEOUT_MS, int(self.timeout * 1000))
+        return curl_handle
+
+    def acquire(self):
+        return self.handles.get()
+
+    def release(self, curl_handle, discard=False):
+        """
+        Give a handle back to the pool. A discarded handle (e.g. after a transfer error)
+        is closed and replaced by a fresh one.
+        """
+
+        if discard:
+            curl_handle.close()
+            curl_handle = self.create_handle()
+        self.handles.put(curl_handle)
+
+    def close(self):
+        while not self.handles.empty():
+            self.handles.get_nowait().close()
+        self.share.close()
 
-    def __init__(self, logger, base_url=None, symbol=None, api_key=None, api_secret=None):
+
+class BithumbExchange(object):
+    def __init__(self, logger, base_url=None, symbol=None, api_key=None, api_secret=None,
+                 pool_size=2, timeout=3, dns_cache_timeout=300):
         self.logger = logger
         self.base_url = base_url
         self.symbol = symbol
         self.api_key = api_key
         self.api_secret = api_secret
-        self.contents = ""
+        self.pool = CurlPool(pool_size, timeout, dns_cache_timeout)
+
+    def exit(self):
+        self.pool.close()
 
-    def body_callback(self, buf):
-        self.contents = self.contents + buf.decode('utf-8')
+    def warm_up(self, endpoint="/public/btci"):
+        """
+        Open a connection on every pooled handle so the first real call skips the handshake
+        """
+
+        handles = [self.pool.acquire() for _ in range(self.pool.size)]
+        try:
+            for curl_handle in handles:
+                curl_handle.setopt(pycurl.HTTPGET, 1)
+                curl_handle.setopt(pycurl.URL, self.base_url + endpoint)
+                curl_handle.setopt(pycurl.WRITEDATA, BytesIO())
+                curl_handle.perform()
+        except pycurl.error as e:
+            self.logger.warning("Bithumb warm up failed: %s" % e)
+        finally:
+            for curl_handle in handles:
+                self.pool.release(curl_handle)
 
     def micro_time(self, get_as_float=False):
         if get_as_float:
@@ -64,30 +144,33 @@ class BithumbExchange(object):
         api_sign = base64.b64encode(utf8_hex_output)
         utf8_api_sign = api_sign.decode('utf-8')
 
-        curl_handle = pycurl.Curl()
+        buffer = BytesIO()
+        curl_handle = self.pool.acquire()
+        discard = False
         try:
             curl_handle.setopt(pycurl.POST, 1)
             curl_handle.setopt(pycurl.POSTFIELDS, str_data)
 
             url = self.base_url + endpoint
-            curl_handle.setopt(curl_handle.CAINFO, certifi.where())
-            curl_handle.setopt(curl_handle.URL, url)
-            curl_handle.setopt(curl_handle.HTTPHEADER, ['Api-Key: ' + self.api_key,
-                                                        'Api-Sign: ' + utf8_api_sign,
-                                                        'Api-Nonce: ' + nonce])
-            curl_handle.setopt(curl_handle.WRITEFUNCTION, self.body_callback)
+            curl_handle.setopt(pycurl.URL, url)
+            curl_handle.setopt(pycurl.HTTPHEADER, ['Api-Key: ' + self.api_key,
+                                                   'Api-Sign: ' + utf8_api_sign,
+                                                   'Api-Nonce: ' + nonce])
+            curl_handle.setopt(pycurl.WRITEDATA, buffer)
 
             curl_handle.perform()
+            contents = buffer.getvalue()
         except pycurl.error as e:
-            print(e)
-            self.contents = '{"status": "1000", "message": "curl error"}'
+            self.logger.error("Bithumb curl error: %s" % e)
+            contents = b'{"status": "1000", "message": "curl error"}'
+            discard = True
         finally:
-            curl_handle.close()
+            self.pool.release(curl_handle, discard)
 
         try:
-            json_data = json.loads(self.contents)
+            json_data = json.loads(contents)
         except ValueError:
-            print("json error")
+            self.logger.error("Bithumb json error")
             json_data = json.loads('{"status": "1000", "message": "json error"}')
 
         return json_data
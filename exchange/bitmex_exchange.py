@@ -3,21 +3,30 @@
 """BitMEX API Connector."""
 from __future__ import absolute_import
 import sys
+import socket
 import requests
+import threading
 import time
 from time import sleep
 from datetime import datetime
 import json
-import decimal
 import base64
 import uuid
 import traceback
+from collections import deque
 from exchange.APIKeyAuthWithExpires import APIKeyAuthWithExpires
 from exchange.bitmex_websocket import BitMEXWebsocket
 from config.settings import settings
-from exchange.chart import CHART
+from exchange.chart_set import CHARTSET
+from exchange.conflated_table import ConflatedTable
+from exchange.feed_merger import FeedMerger
+from exchange.fill_analytics import FillAnalytics
+from exchange.portfolio import Portfolio
+from exchange.risk import RiskEngine
+from exchange.subscriptions import SubscriptionProfile, topic_table, topic_symbol
+from exchange.tick_store import TickStore, parse_timestamp
 from future.utils import iteritems
-from utils import errors
+from utils import errors, math
 
 
 class BitMEXExchange(object):
@@ -51,16 +60,67 @@ class BitMEXExchange(object):
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
 
-        # Create chart
-        self.chart = CHART(self.symbol, self.chartUnit)
-
-        # Create websocket for streaming data
-        self.ws = BitMEXWebsocket(self.logger, self.symbol, self.message_callback)
+        # Create charts (several volume resolutions and time bars from one tick stream)
+        self.charts = CHARTSET(self.symbol, settings.CHART_RESOLUTIONS, settings.CHART_TIME_UNITS, self.chartUnit,
+                               archive_dir=settings.CANDLE_ARCHIVE_DIR or None)
+        self.chart = self.charts.primary
+
+        # Create websocket for streaming data, subscribed to what the strategy reads
+        self.profile = SubscriptionProfile(settings.WS_SUBSCRIPTION_PROFILE, self.symbol, settings.CONTRACTS)
+        self.ws = BitMEXWebsocket(self.logger, self.symbol, self.message_callback, self.profile)
+        self.ws.reconnect_callback = self.on_reconnect
+        self.ws.heartbeat_callback = self.check_feed
+
+        # Extra public connections (settings.WS_REDUNDANT_URLS) carrying the market data tables again, merged
+        # into the same tables so a stall of one socket does not stall the charts and the order book
+        self.merger = None
+        self.redundant = []
+        if settings.WS_REDUNDANT_URLS:
+            self.merger = FeedMerger(settings.WS_REDUNDANT_TABLES, settings.WS_DEDUP_TRADE_IDS)
+            profile = SubscriptionProfile(settings.WS_SUBSCRIPTION_PROFILE, self.symbol, settings.CONTRACTS,
+                                          settings.WS_REDUNDANT_TABLES)
+            for i, url in enumerate(settings.WS_REDUNDANT_URLS):
+                ws = BitMEXWebsocket(self.logger, self.symbol, self.redundant_callback, profile)
+                interfaces = settings.WS_REDUNDANT_INTERFACES
+                if i < len(interfaces) and interfaces[i]:
+                    ws.sockopt = [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interfaces[i].encode())]
+                self.redundant.append((ws, url or self.wss_url))
+        # Every connection delivers on its own thread
+        self.feedLock = threading.Lock()
+
+        # Own fills of the symbol and their markouts against the order book mid
+        self.fillAnalytics = FillAnalytics(settings.FILL_MARKOUT_HORIZONS, settings.FILL_VPIN_BUCKETS,
+                                           settings.FILL_STORE_RETENTION)
+
+        # Delta of the positions in settings.CONTRACTS, from the instrument and position events
+        self.portfolio = Portfolio(settings.CONTRACTS)
+
+        # Pre-trade checks of every order batch, kept up to date from the order, execution, position and
+        # instrument events
+        self.risk = None
+        if settings.RISK_ENABLED:
+            self.risk = RiskEngine(settings.MIN_POSITION, settings.MAX_POSITION,
+                                   settings.RISK_MAX_OPEN_NOTIONAL * settings.XBt_TO_XBT, settings.RISK_PRICE_BAND,
+                                   settings.CHECK_POSITION_LIMITS)
+
+        # Trades of the symbol, kept in columns rather than in the trade table
+        self.ticks = TickStore(settings.TICK_STORE_RETENTION)
 
         # Websocket data
         self.data = {}
         self.keys = {}
 
+        # Arrival time of the last message per table, freshness seen by the last check, stale callback and its thread
+        self.tableTimes = {}
+        self.feedFresh = False
+        self.stale_callback = None
+        self.staleThread = None
+
+        # Tables whose partial arrived on the current connection. Shares the connection state condition,
+        # so waiters also wake up when the websocket exits.
+        self.partials = set()
+        self.partialsCondition = self.ws.condition
+
     def connect_websocket(self):
         """
         Connect BitMEX websocket
@@ -75,26 +135,146 @@ class BitMEXExchange(object):
             self.wait_for_account()
         self.logger.info('Got all market data. Starting.')
 
+        # Redundant connections only merge into tables the primary one synced
+        for ws, url in self.redundant:
+            ws.connect(url, should_auth=False)
+
     def disconnect_websocket(self):
         self.ws.exit()
+        for ws, _ in self.redundant:
+            ws.exit()
+        with self.feedLock:
+            self.charts.close()
 
     def wait_for_symbol(self):
         """
         On subscribe, this data will come down. Wait for it.
         """
 
-        # Wait for the keys to show up from the ws
-        while not {'instrument', 'trade', 'quote', 'orderBook10'} <= set(self.data):
-            sleep(0.1)
+        self.wait_for_partials(self.profile.public_tables())
 
     def wait_for_account(self):
         """
         On subscribe, this data will come down. Wait for it.
         """
 
-        # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order'} <= set(self.data):
-            sleep(0.1)
+        self.wait_for_partials(self.profile.private_tables())
+
+    def wait_for_partials(self, tables, timeout=None):
+        """
+        Block until the partials of tables arrived on the current connection. False on timeout or exit.
+        """
+
+        with self.partialsCondition:
+            self.partialsCondition.wait_for(lambda: tables <= self.partials or self.ws.exited, timeout)
+            return tables <= self.partials and not self.ws.exited
+
+    def on_reconnect(self):
+        """
+        Called before every reconnect attempt. Tables are rebuilt from the fresh partials; charts are kept.
+        """
+
+        with self.partialsCondition:
+            self.partials = set()
+            self.partialsCondition.notify_all()
+
+    def is_synced(self):
+        """
+        Connected and every subscribed table rebuilt from a partial of this connection
+        """
+
+        tables = self.profile.tables(self.shouldWSAuth)
+        with self.partialsCondition:
+            return self.ws.is_connected() and tables <= self.partials
+
+    def table_age(self, table, now=None):
+        """
+        Seconds since the last message of table (inf if none arrived)
+        """
+
+        if table not in self.tableTimes:
+            return float('inf')
+        return (now or time.time()) - self.tableTimes[table]
+
+    def is_feed_fresh(self, now=None):
+        """
+        Synced, a data message (pongs don't count) within WS_FEED_MAX_AGE, and every subscribed table of
+        WS_TABLE_MAX_AGE updated within its bound. Only compares timestamps, cheap enough for every loop.
+        """
+
+        now = now or time.time()
+        if not self.is_synced() or self.data_age(now) > settings.WS_FEED_MAX_AGE:
+            return False
+        # The websocket thread adds partials while this runs on the heartbeat or the trading thread
+        with self.partialsCondition:
+            tables = list(self.partials)
+        for table in tables:
+            max_age = settings.WS_TABLE_MAX_AGE.get(table)
+            if max_age is not None and self.table_age(table, now) > max_age:
+                return False
+        return True
+
+    def data_age(self, now=None):
+        """
+        Seconds since the last data message (not a pong) on any connection
+        """
+
+        ages = [self.ws.data_age(now)]
+        ages += [ws.data_age(now) for ws, _ in self.redundant if ws.is_connected()]
+        return min(ages)
+
+    def check_feed(self, now):
+        """
+        Heartbeat callback: calls stale_callback when the feed turns stale, on a thread of its own since it may
+        block on REST calls (cancelling orders) while the heartbeat has to keep pinging. One at a time: a feed
+        that flaps while the callback still runs doesn't start another.
+        """
+
+        fresh = self.is_feed_fresh(now)
+        if self.feedFresh and not fresh:
+            self.logger.warn("BitMEX, market data feed is stale.")
+            if self.stale_callback is not None:
+                if self.staleThread is not None and self.staleThread.is_alive():
+                    self.logger.info("BitMEX, stale feed callback still running, not starting another.")
+                else:
+                    self.staleThread = threading.Thread(target=self.stale_callback)
+                    self.staleThread.daemon = True
+                    self.staleThread.start()
+        elif fresh and not self.feedFresh:
+            self.logger.info("BitMEX, market data feed is fresh.")
+        self.feedFresh = fresh
+
+    def subscribe(self, topics):
+        """
+        Subscribe to more topics ('table' or 'table:symbol') while running
+        """
+
+        for ws, _ in self.redundant:
+            ws.subscribe([topic for topic in topics if topic_table(topic) in self.merger.tables])
+        return self.ws.subscribe(topics)
+
+    def unsubscribe(self, topics):
+        """
+        Unsubscribe while running and drop the rows that topic delivered
+        """
+
+        for ws, _ in self.redundant:
+            ws.unsubscribe(topics)
+        topics = self.ws.unsubscribe(topics)
+        for topic in topics:
+            table = topic_table(topic)
+            symbol = topic_symbol(topic)
+            if table not in self.data:
+                continue
+            if symbol is None:
+                del self.data[table]
+            elif isinstance(self.data[table], ConflatedTable):
+                self.data[table].delete({'symbol': symbol})
+            else:
+                rows = [row for row in self.data[table] if row.get('symbol') != symbol]
+                self.data[table].clear()
+                self.data[table] += rows
+        return topics
 
     def message_callback(self, json_data):
         """
@@ -104,6 +284,34 @@ class BitMEXExchange(object):
         message = json.loads(json_data)
         # self.logger.info(json.dumps(message))
 
+        with self.feedLock:
+            if self.merger is not None:
+                message = self.merger.merge(message)
+                if message is None:
+                    return
+            self.process_message(message)
+
+    def redundant_callback(self, json_data):
+        """
+        Handler of the redundant connections. Only rows of WS_REDUNDANT_TABLES that no connection delivered yet
+        reach the tables; errors are logged, the primary connection keeps running.
+        """
+
+        message = json.loads(json_data)
+        if 'error' in message:
+            self.logger.error("BitMEX, redundant websocket error: %s" % message['error'])
+            return
+
+        with self.feedLock:
+            message = self.merger.merge(message, primary=False)
+            if message is not None:
+                self.process_message(message)
+
+    def process_message(self, message):
+        """
+        Apply a parsed WS message to the tables
+        """
+
         table = message['table'] if 'table' in message else None
         action = message['action'] if 'action' in message else None
         try:
@@ -113,14 +321,22 @@ class BitMEXExchange(object):
                 else:
                     self.ws.error("Unable to subscribe to %s. Error: \"%s\" Please check and restart." %
                                (message['request']['args'][0], message['error']))
+            elif 'unsubscribe' in message:
+                if message['success']:
+                    self.logger.debug("Unsubscribed from %s." % message['unsubscribe'])
+                else:
+                    self.logger.error("Unable to unsubscribe from %s. Error: \"%s\"" %
+                                      (message['request']['args'][0], message['error']))
             elif 'status' in message:
                 if message['status'] == 400:
                     self.ws.error(message['error'])
                 if message['status'] == 401:
                     self.ws.error("API Key incorrect, please check and restart.")
             elif action:
+                self.tableTimes[table] = time.time()
+
                 if table not in self.data:
-                    self.data[table] = []
+                    self.data[table] = self.new_table(table)
 
                 if table not in self.keys:
                     self.keys[table] = []
@@ -130,33 +346,44 @@ class BitMEXExchange(object):
                 # 'insert'  - new row
                 # 'update'  - update row
                 # 'delete'  - delete row
-                if action == 'partial':
+                if isinstance(self.data[table], ConflatedTable):
+                    # Snapshot tables only keep the latest row per symbol
+                    if action == 'partial':
+                        self.keys[table] = message['keys']
+                    conflated = self.data[table]
+                    for row in message['data']:
+                        if action == 'update':
+                            conflated.update(row)
+                        elif action == 'delete':
+                            conflated.delete(row)
+                        else:
+                            conflated.set(row)
+
+                elif action == 'partial':
                     self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
+                    # A partial is the full table image: replace what a previous connection left behind.
+                    # Further partials of the table on this connection (another symbol filter) replace only
+                    # the rows of their symbols.
+                    rows = self.new_table(table)
+                    if table in self.partials:
+                        symbols = set(row.get('symbol') for row in message['data'])
+                        rows += [row for row in self.data[table] if row.get('symbol') not in symbols]
+                    rows += message['data']
+                    self.data[table] = rows
                     # Keys are communicated on partials to let you know how to uniquely identify
                     # an item. We use it for updates.
                     self.keys[table] = message['keys']
 
+                    # After a reconnect, trades missed while disconnected are in the partial
+                    if table == 'trade' and len(self.ticks) > 0:
+                        self.on_trades(self.missed_trades(message))
+
                 elif action == 'insert':
                     self.logger.debug('%s: inserting %s' % (table, message['data']))
                     self.data[table] += message['data']
 
                     if table == 'trade':
-                        for tick in message['data']:
-                            symbol = tick['symbol']
-                            if symbol == self.symbol:
-                                tick_seconds = int(time.time())
-                                # tick_seconds = (time.mktime(datetime.strptime(tick['timestamp'],
-                                # '%Y-%m-%dT%H:%M:%S.000Z').timetuple()) + 3600 * 9 - 5 * 60) * 1000
-                                tick_price = float(tick['price'])
-                                tick_volume = float(tick['size'])
-                                tick_dir = 1 if tick['side'] == 'Buy' else -1
-                                self.chart.make_bar(tick_seconds, tick_price, tick_dir, tick_volume)
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
+                        self.on_trades(message['data'])
 
                 elif action == 'update':
                     self.logger.debug('%s: updating %s' % (table, message['data']))
@@ -192,9 +419,137 @@ class BitMEXExchange(object):
                         self.data[table].remove(item)
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                # The risk engine first, so a failure further on can't leave it behind the tables
+                if self.risk is not None and table in ('order', 'execution', 'position', 'instrument'):
+                    self.feed_risk(table, action, message['data'])
+
+                if table == 'instrument':
+                    self.portfolio.on_instrument(message['data'])
+                elif table == 'position':
+                    self.portfolio.on_position(message['data'])
+                elif table == 'execution' and action == 'insert':
+                    self.on_executions(message['data'])
+                elif table == 'orderBook10':
+                    mid = self.book_mid()
+                    if mid is not None:
+                        self.fillAnalytics.on_mid(time.time(), mid)
+
+                if action == 'partial':
+                    with self.partialsCondition:
+                        self.partials.add(table)
+                        self.partialsCondition.notify_all()
         except:
             self.logger.error(traceback.format_exc())
 
+    def feed_risk(self, table, action, rows):
+        """
+        Pass the events of the symbol to the risk engine. The position is only taken from partials, executions
+        move it afterwards.
+        """
+
+        rows = [row for row in rows if row.get('symbol', self.symbol) == self.symbol]
+        if table == 'order':
+            self.risk.on_order(rows, action == 'partial')
+        elif table == 'execution' and action != 'partial':
+            self.risk.on_execution(rows)
+        elif table == 'position' and action == 'partial':
+            self.risk.on_position(rows)
+        elif table == 'instrument':
+            self.risk.on_instrument(rows)
+
+    def check_risk(self, orders, amend=False):
+        """
+        Reserve the exposure of an order batch, raises errors.RiskLimitError when it breaks a limit
+        """
+
+        if self.risk is None:
+            return []
+        mid = self.get_ws_ticker(self.symbol)['mid']
+        with self.feedLock:
+            try:
+                return self.risk.check_orders(orders, mid, amend)
+            except errors.RiskLimitError as e:
+                self.logger.warn("BitMEX, order batch rejected by risk check: %s" % e)
+                raise
+
+    def release_risk(self, reserved):
+        if self.risk is not None:
+            with self.feedLock:
+                self.risk.release(reserved)
+
+    def on_trades(self, trades):
+        """
+        Feed trades of the symbol to the tick store and the charts
+        """
+
+        for tick in trades:
+            symbol = tick['symbol']
+            if symbol == self.symbol:
+                self.ticks.append_trade(tick)
+                tick_seconds = int(time.time())
+                # tick_seconds = (time.mktime(datetime.strptime(tick['timestamp'],
+                # '%Y-%m-%dT%H:%M:%S.000Z').timetuple()) + 3600 * 9 - 5 * 60) * 1000
+                tick_price = float(tick['price'])
+                tick_volume = float(tick['size'])
+                tick_dir = 1 if tick['side'] == 'Buy' else -1
+                self.charts.make_bar(tick_seconds, tick_price, tick_dir, tick_volume)
+
+    def on_executions(self, executions):
+        """
+        Record own fills of the symbol with the VPIN of the current bucket
+        """
+
+        now = time.time()
+        # nan before the first completed bucket, FillAnalytics counts those fills apart
+        vpin, vpin_cdf = self.chart.latest_vpin()
+        for execution in executions:
+            if execution.get('execType') != 'Trade' or execution.get('symbol') != self.symbol:
+                continue
+            self.fillAnalytics.on_fill(now, 1 if execution['side'] == 'Buy' else -1, float(execution['lastPx']),
+                                       float(execution['lastQty']), float(execution.get('execComm') or 0),
+                                       vpin, vpin_cdf)
+
+    def book_mid(self):
+        """
+        Mid of the best orderBook10 levels of the symbol, None while a side is empty
+        """
+
+        book = self.data.get('orderBook10')
+        row = book.get(self.symbol) if isinstance(book, ConflatedTable) else None
+        if not row or not row.get('bids') or not row.get('asks'):
+            return None
+        return (row['bids'][0][0] + row['asks'][0][0]) / 2.0
+
+    def missed_trades(self, message):
+        """
+        Trades of a trade partial missing from the tick store, oldest first: the ones no connection delivered yet
+        (FeedMerger), or without redundant connections the ones newer than the last trade in the tick store
+        """
+
+        if 'missed' in message:
+            trades = [t for t in message['missed'] if t['symbol'] == self.symbol]
+        else:
+            last = self.ticks.last(1)['timestamp'][0]
+            trades = [t for t in message['data']
+                      if t['symbol'] == self.symbol and parse_timestamp(t['timestamp']) > last]
+        return sorted(trades, key=lambda t: t['timestamp'])
+
+    def new_table(self, table):
+        """
+        Snapshot tables keep the latest row per symbol (ConflatedTable), bounded tables drop their oldest rows on
+        insert (deque(maxlen)), the others are never trimmed because they hold state (orders, positions,
+        instruments) rather than history.
+        """
+
+        if table in settings.WS_CONFLATED_TABLES:
+            return ConflatedTable()
+
+        retention = settings.WS_TABLE_RETENTION.get(table)
+        if retention:
+            return deque(maxlen=retention)
+        return []
+
     def findItemByKeys(self, keys, table, match_data):
         for item in table:
             matched = True
@@ -214,7 +569,7 @@ class BitMEXExchange(object):
         if len(matchingInstruments) == 0:
             raise Exception("Unable to find instrument or index with symbol: " + symbol)
         instrument = matchingInstruments[0]
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
+        instrument['tickLog'] = math.tickLog(instrument['tickSize'])
 
         return instrument
 
@@ -255,10 +610,14 @@ class BitMEXExchange(object):
         Get market depth / orderbook.
         """
 
-        for order_book in self.data['orderBook10']:
-            if order_book['symbol'] == symbol:
-                return order_book
-        return None
+        return self.data['orderBook10'].get(symbol)
+
+    def get_ws_market_depth_if_changed(self, symbol, since):
+        """
+        (order book, sequence) with order book None when it did not change since the sequence since
+        """
+
+        return self.data['orderBook10'].get_if_changed(symbol, since)
 
     def get_ws_open_orders(self):
         """
@@ -269,6 +628,18 @@ class BitMEXExchange(object):
         # Filter to only open orders (leavesQty > 0) and those that we actually placed
         return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix) and o['leavesQty'] > 0]
 
+    def get_open_orders(self):
+        """
+        Own open orders without a REST call, copied under the feed lock: the risk engine's view (the order table
+        plus the batches it reserved and the REST results it saw), so quoting amends exactly the orders the risk
+        check knows; the websocket order table without a risk engine
+        """
+
+        with self.feedLock:
+            if self.risk is not None:
+                return self.risk.open_orders(self.orderIDPrefix)
+            return [dict(o) for o in self.get_ws_open_orders()]
+
     def get_ws_position(self, symbol):
         """
         Get your open position.
@@ -283,7 +654,7 @@ class BitMEXExchange(object):
 
     def get_ws_recent_trades(self):
         """
-        Get recent trades.
+        Get recent trades (the last WS_TABLE_RETENTION['trade'] rows; self.ticks keeps the longer history).
 
         Returns
         -------
@@ -296,6 +667,14 @@ class BitMEXExchange(object):
 
         return self.data['trade']
 
+    def get_chart(self, units=None, time=False):
+        """
+        Chart of the CHARTSET, the secondary volume charts brought up to the last trade under the feed lock
+        """
+
+        with self.feedLock:
+            return self.charts.get_chart(units, time)
+
     def instruments(self, filter=None):
         """
         Get all instrument
@@ -375,7 +754,12 @@ class BitMEXExchange(object):
         Amend multiple orders.
         """
 
-        return self._curl_bitmex(api='/order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True)
+        reserved = self.check_risk(orders, amend=True)
+        try:
+            return self._curl_bitmex(api='/order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True)
+        except Exception:
+            self.release_risk(reserved)
+            raise
 
     @authentication_required
     def create_bulk_orders(self, orders):
@@ -387,7 +771,20 @@ class BitMEXExchange(object):
             order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf-8').rstrip('=\n')
             order['symbol'] = self.symbol
             order['execInst'] = 'ParticipateDoNotInitiate'
-        return self._curl_bitmex(api='/order/bulk', postdict={'orders': orders}, verb='POST')
+        reserved = self.check_risk(orders)
+        try:
+            result = self._curl_bitmex(api='/order/bulk', postdict={'orders': orders}, verb='POST')
+        except Exception:
+            self.release_risk(reserved)
+            raise
+
+        # Link the orderIDs to the reservations now, so the next loop can amend the orders before their
+        # websocket inserts arrive. Only the ids: the order events may already be ahead of this response.
+        if self.risk is not None and result:
+            with self.feedLock:
+                self.risk.on_order([{'orderID': o['orderID'], 'clOrdID': o['clOrdID']} for o in result
+                                    if o.get('orderID') and o.get('clOrdID')])
+        return result
 
     @authentication_required
     def cancel_bulk_orders(self, orders):
@@ -421,7 +818,14 @@ class BitMEXExchange(object):
             'orderID': order_id,
         }
         self.logger.info("BitMex cancel order %s" % order_id)
-        return self._curl_bitmex(api="/order", postdict=postdict, verb="DELETE")
+        result = self._curl_bitmex(api="/order", postdict=postdict, verb="DELETE")
+
+        # The canceled orders come back with their final status: release their exposure now, not once the
+        # order events arrive, so the next batch can use the room
+        if self.risk is not None and result:
+            with self.feedLock:
+                self.risk.on_order(result if isinstance(result, list) else [result])
+        return result
 
     @authentication_required
     def withdraw(self, amount, fee, address):
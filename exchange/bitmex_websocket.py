@@ -2,22 +2,42 @@
 
 import websocket
 import threading
-from time import sleep
+import random
+import time
 import json
+import traceback
 from config.settings import settings
 from exchange.APIKeyAuth import generate_expires, generate_signature
 
 
 class BitMEXWebsocket(object):
-    # Don't grow a table larger than this amount. Helps cap memory usage.
-    MAX_TABLE_LEN = 200
-
-    def __init__(self, logger, symbol, message_callback):
+    def __init__(self, logger, symbol, message_callback, profile=None):
         self.logger = logger
         self.symbol = symbol
         self.message_callback = message_callback
+        self.profile = profile
         self.endpoint = ""
         self.shouldAuth = True
+        self.subscriptions = []
+        # socket.setsockopt arguments applied before connecting, e.g. SO_BINDTODEVICE for an egress interface
+        self.sockopt = []
+
+        # Called from the reconnect thread before every reconnect attempt
+        self.reconnect_callback = None
+        # Called from the heartbeat thread after every check
+        self.heartbeat_callback = None
+
+        # Connection state, waited on instead of polled
+        self.condition = threading.Condition()
+        self.connected = False
+        self.ws = None
+
+        # Heartbeat: time of the last message (pong included) and of the unanswered ping, if any. Market data
+        # freshness only counts the other messages: a pong proves the connection alive, not the data current.
+        self.lastMessageTime = 0.0
+        self.lastDataTime = 0.0
+        self.pingSentTime = None
+        self.heartbeat = None
 
         self.reset()
 
@@ -33,21 +53,43 @@ class BitMEXWebsocket(object):
         self.shouldAuth = should_auth
 
         # We can subscribe right in the connection querystring, so let's build that.
-        # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + self.symbol for sub in ["quote", "trade", "orderBook10"]]
-        subscriptions += ["instrument"]  # We want all of them
-        if self.shouldAuth:
-            subscriptions += [sub + ':' + self.symbol for sub in ["order", "execution"]]
-            subscriptions += ["margin", "position"]
+        # Subscribe to the topics of the subscription profile
+        if self.profile is not None:
+            subscriptions = self.profile.topics(self.shouldAuth)
+        else:
+            subscriptions = [sub + ':' + self.symbol for sub in ["quote", "trade", "orderBook10"]]
+            subscriptions += ["instrument"]  # We want all of them
+            if self.shouldAuth:
+                subscriptions += [sub + ':' + self.symbol for sub in ["order", "execution"]]
+                subscriptions += ["margin", "position"]
+        self.subscriptions = list(subscriptions)
 
         # Get WS URL and connect.
-        ws_url = endpoint + "/realtime?subscribe=" + ",".join(subscriptions)
+        ws_url = self.get_ws_url()
         self.logger.info("BitMEX, Websocket Connecting to %s" % ws_url)
-        self.__connect(ws_url)
+        if not self.__connect(ws_url):
+            self.logger.error("BitMEX, Websocket not connected. Exiting.")
+            self.exit()
+            return
+
+        self.logger.info("BitMEX, Websocket connect complete!")
+
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.__heartbeat)
+            self.heartbeat.daemon = True
+            self.heartbeat.start()
+
+    def get_ws_url(self):
+        # Topics subscribed since connect are part of the url of a reconnect
+        return self.endpoint + "/realtime?subscribe=" + ",".join(self.subscriptions)
 
     def exit(self):
         self.exited = True
-        self.ws.close()
+        with self.condition:
+            self.connected = False
+            self.condition.notify_all()
+        if self.ws is not None:
+            self.ws.close()
 
     def reset(self):
         self.exited = False
@@ -58,36 +100,148 @@ class BitMEXWebsocket(object):
         self.logger.error(err)
         self.exit()
 
+    def is_connected(self):
+        return self.connected and not self.exited
+
+    def message_age(self, now=None):
+        """
+        Seconds since the last message or pong on the current connection
+        """
+
+        return (now or time.time()) - self.lastMessageTime
+
+    def data_age(self, now=None):
+        """
+        Seconds since the last message other than a pong on the current connection
+        """
+
+        return (now or time.time()) - self.lastDataTime
+
+    def wait_connected(self, timeout=None):
+        """
+        Block until the socket is open (True) or closed for good / timeout (False)
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.connected or self.exited, timeout)
+            return self.connected
+
     def __connect(self, ws_url):
         """
-        Connect to the websocket
+        Connect to the websocket. Returns True once it is open.
         """
 
         self.logger.info("BitMEX, Websocket %s", ws_url)
 
+        self._error = None
+
         # websocket.enableTrace(True)
-        self.ws = websocket.WebSocketApp(ws_url,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth())
-
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever())
+        # Callbacks take the socket first, so events of a replaced socket can be told apart and ignored
+        ws = websocket.WebSocketApp(ws_url,
+                                    on_message=lambda ws, message: self.__on_message(ws, message),
+                                    on_close=lambda ws, *args: self.__on_close(ws),
+                                    on_open=lambda ws: self.__on_open(ws),
+                                    on_error=lambda ws, error: self.__on_error(ws, error),
+                                    header=self.__get_auth())
+        self.ws = ws
+
+        self.wst = threading.Thread(target=lambda: ws.run_forever(sockopt=self.sockopt))
         self.wst.daemon = True
         self.wst.start()
 
         # Wait for connect before continuing
-        conn_timeout = 5
-        while (not self.ws.sock or not self.ws.sock.connected) and conn_timeout and not self._error:
-            sleep(1)
-            conn_timeout -= 1
+        with self.condition:
+            self.condition.wait_for(lambda: self.connected or self._error is not None or self.exited,
+                                    settings.WS_CONNECT_TIMEOUT)
+            return self.connected
 
-        if not conn_timeout or self._error:
-            self.logger.error("BitMEX, Websocket not connected. Exiting.")
-            self.exit()
+    def __heartbeat(self):
+        """
+        Send 'ping' after WS_PING_INTERVAL seconds of silence and drop the connection (which reconnects) when
+        no message arrives within WS_PONG_TIMEOUT of it. A silently dead TCP connection is noticed in seconds.
+        """
 
-        self.logger.info("BitMEX, Websocket connect complete!")
+        while not self.exited:
+            with self.condition:
+                self.condition.wait_for(lambda: self.exited, settings.WS_HEARTBEAT_CHECK)
+            if self.exited:
+                return
+
+            now = time.time()
+            ws = self.ws
+            if self.connected and ws is not None:
+                if self.pingSentTime is None:
+                    if now - self.lastMessageTime >= settings.WS_PING_INTERVAL:
+                        self.pingSentTime = now
+                        try:
+                            ws.send("ping")
+                        except Exception as e:
+                            self.logger.error("BitMEX, Websocket ping failed: %s" % e)
+                elif now - self.pingSentTime >= settings.WS_PONG_TIMEOUT:
+                    self.logger.error("BitMEX, Websocket no pong for %.1f seconds, reconnecting." %
+                                      (now - self.pingSentTime))
+                    self.pingSentTime = None
+                    self.__drop(ws)
+
+            if self.heartbeat_callback is not None:
+                # An exception here would end the heartbeat, and with it the pings, without a trace
+                try:
+                    self.heartbeat_callback(now)
+                except Exception:
+                    self.logger.error("BitMEX, Websocket heartbeat callback failed: %s" % traceback.format_exc())
+
+    def __drop(self, ws):
+        """
+        Abandon a dead connection without waiting for its close handshake and reconnect. Its own close
+        event is ignored since it is no longer self.ws.
+        """
+
+        with self.condition:
+            if ws is not self.ws:
+                return
+            self.ws = None
+            self.connected = False
+            self.condition.notify_all()
+
+        try:
+            ws.close(timeout=0)
+        except Exception:
+            pass
+
+        if not self.exited:
+            reconnect = threading.Thread(target=self.__reconnect)
+            reconnect.daemon = True
+            reconnect.start()
+
+    def __reconnect(self):
+        """
+        Reconnect with exponential backoff (and jitter). Gives up, and exits, after WS_RECONNECT_ATTEMPTS.
+        """
+
+        delay = settings.WS_RECONNECT_DELAY
+        for attempt in range(1, settings.WS_RECONNECT_ATTEMPTS + 1):
+            if self.exited:
+                return
+
+            self.logger.info("BitMEX, Websocket reconnecting (attempt %d)" % attempt)
+            if self.reconnect_callback is not None:
+                self.reconnect_callback()
+
+            if self.__connect(self.get_ws_url()):
+                self.logger.info("BitMEX, Websocket reconnected.")
+                return
+
+            # Drop the failed socket; its close event is ignored since it is no longer self.ws
+            failed = self.ws
+            self.ws = None
+            failed.close()
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.exited, delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, settings.WS_RECONNECT_MAX_DELAY)
+
+        self.logger.error("BitMEX, Websocket could not reconnect. Exiting.")
+        self.exit()
 
     def __get_auth(self):
         """
@@ -103,6 +257,31 @@ class BitMEXWebsocket(object):
             "api-key:" + settings.BITMEX_API_KEY
         ]
 
+    def subscribe(self, topics):
+        """
+        Subscribe to more topics ('table' or 'table:symbol') on the open connection.
+        """
+
+        topics = [topic for topic in topics if topic not in self.subscriptions]
+        # While reconnecting the topics are only added to the url of the next connection
+        if topics and self.is_connected():
+            self.__send_command("subscribe", topics)
+        if topics:
+            self.subscriptions += topics
+        return topics
+
+    def unsubscribe(self, topics):
+        """
+        Stop topics on the open connection, so their messages are no longer sent at all.
+        """
+
+        topics = [topic for topic in topics if topic in self.subscriptions]
+        if topics and self.is_connected():
+            self.__send_command("unsubscribe", topics)
+        if topics:
+            self.subscriptions = [topic for topic in self.subscriptions if topic not in topics]
+        return topics
+
     def __send_command(self, command, args=None):
         """
         Send a raw command.
@@ -111,34 +290,69 @@ class BitMEXWebsocket(object):
             args = []
         self.ws.send(json.dumps({"op": command, "args": args}))
 
-    def __on_open(self):
+    def __on_open(self, ws):
         """
         Handler for WS open event
         """
 
+        if ws is not self.ws:
+            return
+
         self.logger.info("BitMEX, Websocket Opened.")
 
-        self.exited = False
+        self.lastMessageTime = time.time()
+        self.pingSentTime = None
+        with self.condition:
+            self.connected = True
+            self.condition.notify_all()
 
-    def __on_message(self, json_data):
+    def __on_message(self, ws, json_data):
         """
         Handler for parsing WS messages.
         """
 
+        if ws is not self.ws:
+            return
+
+        # Any message proves the connection alive
+        self.lastMessageTime = time.time()
+        self.pingSentTime = None
+        if json_data == 'pong':
+            return
+
+        self.lastDataTime = self.lastMessageTime
         self.message_callback(json_data)
 
-    def __on_close(self):
+    def __on_close(self, ws):
         """
         Handler for WS close event
         """
 
+        if ws is not self.ws:
+            return
+
         self.logger.info('BitMEX, Websocket Closed')
-        self.exit()
 
-    def __on_error(self, error):
+        with self.condition:
+            was_connected = self.connected
+            self.connected = False
+            self.condition.notify_all()
+
+        # Unexpected close of an established connection: reconnect in the background
+        if was_connected and not self.exited:
+            reconnect = threading.Thread(target=self.__reconnect)
+            reconnect.daemon = True
+            reconnect.start()
+
+    def __on_error(self, ws, error):
         """
-        Handler for WS close event
+        Handler for WS error event. A close event follows, which reconnects.
         """
 
-        if not self.exited:
-            self.error(error)
+        if ws is not self.ws or self.exited:
+            return
+
+        self.logger.error("BitMEX, Websocket error: %s" % error)
+        with self.condition:
+            self._error = error
+            self.condition.notify_all()
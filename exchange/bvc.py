@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+
+SQRT2 = math.sqrt(2.0)
+
+# math.erf element wise, so the array path matches the scalar path bit for bit
+_erf = np.frompyfunc(math.erf, 1, 1)
+
+
+def normal_cdf(z):
+    return 0.5 * (1.0 + math.erf(z / SQRT2))
+
+
+class BulkVolumeClassifier(object):
+    """
+    Bulk volume classification (Easley, Lopez de Prado, O'Hara): the buy share of a bucket's volume is
+    Phi(dP / sigma), dP being the close to close price change of the bucket.
+
+    sigma is an EWMA of squared price changes over the completed buckets, so a bucket is classified with the
+    volatility known when it started. Until a price change has been seen volume is split evenly.
+    """
+
+    def __init__(self, window=50):
+        self.alpha = 2.0 / (window + 1.0)
+        self.variance = 0.0
+        self.count = 0
+
+    def buy_fraction(self, delta_price):
+        if self.variance <= 0:
+            return 0.5
+        return normal_cdf(delta_price / math.sqrt(self.variance))
+
+    def split(self, delta_price, volume):
+        """ (buy volume, sell volume) """
+
+        buy_volume = volume * self.buy_fraction(delta_price)
+        return buy_volume, volume - buy_volume
+
+    def update(self, delta_price):
+        """ Add the price change of a completed bucket to the volatility estimate """
+
+        squared = delta_price * delta_price
+        if self.count == 0:
+            self.variance = squared
+        else:
+            self.variance = (1 - self.alpha) * self.variance + self.alpha * squared
+        self.count += 1
+
+
+def bulk_volume(close_prices, volumes, first_price=None, window=50):
+    """
+    Array version of BulkVolumeClassifier over consecutive buckets. The first bucket's price change is taken
+    against first_price (its open), or is zero. Returns (buy volume, sell volume) arrays.
+    """
+
+    close_prices = np.asarray(close_prices, dtype=float)
+    volumes = np.asarray(volumes, dtype=float)
+    n = len(close_prices)
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+
+    delta = np.diff(close_prices, prepend=close_prices[0] if first_price is None else first_price)
+
+    # Variance known at the start of every bucket (sequential, same order as BulkVolumeClassifier.update)
+    alpha = 2.0 / (window + 1.0)
+    variance = np.empty(n)
+    prev = 0.0
+    for i, d in enumerate(delta.tolist()):
+        variance[i] = prev
+        prev = d * d if i == 0 else (1 - alpha) * prev + alpha * (d * d)
+
+    sigma = np.sqrt(variance)
+    known = sigma > 0
+    z = np.divide(delta, sigma, out=np.zeros(n), where=known)
+    fraction = np.where(known, 0.5 * (1.0 + _erf(z / SQRT2).astype(float)), 0.5)
+
+    buy_volume = volumes * fraction
+    return buy_volume, volumes - buy_volume
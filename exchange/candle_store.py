@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import numpy as np
+from exchange.column_store import ColumnStore
+
+# BAR attributes kept per completed bucket
+CANDLE_FIELDS = [
+    ('start_time', np.float64), ('end_time', np.float64),
+    ('openPrice', np.float64), ('highPrice', np.float64), ('lowPrice', np.float64), ('closePrice', np.float64),
+    ('totalCnt', np.int64), ('totalVolume', np.float64), ('totalAmt', np.float64),
+    ('askCnt', np.int64), ('bidCnt', np.int64), ('askVolume', np.float64), ('bidVolume', np.float64),
+    ('askAmt', np.float64), ('bidAmt', np.float64),
+    ('bounceCnt', np.int64), ('priceLong', np.float64), ('priceShort', np.float64),
+    ('vpinLong', np.float64), ('vpinShort', np.float64), ('bounceLong', np.float64), ('bounceShort', np.float64),
+    ('vpin', np.float64), ('vpinCdf', np.float64),
+]
+CANDLE_NAMES = [name for name, _ in CANDLE_FIELDS]
+
+
+class CandleHistory(ColumnStore):
+    """
+    Completed candles of a chart in contiguous numpy columns named like the BAR attributes, queried by the
+    end_time of the bucket. Bucket indices count from the first candle of the chart.
+
+    Queries return views into the ring (see ColumnStore): they hold their values for at least
+    capacity - len(view) more candles, CHART_MAX_CANDLES / 8 for a full window. Strategies that keep the
+    result across that many buckets copy it (np.copy) first.
+    """
+
+    def __init__(self, retention=100000, spill=None):
+        super(CandleHistory, self).__init__(CANDLE_FIELDS, retention, 'end_time', spill)
+
+    def append(self, candle):
+        self.append_row([getattr(candle, name) for name in CANDLE_NAMES])
+
+
+class CandleArchive(object):
+    """
+    Append only on-disk columns of completed candles, one directory per symbol, chart and UTC day:
+
+        root/<symbol>/<volume|time><units>/<YYYYMMDD>/<field>.bin
+
+    Every field is a raw array of its CANDLE_FIELDS dtype, so other processes can np.memmap a
+    day while the bot keeps appending. Columns are written one after the other, so readers use the shortest
+    column; a row cut short by a crash is truncated away when the writer reopens the day.
+
+    Candles are buffered and written batch_rows at a time, or once the oldest buffered one waited batch_seconds,
+    one write per column and batch, so a closed bucket costs the websocket thread a list append. Readers see a
+    candle up to batch_seconds late; close() writes what is left, a crash loses it.
+    """
+
+    def __init__(self, root, symbol, units, kind='volume', batch_rows=1, batch_seconds=0):
+        self.path = os.path.join(root, symbol, '%s%d' % (kind, units))
+        self.day = None
+        self.files = {}
+        self.batchRows = max(1, batch_rows)
+        self.batchSeconds = batch_seconds
+        # Buffered candles of self.day as CANDLE_NAMES tuples, and the time the first of them was buffered
+        self.pending = []
+        self.pendingSince = None
+
+    @staticmethod
+    def day_of(seconds):
+        return time.strftime('%Y%m%d', time.gmtime(seconds))
+
+    def open_day(self, day):
+        self.close()
+        path = os.path.join(self.path, day)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        rows = day_length(path)
+        for name, dtype in CANDLE_FIELDS:
+            file_path = os.path.join(path, name + '.bin')
+            f = open(file_path, 'ab')
+            f.truncate(rows * np.dtype(dtype).itemsize)
+            self.files[name] = f
+        self.day = day
+
+    def append(self, candle):
+        day = self.day_of(candle.end_time)
+        if day != self.day:
+            self.write()
+            self.open_day(day)
+
+        now = time.time()
+        if not self.pending:
+            self.pendingSince = now
+        self.pending.append(tuple(getattr(candle, name) for name in CANDLE_NAMES))
+        if len(self.pending) >= self.batchRows or now - self.pendingSince >= self.batchSeconds:
+            self.write()
+
+    def write(self):
+        """ write the buffered candles, one column after the other """
+
+        if not self.pending:
+            return
+
+        rows = np.array(self.pending, dtype=CANDLE_FIELDS)
+        for name, _ in CANDLE_FIELDS:
+            self.files[name].write(rows[name].tobytes())
+        for f in self.files.values():
+            f.flush()
+        self.pending = []
+        self.pendingSince = None
+
+    def close(self):
+        self.write()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.day = None
+
+    #
+    # Readers
+    #
+
+    def days(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d)))
+
+    def read_day(self, day):
+        return read_day(os.path.join(self.path, day))
+
+    def between(self, start_time, end_time=None):
+        """
+        Candles that ended in [start_time, end_time), concatenated over the days involved
+        """
+
+        first = self.day_of(start_time)
+        last = self.day_of(end_time) if end_time is not None else None
+        parts = []
+        for day in self.days():
+            if day < first or (last is not None and day > last):
+                continue
+            columns = self.read_day(day)
+            end_times = columns['end_time']
+            lo = np.searchsorted(end_times, start_time, side='left')
+            hi = len(end_times) if end_time is None else np.searchsorted(end_times, end_time, side='left')
+            if hi > lo:
+                parts.append(dict((name, column[lo:hi]) for name, column in columns.items()))
+
+        if len(parts) == 1:
+            return parts[0]
+        return dict((name, np.concatenate([p[name] for p in parts]) if parts else np.zeros(0, dtype=dtype))
+                    for name, dtype in CANDLE_FIELDS)
+
+
+def day_length(path):
+    """ complete rows of a day directory (shortest column) """
+
+    rows = None
+    for name, dtype in CANDLE_FIELDS:
+        file_path = os.path.join(path, name + '.bin')
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        n = size // np.dtype(dtype).itemsize
+        rows = n if rows is None else min(rows, n)
+    return rows or 0
+
+
+def read_day(path):
+    """
+    Read only memory maps of the complete rows of a day directory, safe while the bot appends to it
+    """
+
+    rows = day_length(path)
+    columns = {}
+    for name, dtype in CANDLE_FIELDS:
+        if rows > 0:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=(rows,))
+        else:
+            columns[name] = np.zeros(0, dtype=dtype)
+    return columns
@@ -2,7 +2,13 @@
 
 import math
 import time
+import numpy as np
+from collections import deque
 from config.settings import settings
+from exchange.bvc import BulkVolumeClassifier
+from exchange.candle_store import CandleHistory, CandleArchive, CANDLE_NAMES
+from exchange.chart_columnar import columnar_chart, split_ticks
+from exchange.vpin import RollingVPIN, VPINDistribution
 
 
 class BAR(object):
@@ -21,6 +27,10 @@ class BAR(object):
         self.vpinLong = 0.0
         self.vpinShort = 0.0
 
+        # 완료된 버킷 기준 VPIN 과 과거 VPIN 분포상의 백분위
+        self.vpin = 0.0
+        self.vpinCdf = 0.0
+
         self.totalCnt = 0
         self.totalVolume = 0
         self.totalAmt = 0.0
@@ -38,59 +48,175 @@ class BAR(object):
         self.bounceLong = 0.0
 
 
+def hist_ticks(data):
+    """
+    OHLCV 이력 ([ms, open, high, low, close, volume], ...) 의 각 바를 open -> low/high -> close 순서의 네 틱
+    (거래량 1/4 씩) 으로 변환, 값이 빠지거나 거래량이 없는 바는 건너뜀. (seconds, prices, volumes) 배열
+    """
+
+    bars = np.array([bar[:6] for bar in data if None not in bar[:6] and bar[5] > 0], dtype=float).reshape(-1, 6)
+    seconds, open_price, high_price, low_price, close_price, volume = bars.T
+    up = close_price >= open_price
+    prices = np.column_stack((open_price, np.where(up, low_price, high_price), np.where(up, high_price, low_price),
+                              close_price)).ravel()
+    return np.repeat(seconds / 1000, 4), prices, np.repeat(volume / 4.0, 4)
+
+
 class CHART(object):
-    def __init__(self, symbol="", units=300):
-        """ 차트 생성자 """
+    kind = 'volume'
+
+    def __init__(self, symbol="", units=300, long_window=None, short_window=None, bvc=None, archive_dir=None):
+        """
+        차트 생성자
+        bvc: 틱 방향 대신 bulk volume classification 으로 매수/매도 거래량 분류
+        archive_dir: 완료된 바를 일자별 컬럼 파일로 보관 (None 이면 메모리 이력만 유지)
+        """
 
         self.symbol = symbol
         self.units = units
-        self.longAlpha = 2.0 / (settings.LONG_WINDOW_SIZE + 1.0)
-        self.shortAlpha = 2.0 / (settings.SHORT_WINDOW_SIZE + 1.0)
+        self.longWindow = settings.LONG_WINDOW_SIZE if long_window is None else long_window
+        self.shortWindow = settings.SHORT_WINDOW_SIZE if short_window is None else short_window
+        self.longAlpha = 2.0 / (self.longWindow + 1.0)
+        self.shortAlpha = 2.0 / (self.shortWindow + 1.0)
+
+        # 볼륨 차트의 BAR 시작 시각은 초 단위
+        self.barSeconds = 1
+
+        self.useBVC = settings.BVC_ENABLED if bvc is None else bvc
+
+        # 최근 바 (hot), 완료된 바 컬럼 이력 (warm), 디스크 아카이브 (cold)
+        self.candles = deque(maxlen=settings.CHART_HOT_CANDLES)
+        self.history = CandleHistory(settings.CHART_MAX_CANDLES)
+        self.archive = CandleArchive(archive_dir, symbol, units, self.kind, settings.CANDLE_ARCHIVE_BATCH,
+                                     settings.CANDLE_ARCHIVE_FLUSH) if archive_dir else None
+        self.reset_indicators()
 
-        self.candles = []
+    def close(self):
+        """ 아카이브에 남은 바 기록 """
+
+        if self.archive is not None:
+            self.archive.close()
+
+    def reset_indicators(self):
+        self.rollingVPIN = RollingVPIN(settings.VPIN_WINDOW_SIZE)
+        self.vpinDistribution = VPINDistribution(settings.VPIN_CDF_BINS, settings.VPIN_CDF_WINDOW)
+        self.classifier = BulkVolumeClassifier(settings.BVC_WINDOW_SIZE)
 
     def make_hist_bar(self, data):
-        self.candles = []
-
-        for bar in data:
-            seconds = bar[0] / 1000
-            open_price = bar[1]
-            high_price = bar[2]
-            low_price = bar[3]
-            close_price = bar[4]
-            volume = bar[5]
-            if seconds is None or open_price is None or high_price is None or low_price is None or close_price is None \
-                    or volume is None:
-                continue
-
-            self.create_bar(seconds, open_price)
-            cur_candle = self.candles[-1]
-            cur_candle.openPrice = open_price
-            cur_candle.closePrice = close_price
-            cur_candle.highPrice = high_price
-            cur_candle.lowPrice = low_price
-            cur_candle.totalVolume = volume
+        """
+        OHLCV 이력 ([ms, open, high, low, close, volume], ...) 으로 차트 생성.
+        각 바를 hist_ticks 의 네 틱으로 바꾸고 방향 정보가 없으므로 BVC (bulk_volume) 로 매수/매도 거래량을 나눔.
+        버킷은 columnar_chart 로 한 번에 계산하고 바, 컬럼 이력, BVC 변동성, VPIN 윈도우와 분포를 채우므로
+        틱마다 make_bar 로 재생한 것과 같은 상태에서 VPIN 이 즉시 채워짐. 이력 바는 아카이브하지 않음.
+        """
+
+        self.candles.clear()
+        self.history.clear()
+        self.reset_indicators()
+
+        seconds, prices, volumes = hist_ticks(data)
+        columns = columnar_chart(seconds, prices, np.zeros(len(prices), dtype=np.int8), volumes, self.units,
+                                 self.longWindow, self.shortWindow, bvc=True)
+        if columns:
+            self.seed(columns, prices, volumes)
 
         self.print_bar()
 
+    def seed(self, columns, prices, volumes):
+        """ columnar_chart 결과로 바 (hot), 컬럼 이력, BVC 변동성, VPIN 윈도우와 분포 설정 """
+
+        # 마지막 버킷은 아직 열려 있음, 나머지는 complete_bar 를 거친 상태
+        completed = len(columns['closePrice']) - 1
+        close = columns['closePrice']
+        delta = np.diff(close, prepend=columns['openPrice'][0])
+        for delta_price in delta[:completed].tolist():
+            self.classifier.update(delta_price)
+        for ask_volume, bid_volume in zip(columns['askVolume'][:completed].tolist(),
+                                          columns['bidVolume'][:completed].tolist()):
+            if ask_volume + bid_volume > 0:
+                self.vpinDistribution.add(self.rollingVPIN.add(ask_volume, bid_volume))
+
+        self.history.extend(dict((name, columns[name][:completed]) for name in CANDLE_NAMES))
+
+        # bounce 방향: 각 버킷 마지막 틱까지의 마지막 가격 변화 부호
+        tick_index, bucket_index, _ = split_ticks(volumes, self.units)
+        last_tick = tick_index[np.append(np.flatnonzero(np.diff(bucket_index)), len(tick_index) - 1)]
+        change = np.sign(np.diff(prices, prepend=prices[0]))
+        moved = np.maximum.accumulate(np.where(change != 0, np.arange(len(change)), -1))
+        up_down = np.where(moved >= 0, change[np.maximum(moved, 0)], 0.0)[last_tick]
+
+        for k in range(max(0, completed + 1 - self.candles.maxlen), completed + 1):
+            candle = BAR(columns['start_time'][k], columns['openPrice'][k], self.barSeconds)
+            for name in CANDLE_NAMES:
+                setattr(candle, name, columns[name][k].item())
+            candle.bouncePrice = candle.closePrice
+            candle.bounceUpDown = int(up_down[k])
+            self.candles.append(candle)
+
     def create_bar(self, tick_seconds, tick_price):
         """ BAR 생성 """
 
-        # 적정 수준의 캔들을 유지
-        if len(self.candles) > 200:
-            self.candles.pop(0)
-
-        new_candle = BAR(tick_seconds, tick_price, self.units)
+        new_candle = BAR(tick_seconds, tick_price, self.barSeconds)
         if len(self.candles) > 0:
             prev_candle = self.candles[-1]
+            self.complete_bar(prev_candle)
             new_candle.bouncePrice = prev_candle.bouncePrice
             new_candle.bounceUpDown = prev_candle.bounceUpDown
+            new_candle.vpin = prev_candle.vpin
+            new_candle.vpinCdf = prev_candle.vpinCdf
         else:
             new_candle.bouncePrice = tick_price
             new_candle.bounceUpDown = 0
 
         self.candles.append(new_candle)
 
+    def latest_vpin(self):
+        """ 최종 바의 (vpin, vpinCdf), 완료된 버킷의 VPIN 이 아직 없으면 (nan, nan) """
+
+        if len(self.candles) <= 0 or self.vpinDistribution.total <= 0:
+            return float('nan'), float('nan')
+        candle = self.candles[-1]
+        return candle.vpin, candle.vpinCdf
+
+    def price_change(self):
+        """ 최종 바의 직전 바 종가 대비 가격 변화 (첫 바는 시가 대비) """
+
+        cur_candle = self.candles[-1]
+        if len(self.candles) > 1:
+            return cur_candle.closePrice - self.candles[-2].closePrice
+        return cur_candle.closePrice - cur_candle.openPrice
+
+    def classify_bar(self, candle):
+        """ BVC 로 최종 바의 매수/매도 거래량 분류 """
+
+        buy_volume, sell_volume = self.classifier.split(self.price_change(), candle.totalVolume)
+        candle.askVolume = buy_volume
+        candle.bidVolume = sell_volume
+        if candle.totalVolume > 0:
+            candle.askAmt = candle.totalAmt * buy_volume / candle.totalVolume
+            candle.bidAmt = candle.totalAmt - candle.askAmt
+
+    def complete_bar(self, candle):
+        """ 버킷 완료 시 BVC 변동성, VPIN 윈도우와 분포, 이력 갱신 """
+
+        self.classifier.update(self.price_change())
+
+        # 매수/매도 구분이 없는 바는 VPIN 갱신을 건너뜀
+        if candle.askVolume + candle.bidVolume > 0:
+            candle.vpin = self.rollingVPIN.add(candle.askVolume, candle.bidVolume)
+            self.vpinDistribution.add(candle.vpin)
+            candle.vpinCdf = self.vpinDistribution.cdf(candle.vpin)
+
+        # 완료된 바는 컬럼 이력과 아카이브에 보관
+        self.history.append(candle)
+        if self.archive is not None:
+            self.archive.append(candle)
+
+    def imbalance(self, candle):
+        """ 매수/매도 거래량 불균형 (VPIN 입력) """
+
+        return (candle.askVolume - candle.bidVolume) / self.units
+
     def update_bar(self, tick_seconds, tick_price, tick_dir, tick_volume):
         """ 틱 업데이트 """
 
@@ -139,6 +265,65 @@ class CHART(object):
             cur_candle.bouncePrice = tick_price
             cur_candle.bounceUpDown = -1
 
+        self.update_indicators(cur_candle)
+
+    def add_ticks(self, ticks):
+        """
+        현재 바를 넘지 않는 연속 틱 (tick_seconds, tick_price, tick_dir, tick_volume, tick_price * tick_volume)
+        을 한 번에 반영, update_bar 를 틱마다 호출한 것과 같은 값이며 지표는 한 번만 계산
+        """
+
+        cur_candle = self.candles[-1]
+        high_price, low_price = cur_candle.highPrice, cur_candle.lowPrice
+        bounce_price, bounce_up_down, bounce_cnt = cur_candle.bouncePrice, cur_candle.bounceUpDown, cur_candle.bounceCnt
+        total_volume, total_amt = cur_candle.totalVolume, cur_candle.totalAmt
+        ask_cnt, ask_volume, ask_amt = cur_candle.askCnt, cur_candle.askVolume, cur_candle.askAmt
+        bid_cnt, bid_volume, bid_amt = cur_candle.bidCnt, cur_candle.bidVolume, cur_candle.bidAmt
+
+        # update_bar 와 같은 반올림이 되도록 틱 순서대로 합산
+        for tick_seconds, tick_price, tick_dir, tick_volume, tick_amount in ticks:
+            if high_price < tick_price:
+                high_price = tick_price
+            if low_price > tick_price:
+                low_price = tick_price
+            total_volume += tick_volume
+            total_amt += tick_amount
+            if tick_dir == 1:
+                ask_cnt += 1
+                ask_volume += tick_volume
+                ask_amt += tick_amount
+            else:
+                bid_cnt += 1
+                bid_volume += tick_volume
+                bid_amt += tick_amount
+            if bounce_price < tick_price:
+                bounce_cnt += 1
+                bounce_price = tick_price
+                bounce_up_down = 1
+            elif bounce_price > tick_price:
+                bounce_cnt -= 1
+                bounce_price = tick_price
+                bounce_up_down = -1
+
+        cur_candle.end_time = ticks[-1][0]
+        cur_candle.closePrice = ticks[-1][1]
+        cur_candle.highPrice, cur_candle.lowPrice = high_price, low_price
+        cur_candle.bouncePrice, cur_candle.bounceUpDown, cur_candle.bounceCnt = bounce_price, bounce_up_down, bounce_cnt
+        cur_candle.totalCnt += len(ticks)
+        cur_candle.totalVolume, cur_candle.totalAmt = total_volume, total_amt
+        cur_candle.askCnt, cur_candle.askVolume, cur_candle.askAmt = ask_cnt, ask_volume, ask_amt
+        cur_candle.bidCnt, cur_candle.bidVolume, cur_candle.bidAmt = bid_cnt, bid_volume, bid_amt
+
+        self.update_indicators(cur_candle)
+
+    def update_indicators(self, cur_candle):
+        """ BVC 분류, 이동평균 가격, VPIN, bounce 갱신 (바의 누적값에만 의존) """
+
+        if self.useBVC:
+            self.classify_bar(cur_candle)
+
+        imbalance = self.imbalance(cur_candle)
+
         # 이전 바 가져오기
         if len(self.candles) > 2:
             prev_candle = self.candles[-2]
@@ -148,8 +333,8 @@ class CHART(object):
             cur_candle.priceShort = (1 - self.shortAlpha) * prev_candle.priceShort + self.shortAlpha * cur_candle.closePrice
 
             # VPIN
-            cur_candle.vpinLong = (1 - self.longAlpha) * prev_candle.vpinLong + self.longAlpha * ((cur_candle.askVolume - cur_candle.bidVolume) / self.units) * 100.0
-            cur_candle.vpinShort = (1 - self.shortAlpha) * prev_candle.vpinShort + self.shortAlpha * ((cur_candle.askVolume - cur_candle.bidVolume) / self.units) * 100.0
+            cur_candle.vpinLong = (1 - self.longAlpha) * prev_candle.vpinLong + self.longAlpha * imbalance * 100.0
+            cur_candle.vpinShort = (1 - self.shortAlpha) * prev_candle.vpinShort + self.shortAlpha * imbalance * 100.0
 
             # Bounce
             cur_candle.bounceLong = (1 - self.longAlpha) * prev_candle.bounceLong + self.longAlpha * cur_candle.bounceCnt
@@ -161,8 +346,8 @@ class CHART(object):
             cur_candle.priceShort = cur_candle.closePrice
 
             # VPIN
-            cur_candle.vpinLong = ((cur_candle.askVolume - cur_candle.bidVolume) / self.units) * 100.0
-            cur_candle.vpinShort = ((cur_candle.askVolume - cur_candle.bidVolume) / self.units) * 100.0
+            cur_candle.vpinLong = imbalance * 100.0
+            cur_candle.vpinShort = imbalance * 100.0
 
             # Bounce
             cur_candle.bounceLong = cur_candle.bounceCnt
@@ -174,7 +359,8 @@ class CHART(object):
 
             print('%s: %s, %.2f, %.2f, %.2f, %.2f, bounce = %.2f, %.2f' %
                   (self.symbol, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(candle.start_time)), candle.closePrice,
-                   candle.vpinShort, candle.vpinLong, ((candle.askVolume - candle.bidVolume) / self.units) * 100.0), candle.bounceShort, candle.bounceLong)
+                   candle.vpinShort, candle.vpinLong, self.imbalance(candle) * 100.0, candle.bounceShort,
+                   candle.bounceLong))
 
     def make_bar(self, tick_seconds, tick_price, tick_dir, tick_volume):
         is_new = 0
@@ -184,34 +370,71 @@ class CHART(object):
             self.create_bar(tick_seconds, tick_price)
             is_new = 1
 
-        # 최종 바 가져오기
-        cur_candle = self.candles[-1]
-
         # 거래량 소진 시 까지 반복
         while tick_volume > 0:
             # 최종 바 가져오기
             cur_candle = self.candles[-1]
 
-            # 거래량 계산
-            if self.units > (cur_candle.totalVolume + tick_volume):
-                cur_volume = tick_volume
-            else:
-                cur_volume = self.units - cur_candle.totalVolume
-
             # 신규 바 생성 조건
             if cur_candle.totalVolume >= self.units:
                 # self.print_bar()
 
                 # 신규 바 생성
                 self.create_bar(tick_seconds, tick_price)
+                cur_candle = self.candles[-1]
                 is_new = 1
 
+            # 거래량 계산 (버킷 경계까지)
+            cur_volume = min(tick_volume, self.units - cur_candle.totalVolume)
+
             # 틱 업데이트
             self.update_bar(tick_seconds, tick_price, tick_dir, cur_volume)
 
             # 거래량 차감
             tick_volume -= cur_volume
 
+        return is_new
+
+
+class TIMECHART(CHART):
+    kind = 'time'
+
+    def __init__(self, symbol="", units=60, long_window=None, short_window=None, bvc=None, archive_dir=None):
+        """ 시간 차트 생성자 (units: 초) """
+
+        super(TIMECHART, self).__init__(symbol, units, long_window, short_window, bvc, archive_dir)
+        self.barSeconds = units
+
+    def make_hist_bar(self, data):
+        """ OHLCV 이력으로 시간 차트 생성, hist_ticks 의 네 틱을 BVC 로 make_bar 에 재생 """
+
+        self.candles.clear()
+        self.history.clear()
+        self.reset_indicators()
+
+        use_bvc = self.useBVC
+        self.useBVC = True
+        for tick_seconds, tick_price, tick_volume in zip(*[column.tolist() for column in hist_ticks(data)]):
+            self.make_bar(tick_seconds, tick_price, 0, tick_volume)
+        self.useBVC = use_bvc
+
+        self.print_bar()
+
+    def imbalance(self, candle):
+        """ 시간 바는 거래량이 일정하지 않으므로 바 거래량으로 정규화 """
+
+        if candle.totalVolume <= 0:
+            return 0.0
+        return (candle.askVolume - candle.bidVolume) / candle.totalVolume
+
+    def make_bar(self, tick_seconds, tick_price, tick_dir, tick_volume):
+        is_new = 0
+
+        # 바가 없거나 시간이 지나면 생성
+        if len(self.candles) <= 0 or tick_seconds >= self.candles[-1].start_time + self.units:
+            self.create_bar(tick_seconds, tick_price)
+            is_new = 1
+
         # 틱 업데이트
         self.update_bar(tick_seconds, tick_price, tick_dir, tick_volume)
 
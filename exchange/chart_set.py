@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from config.settings import settings
+from exchange.chart import CHART, TIMECHART
+
+
+class CHARTSET(object):
+    """
+    Several volume resolutions plus time bars fed from one tick stream.
+
+    The primary chart and the time charts take every tick (CHART.make_bar), the primary one is read on every loop.
+    Every other volume chart only does work at its own bucket boundaries: ticks are appended once to a shared
+    list, and a chart applies the ticks it has not seen yet in one go (CHART.add_ticks, indicators computed once)
+    when the next tick reaches the end of its current bar, or when it is read through get_chart. That tick then
+    goes through the chart's own make_bar. An extra resolution costs a short loop per tick at its next boundary
+    instead of an update_bar per tick.
+
+    Read secondary charts through get_chart (or call flush first); their current bar lags until then.
+    """
+
+    def __init__(self, symbol="", volume_units=None, time_units=None, primary_units=None,
+                 long_window=None, short_window=None, archive_dir=None):
+        self.symbol = symbol
+        primary_units = primary_units or settings.CHART_UNITS
+        volume_units = sorted(set(list(volume_units or settings.CHART_RESOLUTIONS) + [primary_units]))
+        time_units = time_units if time_units is not None else settings.CHART_TIME_UNITS
+
+        self.volume = dict((units, CHART(symbol, units, long_window, short_window, archive_dir=archive_dir))
+                           for units in volume_units)
+        self.time = dict((units, TIMECHART(symbol, units, long_window, short_window, archive_dir=archive_dir))
+                         for units in time_units)
+        self.primary = self.volume[primary_units]
+        self.timeCharts = list(self.time.values())
+
+        self.secondary = [self.volume[units] for units in volume_units if units != primary_units]
+        # (tick_seconds, tick_price, tick_dir, tick_volume, tick_price * tick_volume) not yet applied by every
+        # secondary chart, the index in it up to which each chart applied them, and the volume clock
+        self.ticks = []
+        self.cursors = [0] * len(self.secondary)
+        self.clock = 0
+        # Clock at which each secondary chart's current bar fills, and the first of those
+        self.limits = [0] * len(self.secondary)
+        self.nextLimit = 0
+
+    def get_chart(self, units=None, time=False):
+        if units is None:
+            return self.primary
+        if time:
+            return self.time[units]
+        self.flush()
+        return self.volume[units]
+
+    def flush(self):
+        """ bring every secondary chart up to the last tick """
+
+        for i, chart in enumerate(self.secondary):
+            self.apply(i, chart)
+        del self.ticks[:]
+        self.cursors = [0] * len(self.secondary)
+
+    def close(self):
+        """ write what the candle archives still buffer """
+
+        self.flush()
+        for chart in list(self.volume.values()) + self.timeCharts:
+            chart.close()
+
+    def apply(self, i, chart):
+        cursor = self.cursors[i]
+        if cursor < len(self.ticks):
+            chart.add_ticks(self.ticks[cursor:])
+            self.cursors[i] = len(self.ticks)
+
+    def make_bar(self, tick_seconds, tick_price, tick_dir, tick_volume):
+        """
+        Feed one tick to every chart. Returns the is_new flag of the primary chart.
+        """
+
+        is_new = self.primary.make_bar(tick_seconds, tick_price, tick_dir, tick_volume)
+        for chart in self.timeCharts:
+            chart.make_bar(tick_seconds, tick_price, tick_dir, tick_volume)
+
+        # 0 volume ticks don't update a bar, only make_bar's first bar
+        if not self.secondary or (tick_volume <= 0 and self.nextLimit > 0):
+            return is_new
+
+        clock = self.clock + tick_volume
+        if clock < self.nextLimit:
+            self.ticks.append((tick_seconds, tick_price, tick_dir, tick_volume, tick_price * tick_volume))
+            self.clock = clock
+            return is_new
+
+        # The tick reaches the end of the current bar of at least one secondary chart: those catch up and take it
+        # through make_bar, the others get it appended like any other tick
+        limits = self.limits
+        crossing = False
+        for i, chart in enumerate(self.secondary):
+            if clock >= limits[i]:
+                self.apply(i, chart)
+                chart.make_bar(tick_seconds, tick_price, tick_dir, tick_volume)
+                self.cursors[i] = len(self.ticks) + 1
+                limits[i] = clock + chart.units - chart.candles[-1].totalVolume
+            else:
+                crossing = True
+        if crossing:
+            self.ticks.append((tick_seconds, tick_price, tick_dir, tick_volume, tick_price * tick_volume))
+        self.clock = clock
+        self.nextLimit = min(limits)
+
+        # Drop the ticks every chart applied
+        applied = min(self.cursors)
+        if applied > 0:
+            del self.ticks[:applied]
+            self.cursors = [cursor - applied for cursor in self.cursors]
+        return is_new
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class ColumnStore(object):
+    """
+    Rows kept in contiguous numpy columns, one per (name, dtype) field.
+
+    The columns are a ring of retention + retention / 8 rows, mirrored: a row is written at its slot and at slot
+    + capacity, so the kept rows always lie in one contiguous slice however the ring wraps. When the ring is full
+    the oldest retention / 8 rows are handed to spill (if any) and dropped by moving the head, so appends are O(1)
+    and nothing is copied or reallocated. Queries binary search the monotonic time_field column and return dicts
+    of views. A view keeps its values while its rows are kept, i.e. for at least the next capacity - len(view)
+    appends; readers that hold on to rows longer copy them.
+
+    Rows are numbered from the first row ever appended, so indices stay stable when rows are dropped.
+    """
+
+    def __init__(self, fields, retention, time_field, spill=None):
+        self.fields = fields
+        self.names = [name for name, _ in fields]
+        self.timeField = time_field
+        self.retention = max(1, retention)
+        self.capacity = self.retention + max(1, self.retention // 8)
+        self.spill = spill
+        self.columns = dict((name, np.zeros(2 * self.capacity, dtype=dtype)) for name, dtype in fields)
+        self.size = 0
+        # Slot of the first kept row, and the number of rows dropped (index of the first kept row)
+        self.head = 0
+        self.offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.size = 0
+        self.head = 0
+        self.offset = 0
+
+    def append_row(self, values):
+        """ values in the order of fields """
+
+        if self.size >= self.capacity:
+            self.drop()
+
+        slot = (self.head + self.size) % self.capacity
+        mirror = slot + self.capacity
+        columns = self.columns
+        for name, value in zip(self.names, values):
+            column = columns[name]
+            column[slot] = value
+            column[mirror] = value
+        self.size += 1
+
+    def extend(self, columns):
+        """ append_row of every row of a dict of equal length columns, written a slice per column at a time """
+
+        n = len(columns[self.names[0]])
+        start = 0
+        while start < n:
+            if self.size >= self.capacity:
+                self.drop()
+
+            count = min(n - start, self.capacity - self.size)
+            slot = (self.head + self.size) % self.capacity
+            # Up to the end of the ring, the rest wraps to its start
+            first = min(count, self.capacity - slot)
+            rest = count - first
+            for name in self.names:
+                column = self.columns[name]
+                values = columns[name][start:start + count]
+                column[slot:slot + first] = values[:first]
+                column[slot + self.capacity:slot + self.capacity + first] = values[:first]
+                if rest:
+                    column[:rest] = values[first:]
+                    column[self.capacity:self.capacity + rest] = values[first:]
+            self.size += count
+            start += count
+
+    def drop(self):
+        """ drop the rows beyond the retention, oldest first """
+
+        drop = self.size - self.retention
+        if drop <= 0:
+            return
+
+        if self.spill is not None:
+            self.spill(self.view(0, drop))
+
+        self.head = (self.head + drop) % self.capacity
+        self.size -= drop
+        self.offset += drop
+
+    def set_value(self, index, name, value):
+        """ set a field of the row with index, unless it was dropped already """
+
+        row = index - self.offset
+        if 0 <= row < self.size:
+            slot = (self.head + row) % self.capacity
+            column = self.columns[name]
+            column[slot] = value
+            column[slot + self.capacity] = value
+
+    def view(self, lo, hi):
+        """ rows [lo, hi) of the kept rows """
+
+        head = self.head
+        return dict((name, column[head + lo:head + hi]) for name, column in self.columns.items())
+
+    def times(self):
+        """ time_field of the kept rows """
+
+        return self.columns[self.timeField][self.head:self.head + self.size]
+
+    #
+    # Queries
+    #
+
+    def last(self, n):
+        """ last n rows """
+
+        return self.view(max(0, self.size - n), self.size)
+
+    def between(self, start_time, end_time=None):
+        """ rows with time in [start_time, end_time) """
+
+        times = self.times()
+        lo = np.searchsorted(times, start_time, side='left')
+        hi = self.size if end_time is None else np.searchsorted(times, end_time, side='left')
+        return self.view(lo, max(lo, hi))
+
+    def since(self, start_time):
+        """ rows with time at or after start_time """
+
+        return self.between(start_time)
+
+    def index_at(self, seconds):
+        """ index of the first row with time at or after seconds """
+
+        return self.offset + int(np.searchsorted(self.times(), seconds, side='left'))
+
+    def index_range(self, first, last=None):
+        """ rows with index in [first, last); indices older than the retention are clipped """
+
+        last = self.offset + self.size if last is None else last
+        lo = min(max(first - self.offset, 0), self.size)
+        hi = min(max(last - self.offset, lo), self.size)
+        return self.view(lo, hi)
+
+    def first_index(self):
+        return self.offset
+
+    def next_index(self):
+        """ index the next appended row will get """
+
+        return self.offset + self.size
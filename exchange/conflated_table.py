@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+
+class ConflatedTable(object):
+    """
+    Latest row per symbol of a snapshot style websocket table (quote, orderBook10).
+
+    Every change replaces the row with a new dict, so a row handed to a reader is never modified afterwards,
+    and bumps a sequence number: readers compare the sequence they last saw with sequence_of(symbol) to
+    tell whether anything changed without looking at the row.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.sequences = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(list(self.rows.values()))
+
+    def set(self, row):
+        """ partial / insert: the row is the new snapshot """
+
+        self.sequence += 1
+        symbol = row['symbol']
+        self.rows[symbol] = row
+        self.sequences[symbol] = self.sequence
+
+    def update(self, row):
+        """ update: merge the changed fields into a copy of the current snapshot """
+
+        current = self.rows.get(row['symbol'])
+        if current is not None:
+            merged = dict(current)
+            merged.update(row)
+            row = merged
+        self.set(row)
+
+    def delete(self, row):
+        self.sequence += 1
+        self.rows.pop(row['symbol'], None)
+        self.sequences[row['symbol']] = self.sequence
+
+    def get(self, symbol):
+        return self.rows.get(symbol)
+
+    def sequence_of(self, symbol):
+        """ sequence number of the last change of symbol, 0 if never seen """
+
+        return self.sequences.get(symbol, 0)
+
+    def get_if_changed(self, symbol, since):
+        """ (row, sequence), row None when nothing changed since the sequence since """
+
+        sequence = self.sequences.get(symbol, 0)
+        if sequence <= since:
+            return None, sequence
+        return self.rows.get(symbol), sequence
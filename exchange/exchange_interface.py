@@ -5,6 +5,7 @@ from time import sleep
 from config.settings import settings
 from exchange.bithumb_exchange import BithumbExchange
 from exchange.bitmex_exchange import BitMEXExchange
+from exchange.reference_price import FxRateCache, ReferencePriceFeed
 
 
 class ExchangeInterface:
@@ -13,7 +14,10 @@ class ExchangeInterface:
         self.bithumb_exchange = BithumbExchange(self.logger,
                                                 settings.BITHUMB_BASE_URL,
                                                 settings.BITHUMB_BTC_SYMBOL,
-                                                settings.BITHUMB_API_KEY, settings.BITHUMB_API_SECRET)
+                                                settings.BITHUMB_API_KEY, settings.BITHUMB_API_SECRET,
+                                                settings.BITHUMB_CURL_POOL_SIZE, settings.BITHUMB_API_TIMEOUT,
+                                                settings.BITHUMB_DNS_CACHE_TIMEOUT)
+        self.bithumb_exchange.warm_up()
 
         self.bitmex_exchange = BitMEXExchange(self.logger,
                                               settings.BITMEX_BASE_URL, settings.BITMEX_WSS_URL,
@@ -22,16 +26,57 @@ class ExchangeInterface:
                                               settings.BITMEX_ORDERID_PREFIX, True)
         self.bitmex_exchange.connect_websocket()
 
+        self.reference_feed = ReferencePriceFeed(self.logger, self.bithumb_exchange, self.bitmex_exchange,
+                                                 FxRateCache(self.logger, settings.FX_RATE_URL,
+                                                             settings.FX_KRW_PER_USD, settings.FX_RATE_TTL),
+                                                 settings.REFERENCE_PRICE_INTERVAL, settings.REFERENCE_PRICE_MAX_LEN,
+                                                 settings.REFERENCE_PREMIUM_WINDOW_SIZE)
+        if settings.REFERENCE_PRICE_ENABLED:
+            self.reference_feed.start()
+
     def exit(self):
-        self.bitmex_exchange.ws.exit()
+        self.reference_feed.stop()
+        self.bitmex_exchange.disconnect_websocket()
+        self.bithumb_exchange.exit()
 
     def get_btci(self):
         return self.bithumb_exchange.api_call("/public/btci", {})
 
+    def get_reference_price(self, max_age=None):
+        """
+        Latest Bithumb based fair value sample. Never blocks on HTTP.
+        """
+
+        return self.reference_feed.get_latest(max_age)
+
+    def get_latest_candle(self, units=None, time=False):
+        """
+        Latest candle of the primary chart, or of the volume (or time, in seconds) chart with the given units
+        """
+
+        return self.bitmex_exchange.get_chart(units, time).candles[-1]
+
+    def get_candle_history(self, units=None, time=False):
+        """
+        Completed candles of a chart (exchange.candle_store.CandleHistory), e.g.
+        get_candle_history().since(now - 600)['vpin'] for the windowed VPIN of the last 10 minutes. The columns
+        returned are views, copy them to keep them for long (CandleHistory)
+        """
+
+        return self.bitmex_exchange.get_chart(units, time).history
+
     def get_latest_vpin(self):
         cur_candle = self.bitmex_exchange.chart.candles[-1]
         return cur_candle.vpinShort, cur_candle.bounceShort
 
+    def get_vpin_percentile(self):
+        """
+        Windowed VPIN of the last completed bucket and its percentile (0..1) among past values
+        """
+
+        cur_candle = self.bitmex_exchange.chart.candles[-1]
+        return cur_candle.vpin, cur_candle.vpinCdf
+
     def is_ws_open(self):
         """
         Check that websocket are still open.
@@ -39,6 +84,27 @@ class ExchangeInterface:
 
         return not self.bitmex_exchange.ws.exited
 
+    def is_ws_synced(self):
+        """
+        Websocket connected and its tables rebuilt from fresh partials (False while reconnecting)
+        """
+
+        return self.bitmex_exchange.is_synced()
+
+    def is_feed_fresh(self):
+        """
+        Market data is synced and recent enough to quote on
+        """
+
+        return self.bitmex_exchange.is_feed_fresh()
+
+    def set_feed_stale_callback(self, callback):
+        """
+        callback() runs on a thread of its own as soon as the feed turns stale, never two at once
+        """
+
+        self.bitmex_exchange.stale_callback = callback
+
     def check_market_not_open(self, symbol):
         """
         Check market opened
@@ -91,59 +157,11 @@ class ExchangeInterface:
         sleep(settings.API_REST_INTERVAL)
 
     def get_portfolio(self):
-        contracts = settings.CONTRACTS
-        portfolio = {}
-        for symbol in contracts:
-            position = self.bitmex_exchange.get_ws_position(symbol=symbol)
-            instrument = self.bitmex_exchange.get_ws_instrument(symbol=symbol)
-
-            if instrument['isQuanto']:
-                future_type = "Quanto"
-            elif instrument['isInverse']:
-                future_type = "Inverse"
-            elif not instrument['isQuanto'] and not instrument['isInverse']:
-                future_type = "Linear"
-            else:
-                raise NotImplementedError("Unknown future type; not quanto or inverse: %s" % instrument['symbol'])
-
-            if instrument['underlyingToSettleMultiplier'] is None:
-                multiplier = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
-            else:
-                multiplier = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
-
-            portfolio[symbol] = {
-                "currentQty": float(position['currentQty']),
-                "futureType": future_type,
-                "multiplier": multiplier,
-                "markPrice": float(instrument['markPrice']),
-                "spot": float(instrument['indicativeSettlePrice'])
-            }
-
-        return portfolio
+        return self.bitmex_exchange.portfolio.positions()
 
     def calc_delta(self):
-        """Calculate currency delta for portfolio"""
-        portfolio = self.get_portfolio()
-        spot_delta = 0
-        mark_delta = 0
-        for symbol in portfolio:
-            item = portfolio[symbol]
-            if item['futureType'] == "Quanto":
-                spot_delta += item['currentQty'] * item['multiplier'] * item['spot']
-                mark_delta += item['currentQty'] * item['multiplier'] * item['markPrice']
-            elif item['futureType'] == "Inverse":
-                spot_delta += (item['multiplier'] / item['spot']) * item['currentQty']
-                mark_delta += (item['multiplier'] / item['markPrice']) * item['currentQty']
-            elif item['futureType'] == "Linear":
-                spot_delta += item['multiplier'] * item['currentQty']
-                mark_delta += item['multiplier'] * item['currentQty']
-        basis_delta = mark_delta - spot_delta
-        delta = {
-            "spot": spot_delta,
-            "mark_price": mark_delta,
-            "basis": basis_delta
-        }
-        return delta
+        """Calculate currency delta (and initial / maintenance margin of the positions) for portfolio"""
+        return self.bitmex_exchange.portfolio.delta()
 
     def get_delta(self, symbol):
         return self.get_position(symbol)['currentQty']
@@ -154,11 +172,19 @@ class ExchangeInterface:
     def get_market_depth(self, symbol):
         return self.bitmex_exchange.get_ws_market_depth(symbol)
 
+    def get_market_depth_if_changed(self, symbol, since):
+        return self.bitmex_exchange.get_ws_market_depth_if_changed(symbol, since)
+
     def get_margin(self):
         return self.bitmex_exchange.get_ws_funds()
 
     def get_orders(self):
-        return self.bitmex_exchange.http_open_orders()
+        """
+        Own open orders from the websocket state (BitMEXExchange.get_open_orders), no REST call; cancel_all_orders
+        asks REST
+        """
+
+        return self.bitmex_exchange.get_open_orders()
 
     def get_highest_buy(self):
         buys = [o for o in self.get_orders() if o['side'] == 'Buy']
@@ -180,6 +206,21 @@ class ExchangeInterface:
     def get_ticker(self, symbol):
         return self.bitmex_exchange.get_ws_ticker(symbol)
 
+    def get_fill_analytics(self):
+        """
+        exchange.fill_analytics.FillAnalytics of the own fills (summary(), report(), store)
+        """
+
+        return self.bitmex_exchange.fillAnalytics
+
+    def get_risk_exposure(self):
+        """
+        Position, open buy / sell contracts, cost and margin (XBt) of the open orders seen by the risk engine
+        """
+
+        risk = self.bitmex_exchange.risk
+        return risk.exposure() if risk is not None else None
+
     def amend_bulk_orders(self, orders):
         return self.bitmex_exchange.amend_bulk_orders(orders)
 
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+
+class FeedMerger(object):
+    """
+    Merges the market data of several websocket connections into one stream. Trades are deduplicated by
+    trdMatchID, rows of the other tables (orderBook10, quote) are taken from whichever connection delivers their
+    timestamp first; the copy arriving later on the other connection is dropped.
+    """
+
+    def __init__(self, tables, max_trade_ids=100000):
+        self.tables = set(tables)
+        self.maxTradeIDs = max_trade_ids
+        # trdMatchIDs seen, the oldest forgotten first
+        self.tradeIDs = set()
+        self.tradeOrder = deque()
+        # (table, symbol) -> latest timestamp accepted
+        self.timestamps = {}
+        self.duplicates = 0
+
+    def new_trades(self, trades):
+        """
+        Trades whose trdMatchID no connection delivered yet
+        """
+
+        fresh = []
+        for trade in trades:
+            trade_id = trade.get('trdMatchID')
+            if trade_id is not None:
+                if trade_id in self.tradeIDs:
+                    self.duplicates += 1
+                    continue
+                self.tradeIDs.add(trade_id)
+                self.tradeOrder.append(trade_id)
+                if len(self.tradeOrder) > self.maxTradeIDs:
+                    self.tradeIDs.discard(self.tradeOrder.popleft())
+            fresh.append(trade)
+        return fresh
+
+    def new_rows(self, table, rows):
+        """
+        Rows newer than what any connection delivered for their symbol. BitMEX timestamps are ISO 8601 strings
+        of one format, so they compare as strings.
+        """
+
+        fresh = []
+        for row in rows:
+            timestamp = row.get('timestamp')
+            if timestamp is not None:
+                key = (table, row.get('symbol'))
+                last = self.timestamps.get(key)
+                if last is not None and timestamp <= last:
+                    self.duplicates += 1
+                    continue
+                self.timestamps[key] = timestamp
+            fresh.append(row)
+        return fresh
+
+    def merge(self, message, primary=True):
+        """
+        The message with only the rows not delivered yet, or None to drop it.
+
+        The primary connection carries every table and its partials sync them, so its other messages pass
+        untouched and its partials pass even when every row is a duplicate. Extra connections only carry the
+        merged tables; their partials are merged like inserts.
+        """
+
+        table = message.get('table')
+        action = message.get('action')
+        if table not in self.tables or action not in ('partial', 'insert', 'update'):
+            return message if primary else None
+
+        if table == 'trade':
+            rows = self.new_trades(message['data'])
+            if primary and action == 'partial':
+                # The partial rebuilds the trade table; the trades in it no connection delivered are the missed
+                # ones. Picking them by timestamp would lose trades still on their way over another connection.
+                merged = dict(message)
+                merged['missed'] = rows
+                return merged
+        else:
+            rows = self.new_rows(table, message['data'])
+
+        if not (primary and action == 'partial'):
+            if not rows:
+                return None
+            if action == 'partial':
+                action = 'insert'
+
+        merged = dict(message)
+        merged['action'] = action
+        merged['data'] = rows
+        return merged
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import math
+import numpy as np
+from collections import deque
+from exchange.column_store import ColumnStore
+
+
+def markout_name(horizon):
+    return 'markout%g' % horizon
+
+
+class FillStore(ColumnStore):
+    """
+    Own fills in columns: arrival time, side (+1 buy / -1 sell), price, quantity, fee (XBt, negative for a
+    rebate), the mid and VPIN at the fill and the markout per horizon, side * (mid after horizon - price),
+    which stays nan until the horizon has passed.
+    """
+
+    def __init__(self, horizons, retention=100000, spill=None):
+        fields = [('timestamp', np.float64), ('side', np.int8), ('price', np.float64), ('qty', np.float64),
+                  ('fee', np.float64), ('mid', np.float64), ('vpin', np.float64), ('vpinCdf', np.float64)]
+        fields += [(markout_name(horizon), np.float64) for horizon in horizons]
+        super(FillStore, self).__init__(fields, retention, 'timestamp', spill)
+
+
+class FillAnalytics(object):
+    """
+    Incremental fill quality, per VPIN bucket (percentile of the VPIN at the fill, vpinCdf, in equal width
+    buckets), all quantity weighted and in price units per contract. Fills without a VPIN yet (nan vpinCdf,
+    before the first completed bucket) go to a bucket of their own, outside the VPIN buckets:
+
+        edge       side * (mid - price) at the fill, the half spread captured
+        markout    side * (mid after horizon - price), the realized spread at that horizon
+        adverse    side * (mid after horizon - mid), the adverse selection; markout = edge + adverse
+
+    A fill costs O(1) plus one queue entry per horizon; on_mid resolves the entries that are due with the first
+    mid at or after their horizon, so every fill is resolved once per horizon. Fees and rebates are summed in XBt.
+    """
+
+    def __init__(self, horizons=(1, 10, 60), vpin_buckets=5, retention=100000):
+        self.horizons = list(horizons)
+        self.buckets = vpin_buckets
+        self.store = FillStore(self.horizons, retention)
+        self.names = [markout_name(horizon) for horizon in self.horizons]
+        self.pending = [deque() for _ in self.horizons]
+        self.mid = None
+
+        # The last row is the bucket of the fills without a VPIN
+        n, h = self.buckets + 1, len(self.horizons)
+        self.fills = np.zeros(n, dtype=np.int64)
+        self.qty = np.zeros(n)
+        # Quantity with a mid at the fill, and its edge
+        self.edgeQty = np.zeros(n)
+        self.edge = np.zeros(n)
+        # Resolved quantity, markout and adverse selection per bucket and horizon
+        self.markoutQty = np.zeros((n, h))
+        self.markout = np.zeros((n, h))
+        self.adverseQty = np.zeros((n, h))
+        self.adverse = np.zeros((n, h))
+        self.feesPaid = 0.0
+        self.rebates = 0.0
+
+    def bucket_of(self, vpin_cdf):
+        if vpin_cdf is None or math.isnan(vpin_cdf):
+            return self.buckets
+        return min(max(int(vpin_cdf * self.buckets), 0), self.buckets - 1)
+
+    def on_fill(self, now, side, price, qty, fee, vpin, vpin_cdf):
+        mid = self.mid
+        index = self.store.next_index()
+        self.store.append_row([now, side, price, qty, fee, mid if mid is not None else np.nan, vpin, vpin_cdf] +
+                              [np.nan] * len(self.horizons))
+
+        bucket = self.bucket_of(vpin_cdf)
+        self.fills[bucket] += 1
+        self.qty[bucket] += qty
+        if mid is not None:
+            self.edgeQty[bucket] += qty
+            self.edge[bucket] += qty * side * (mid - price)
+        if fee >= 0:
+            self.feesPaid += fee
+        else:
+            self.rebates -= fee
+
+        for horizon, queue in zip(self.horizons, self.pending):
+            queue.append((now + horizon, index, side, price, qty, mid, bucket))
+
+    def on_mid(self, now, mid):
+        self.mid = mid
+        for k, queue in enumerate(self.pending):
+            while queue and queue[0][0] <= now:
+                _, index, side, price, qty, fill_mid, bucket = queue.popleft()
+                markout = side * (mid - price)
+                self.store.set_value(index, self.names[k], markout)
+                self.markoutQty[bucket, k] += qty
+                self.markout[bucket, k] += qty * markout
+                if fill_mid is not None:
+                    self.adverseQty[bucket, k] += qty
+                    self.adverse[bucket, k] += qty * side * (mid - fill_mid)
+
+    def summary(self):
+        """
+        Per VPIN bucket (vpinCdf range, fills, quantity, edge, markout and adverse selection per horizon), the
+        same for the fills without a VPIN (noVPIN) and totals over all fills, per contract averages nan where
+        nothing was resolved yet
+        """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            edge = self.edge / self.edgeQty
+            markout = self.markout / self.markoutQty
+            adverse = self.adverse / self.adverseQty
+            total_markout = self.markout.sum(axis=0) / self.markoutQty.sum(axis=0)
+            total_adverse = self.adverse.sum(axis=0) / self.adverseQty.sum(axis=0)
+            total_edge = self.edge.sum() / self.edgeQty.sum()
+
+        def bucket(b, vpin_cdf):
+            return {'vpinCdf': vpin_cdf, 'fills': int(self.fills[b]), 'qty': float(self.qty[b]), 'edge': float(edge[b]),
+                    'markout': dict(zip(self.horizons, markout[b].tolist())),
+                    'adverse': dict(zip(self.horizons, adverse[b].tolist()))}
+
+        buckets = [bucket(b, (float(b) / self.buckets, float(b + 1) / self.buckets)) for b in range(self.buckets)]
+        return {'buckets': buckets, 'noVPIN': bucket(self.buckets, None),
+                'fills': int(self.fills.sum()), 'qty': float(self.qty.sum()),
+                'edge': float(total_edge),
+                'markout': dict(zip(self.horizons, total_markout.tolist())),
+                'adverse': dict(zip(self.horizons, total_adverse.tolist())),
+                'feesPaid': self.feesPaid, 'rebates': self.rebates}
+
+    def report(self):
+        """ summary as log lines """
+
+        summary = self.summary()
+        horizons = ' '.join('%6gs' % horizon for horizon in self.horizons)
+        lines = ["Fill quality: %d fills, %d contracts, fees %d XBt, rebates %d XBt" %
+                 (summary['fills'], summary['qty'], summary['feesPaid'], summary['rebates']),
+                 "VPIN cdf     fills    edge | markout %s | adverse %s" % (horizons, horizons)]
+        rows = [('%.2f-%.2f' % bucket['vpinCdf'], bucket) for bucket in summary['buckets']]
+        rows += [('no VPIN', summary['noVPIN']), ('all', summary)]
+        for name, bucket in rows:
+            lines.append("%-9s %8d %7.2f | %s | %s" %
+                         (name, bucket['fills'], bucket['edge'],
+                          ' '.join('%7.2f' % bucket['markout'][h] for h in self.horizons),
+                          ' '.join('%7.2f' % bucket['adverse'][h] for h in self.horizons)))
+        return lines
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class Portfolio(object):
+    """
+    Positions and prices of a list of contracts in numpy arrays, updated from the instrument and position
+    websocket events, so the delta of the whole portfolio is one vectorized expression.
+
+    The contract constants (multiplier per underlying, Quanto / Inverse / Linear) are set when an instrument row
+    carries them, i.e. once per partial. Delta in the underlying (XBT) per contract:
+
+        Quanto   qty * multiplier * price
+        Inverse  multiplier / price * qty
+        Linear   multiplier * qty
+
+    computed for the spot (indicativeSettlePrice) and mark price rows of one 2 x n price array.
+    """
+
+    SPOT = 0
+    MARK = 1
+
+    def __init__(self, contracts):
+        self.contracts = list(contracts)
+        self.index = dict((symbol, i) for i, symbol in enumerate(self.contracts))
+        n = len(self.contracts)
+
+        self.multiplier = np.full(n, np.nan)
+        self.quanto = np.zeros(n, dtype=bool)
+        self.inverse = np.zeros(n, dtype=bool)
+        self.initMargin = np.zeros(n)
+        self.maintMargin = np.zeros(n)
+
+        self.qty = np.zeros(n)
+        self.prices = np.full((2, n), np.nan)
+
+    def on_instrument(self, rows):
+        for row in rows:
+            i = self.index.get(row.get('symbol'))
+            if i is None:
+                continue
+            if 'multiplier' in row:
+                self.set_contract(i, row)
+            if row.get('indicativeSettlePrice') is not None:
+                self.prices[self.SPOT, i] = row['indicativeSettlePrice']
+            if row.get('markPrice') is not None:
+                self.prices[self.MARK, i] = row['markPrice']
+            if row.get('initMargin') is not None:
+                self.initMargin[i] = row['initMargin']
+            if row.get('maintMargin') is not None:
+                self.maintMargin[i] = row['maintMargin']
+
+    def set_contract(self, i, instrument):
+        if instrument.get('underlyingToSettleMultiplier') is None:
+            self.multiplier[i] = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
+        else:
+            self.multiplier[i] = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
+        self.quanto[i] = bool(instrument.get('isQuanto'))
+        self.inverse[i] = bool(instrument.get('isInverse')) and not self.quanto[i]
+
+    def on_position(self, rows):
+        for row in rows:
+            i = self.index.get(row.get('symbol'))
+            if i is not None and row.get('currentQty') is not None:
+                self.qty[i] = row['currentQty']
+
+    def contract_deltas(self):
+        """
+        2 x n array of the spot and mark delta per contract; contracts without a position count zero even when
+        their prices did not arrive yet
+        """
+
+        prices = self.prices
+        deltas = np.where(self.quanto, self.qty * self.multiplier * prices,
+                          self.multiplier / np.where(self.inverse, prices, 1.0) * self.qty)
+        return np.where(self.qty != 0, deltas, 0.0)
+
+    def delta(self):
+        deltas = self.contract_deltas()
+        spot, mark = deltas.sum(axis=1)
+        exposure = np.abs(deltas[self.MARK])
+        return {
+            "spot": float(spot),
+            "mark_price": float(mark),
+            "basis": float(mark - spot),
+            "init_margin": float(np.dot(exposure, self.initMargin)),
+            "maint_margin": float(np.dot(exposure, self.maintMargin)),
+        }
+
+    def positions(self):
+        """ per contract dict like ExchangeInterface.get_portfolio used to build """
+
+        types = np.where(self.quanto, "Quanto", np.where(self.inverse, "Inverse", "Linear"))
+        return dict((symbol, {"currentQty": float(self.qty[i]), "futureType": str(types[i]),
+                              "multiplier": float(self.multiplier[i]),
+                              "markPrice": float(self.prices[self.MARK, i]),
+                              "spot": float(self.prices[self.SPOT, i])})
+                    for i, symbol in enumerate(self.contracts))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import requests
+from collections import deque, namedtuple
+
+
+# One sample of the cross exchange reference price.
+# premium is the smoothed Bithumb premium over BitMEX.
+# bucket_time is the start_time of the BitMEX CHART bucket that was open when the sample was taken.
+ReferencePrice = namedtuple('ReferencePrice', ['time', 'bucket_time', 'krw_price', 'usd_price', 'bitmex_mid',
+                                               'premium', 'fair_value'])
+
+
+class FxRateCache(object):
+    """
+    KRW per USD rate, refreshed at most once per ttl seconds.
+    """
+
+    def __init__(self, logger, url=None, default_rate=1170.0, ttl=600):
+        self.logger = logger
+        self.url = url
+        self.rate = float(default_rate)
+        self.ttl = ttl
+        self.updated = 0.0
+
+    def refresh(self):
+        """
+        Fetch the rate if the cached one is stale. Keeps the last known rate on failure.
+        """
+
+        if not self.url or time.time() - self.updated < self.ttl:
+            return self.rate
+
+        try:
+            response = requests.get(self.url, timeout=3)
+            response.raise_for_status()
+            self.rate = float(response.json()['rates']['KRW'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            self.logger.warning("Unable to refresh KRW/USD rate, keeping %.2f: %s" % (self.rate, e))
+        self.updated = time.time()
+
+        return self.rate
+
+
+class ReferencePriceFeed(object):
+    """
+    Polls Bithumb in a background thread and keeps a fair value series for the BitMEX symbol.
+
+    The Bithumb KRW price is converted to USD, and the premium over the BitMEX mid is smoothed with an EMA.
+    The fair value is the Bithumb USD price with that premium removed, so it leads BitMEX when Bithumb moves first.
+    """
+
+    def __init__(self, logger, bithumb_exchange, bitmex_exchange, fx_rate, interval=0.5, max_len=7200,
+                 premium_window_size=120):
+        self.logger = logger
+        self.bithumb_exchange = bithumb_exchange
+        self.bitmex_exchange = bitmex_exchange
+        self.fx_rate = fx_rate
+        self.interval = interval
+        self.premiumAlpha = 2.0 / (premium_window_size + 1.0)
+
+        self.series = deque(maxlen=max_len)
+        self.latest = None
+        self.premium = None
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='reference-price')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + self.bithumb_exchange.pool.timeout)
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.warning("Reference price poll failed: %s" % e)
+            self.stopped.wait(max(0.0, self.interval - (time.time() - started)))
+
+    def poll(self):
+        """
+        Take one reference price sample
+        """
+
+        rate = self.fx_rate.refresh()
+        ticker = self.bithumb_exchange.api_call("/public/ticker/" + self.bithumb_exchange.symbol, {})
+        if ticker.get('status') != '0000':
+            return None
+
+        krw_price = float(ticker['data']['closing_price'])
+        usd_price = krw_price / rate
+
+        bitmex_mid = self.get_bitmex_mid()
+        if bitmex_mid:
+            premium = usd_price / bitmex_mid - 1.0
+            if self.premium is None:
+                self.premium = premium
+            else:
+                self.premium = (1 - self.premiumAlpha) * self.premium + self.premiumAlpha * premium
+
+        fair_value = usd_price / (1.0 + self.premium) if self.premium is not None else None
+
+        candles = self.bitmex_exchange.chart.candles
+        bucket_time = candles[-1].start_time if len(candles) > 0 else None
+
+        sample = ReferencePrice(time.time(), bucket_time, krw_price, usd_price, bitmex_mid, self.premium,
+                                 fair_value)
+        self.series.append(sample)
+        self.latest = sample
+
+        return sample
+
+    def get_bitmex_mid(self):
+        try:
+            return self.bitmex_exchange.get_ws_ticker(self.bitmex_exchange.symbol)['mid']
+        except Exception:
+            return None
+
+    def get_latest(self, max_age=None):
+        """
+        Latest sample, or None if there is none or it is older than max_age seconds
+        """
+
+        sample = self.latest
+        if sample is None or (max_age is not None and time.time() - sample.time > max_age):
+            return None
+        return sample
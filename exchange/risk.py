@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+from config.settings import settings
+from utils.errors import RiskLimitError
+
+BUY = 1
+SELL = -1
+TERMINAL_STATUSES = ('Filled', 'Canceled', 'Rejected')
+
+
+class RiskEngine(object):
+    """
+    Pre-trade gate for outgoing order batches of one symbol.
+
+    Position, open buy / sell contracts and the cost of the open orders are kept up to date from the
+    order and execution events of the websocket, so a batch is checked in O(1) per order without REST calls:
+
+        - worst case position (position plus every open order on that side filled) within
+          [min_position, max_position]
+        - cost of the open orders within max_open_notional (XBt)
+        - price within price_band (fraction) of the mid
+
+    Orders that pass are reserved right away, before the exchange confirms them, so batches sent back to back
+    see each other. A failed request releases them again.
+    """
+
+    def __init__(self, min_position, max_position, max_open_notional, price_band, check_position=True):
+        self.minPosition = min_position
+        self.maxPosition = max_position
+        self.maxOpenNotional = max_open_notional
+        self.priceBand = price_band
+        self.checkPosition = check_position
+
+        # Instrument: XBt per contract is multiplier * price (linear) or multiplier / price (inverse)
+        self.multiplier = None
+        self.initMargin = 0.0
+
+        self.position = 0
+        # key -> (side, leavesQty, price, cumQty); orders are keyed by clOrdID, orderID resolves to it and back
+        self.orders = {}
+        self.orderKeys = {}
+        self.orderIDs = {}
+        self.openBuy = 0
+        self.openSell = 0
+        self.openCost = 0.0
+
+    #
+    # Events
+    #
+
+    def on_instrument(self, rows):
+        for row in rows:
+            if 'multiplier' in row:
+                self.multiplier = float(row['multiplier'])
+            if 'initMargin' in row:
+                self.initMargin = float(row['initMargin'])
+
+    def on_position(self, rows):
+        """ partial only: the baseline executions are applied to """
+
+        for row in rows:
+            if 'currentQty' in row:
+                self.position = row['currentQty']
+
+    def on_execution(self, rows):
+        for row in rows:
+            if row.get('execType') == 'Trade' and row.get('lastQty'):
+                self.position += row['lastQty'] if row['side'] == 'Buy' else -row['lastQty']
+
+    def on_order(self, rows, partial=False):
+        if partial:
+            self.reset_orders()
+
+        for row in rows:
+            key = self.order_key(row)
+            if key is None:
+                continue
+            side, leaves, price, cum = self.orders.get(key, (None, 0, 0.0, 0))
+            if 'side' in row:
+                side = BUY if row['side'] == 'Buy' else SELL
+            leaves = row.get('leavesQty', leaves)
+            price = row.get('price', price) or price
+            cum = row.get('cumQty', cum)
+            if row.get('ordStatus') in TERMINAL_STATUSES:
+                leaves = 0
+            self.set_order(key, side, leaves, price, cum)
+
+    def order_key(self, row):
+        """ clOrdID of the order (orderID for orders of other clients), linking the two on first sight """
+
+        order_id = row.get('orderID')
+        key = row.get('clOrdID') or self.orderKeys.get(order_id) or order_id
+        if order_id is not None and key is not None:
+            self.orderKeys[order_id] = key
+            self.orderIDs[key] = order_id
+        return key
+
+    def reset_orders(self):
+        self.orders = {}
+        self.orderKeys = {}
+        self.orderIDs = {}
+        self.openBuy = 0
+        self.openSell = 0
+        self.openCost = 0.0
+
+    def set_order(self, key, side, leaves, price, cum=0):
+        """ replace the exposure of an order, dropping it once nothing is left """
+
+        old = self.orders.pop(key, None)
+        if old is not None:
+            self.add_exposure(old[0], -old[1], old[2])
+        if side is not None and leaves > 0:
+            self.orders[key] = (side, leaves, price, cum)
+            self.add_exposure(side, leaves, price)
+        elif not self.orders:
+            # no rounding residue once nothing is open
+            self.openCost = 0.0
+        return old
+
+    def add_exposure(self, side, qty, price):
+        if side == BUY:
+            self.openBuy += qty
+        else:
+            self.openSell += qty
+        cost = self.cost(qty, price)
+        self.openCost += cost if qty > 0 else -cost
+
+    #
+    # Checks
+    #
+
+    def cost(self, quantity, price):
+        """ XBt value of quantity contracts at price (TradeManager.cost without the instrument lookup) """
+
+        if self.multiplier is None or not price:
+            return 0.0
+        p = self.multiplier * price if self.multiplier >= 0 else self.multiplier / price
+        return abs(quantity * p)
+
+    def margin(self):
+        """ initial margin of the open orders in XBt """
+
+        return self.openCost * self.initMargin
+
+    def check_orders(self, orders, mid, amend=False):
+        """
+        Reserve the exposure of a batch of new (clOrdID, side, orderQty, price) or amended (orderID, orderQty or
+        leavesQty, price) orders. Raises RiskLimitError, reserving nothing, if any order breaks a limit.
+        Returns the previous state of the orders, for release.
+        """
+
+        applied = []
+        try:
+            for order in orders:
+                key = self.order_key(order) if amend else order['clOrdID']
+                if amend and key not in self.orders:
+                    raise RiskLimitError("Amending unknown order %s" % order.get('orderID'))
+
+                side, leaves, price, cum = self.orders.get(key, (None, 0, 0.0, 0))
+                if not amend:
+                    side = BUY if order.get('side', 'Buy' if order['orderQty'] > 0 else 'Sell') == 'Buy' else SELL
+                    leaves = abs(order['orderQty'])
+                elif 'leavesQty' in order:
+                    leaves = order['leavesQty']
+                elif 'orderQty' in order:
+                    leaves = abs(order['orderQty']) - cum
+                price = order.get('price', price)
+
+                self.check_order(side, leaves, price, mid, self.orders.get(key))
+                applied.append((key, self.set_order(key, side, leaves, price, cum)))
+        except RiskLimitError:
+            self.release(applied)
+            raise
+        return applied
+
+    def check_order(self, side, leaves, price, mid, old=None):
+        if mid and abs(price - mid) > mid * self.priceBand:
+            raise RiskLimitError("Price %.2f is more than %.2f%% away from the mid %.2f" %
+                                 (price, self.priceBand * 100.0, mid))
+
+        # Exposure without the order being replaced
+        open_buy, open_sell, open_cost = self.openBuy, self.openSell, self.openCost
+        if old is not None:
+            open_buy -= old[1] if old[0] == BUY else 0
+            open_sell -= old[1] if old[0] == SELL else 0
+            open_cost -= self.cost(old[1], old[2])
+
+        if self.checkPosition:
+            if side == BUY and self.position + open_buy + leaves > self.maxPosition:
+                raise RiskLimitError("Buying %d would allow a position of %d, above %d" %
+                                     (leaves, self.position + open_buy + leaves, self.maxPosition))
+            if side == SELL and self.position - open_sell - leaves < self.minPosition:
+                raise RiskLimitError("Selling %d would allow a position of %d, below %d" %
+                                     (leaves, self.position - open_sell - leaves, self.minPosition))
+
+        cost = open_cost + self.cost(leaves, price)
+        if cost > self.maxOpenNotional:
+            raise RiskLimitError("Open orders of %.4f XBT would exceed %.4f XBT" %
+                                 (cost / settings.XBt_TO_XBT, self.maxOpenNotional / settings.XBt_TO_XBT))
+
+    def release(self, applied):
+        """ undo the reservations of check_orders after a failed request """
+
+        for key, old in reversed(applied):
+            if old is None:
+                self.set_order(key, None, 0, 0.0)
+            else:
+                self.set_order(key, *old)
+
+    def open_orders(self, prefix=''):
+        """
+        Open orders with a clOrdID starting with prefix as order table rows, reservations included; orders the
+        exchange did not give an orderID yet are left out
+        """
+
+        rows = []
+        for key, (side, leaves, price, cum) in self.orders.items():
+            order_id = self.orderIDs.get(key)
+            if order_id is None or not str(key).startswith(prefix):
+                continue
+            rows.append({'orderID': order_id, 'clOrdID': key, 'side': 'Buy' if side == BUY else 'Sell',
+                         'price': price, 'leavesQty': leaves, 'cumQty': cum, 'orderQty': cum + leaves})
+        return rows
+
+    def exposure(self):
+        return {'position': self.position, 'openBuy': self.openBuy, 'openSell': self.openSell,
+                'openCost': self.openCost, 'margin': self.margin()}
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Tables per profile. 'symbol' tables are filtered on the traded symbol, 'contracts' tables on every symbol
+# of settings.CONTRACTS (and the traded one), 'global' tables are not filterable; 'private' ones need auth.
+PROFILES = {
+    # Market making: trades feed the charts, orderBook10 the liquidity check, instrument the ticker,
+    # tick size and portfolio delta. Quotes are never read.
+    'market_maker': {
+        'symbol': ['trade', 'orderBook10'],
+        'contracts': ['instrument'],
+        'private_symbol': ['order', 'execution'],
+        'private_global': ['margin', 'position'],
+    },
+    # Charts and reference price only
+    'market_data': {
+        'symbol': ['trade'],
+        'contracts': ['instrument'],
+    },
+    # Everything the bot used to subscribe to, with instrument filtered to the contracts
+    'full': {
+        'symbol': ['quote', 'trade', 'orderBook10'],
+        'contracts': ['instrument'],
+        'private_symbol': ['order', 'execution'],
+        'private_global': ['margin', 'position'],
+    },
+}
+
+
+class SubscriptionProfile(object):
+    """
+    Minimal websocket topic set of a profile for one traded symbol and a list of contracts, optionally
+    restricted to some tables.
+    """
+
+    def __init__(self, name, symbol, contracts=None, tables=None):
+        if name not in PROFILES:
+            raise ValueError("Unknown subscription profile %s, expected one of %s" % (name, sorted(PROFILES)))
+        self.name = name
+        self.symbol = symbol
+        self.contracts = []
+        for contract in [symbol] + list(contracts or []):
+            if contract not in self.contracts:
+                self.contracts.append(contract)
+        self.profile = PROFILES[name]
+        if tables is not None:
+            self.profile = dict((kind, [table for table in kind_tables if table in tables])
+                                for kind, kind_tables in self.profile.items())
+
+    def public_topics(self):
+        topics = [table + ':' + self.symbol for table in self.profile.get('symbol', [])]
+        topics += [table + ':' + contract for table in self.profile.get('contracts', []) for contract in self.contracts]
+        topics += list(self.profile.get('global', []))
+        return topics
+
+    def private_topics(self):
+        topics = [table + ':' + self.symbol for table in self.profile.get('private_symbol', [])]
+        topics += list(self.profile.get('private_global', []))
+        return topics
+
+    def topics(self, auth=True):
+        return self.public_topics() + (self.private_topics() if auth else [])
+
+    def public_tables(self):
+        """ tables whose partial has to arrive before market data is usable """
+
+        return set(topic_table(topic) for topic in self.public_topics())
+
+    def private_tables(self):
+        return set(topic_table(topic) for topic in self.private_topics())
+
+    def tables(self, auth=True):
+        return set(topic_table(topic) for topic in self.topics(auth))
+
+
+def topic_table(topic):
+    return topic.split(':', 1)[0]
+
+
+def topic_symbol(topic):
+    parts = topic.split(':', 1)
+    return parts[1] if len(parts) > 1 else None
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import numpy as np
+from datetime import datetime
+from exchange.column_store import ColumnStore
+
+# Recorded trades. side is the aggressor: 1 = Buy, -1 = Sell, 0 = unknown.
+TICK_DTYPE = np.dtype([('timestamp', 'f8'), ('price', 'f8'), ('size', 'f8'), ('side', 'i1')])
+TICK_FIELDS = [(name, TICK_DTYPE[name]) for name in TICK_DTYPE.names]
+
+
+def parse_timestamp(timestamp):
+    """
+    BitMEX ISO timestamp ('2019-11-19T02:05:43.843Z') to epoch seconds
+    """
+
+    parsed = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+
+
+class TickStore(ColumnStore):
+    """
+    Recent trades of one symbol in timestamp / price / size / side columns (the TICK_DTYPE layout of recorded
+    data), queried by exchange timestamp. to_ticks() gives an array save_ticks and the Backtester accept.
+    """
+
+    def __init__(self, retention=1000000, spill=None):
+        super(TickStore, self).__init__(TICK_FIELDS, retention, 'timestamp', spill)
+
+    def append_trade(self, trade):
+        """ BitMEX trade table row """
+
+        self.append_row((parse_timestamp(trade['timestamp']), trade['price'], trade['size'],
+                         1 if trade['side'] == 'Buy' else -1))
+
+    def to_ticks(self, columns=None):
+        columns = self.view(0, self.size) if columns is None else columns
+        ticks = np.empty(len(columns['timestamp']), dtype=TICK_DTYPE)
+        for name in TICK_DTYPE.names:
+            ticks[name] = columns[name]
+        return ticks
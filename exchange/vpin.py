@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+
+class RollingVPIN(object):
+    """
+    Classic VPIN over the last window completed buckets:
+
+        VPIN = sum(|V_buy - V_sell|) / sum(V)
+
+    which is mean(|V_buy - V_sell|) / V for equally sized volume buckets. Running sums make an update O(1);
+    they are rebuilt from the window every window updates so float error does not accumulate.
+    """
+
+    def __init__(self, window=50):
+        self.window = window
+        self.buckets = deque()
+        self.imbalanceSum = 0.0
+        self.volumeSum = 0.0
+        self.updates = 0
+
+    def add(self, buy_volume, sell_volume):
+        imbalance = abs(buy_volume - sell_volume)
+        volume = buy_volume + sell_volume
+        self.buckets.append((imbalance, volume))
+        self.imbalanceSum += imbalance
+        self.volumeSum += volume
+
+        if len(self.buckets) > self.window:
+            old_imbalance, old_volume = self.buckets.popleft()
+            self.imbalanceSum -= old_imbalance
+            self.volumeSum -= old_volume
+
+        self.updates += 1
+        if self.updates % self.window == 0:
+            self.imbalanceSum = sum(b[0] for b in self.buckets)
+            self.volumeSum = sum(b[1] for b in self.buckets)
+
+        return self.value()
+
+    def value(self):
+        if self.volumeSum <= 0:
+            return 0.0
+        return self.imbalanceSum / self.volumeSum
+
+
+class VPINDistribution(object):
+    """
+    Streaming CDF of VPIN values in [0, 1].
+
+    Values are counted in bins equal width bins held in a Fenwick tree, so add() and cdf() are O(log bins) and
+    independent of the history length. With window > 0 only the last window values are kept.
+    """
+
+    def __init__(self, bins=1000, window=0):
+        self.bins = bins
+        self.window = window
+        self.tree = [0] * (bins + 1)
+        self.counts = [0] * bins
+        self.total = 0
+        self.history = deque()
+
+    def bin_of(self, value):
+        index = int(value * self.bins)
+        return min(max(index, 0), self.bins - 1)
+
+    def update(self, index, delta):
+        self.counts[index] += delta
+        self.total += delta
+        i = index + 1
+        while i <= self.bins:
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_below(self, index):
+        """ number of values in bins [0, index) """
+
+        count = 0
+        i = index
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+    def add(self, value):
+        index = self.bin_of(value)
+        self.update(index, 1)
+        if self.window > 0:
+            self.history.append(index)
+            if len(self.history) > self.window:
+                self.update(self.history.popleft(), -1)
+
+    def cdf(self, value):
+        """
+        Fraction of values <= value, interpolated linearly inside the bin
+        """
+
+        if self.total <= 0:
+            return 0.0
+        index = self.bin_of(value)
+        fraction = min(max(value * self.bins - index, 0.0), 1.0)
+        return (self.count_below(index) + fraction * self.counts[index]) / float(self.total)
+
+    def quantile(self, q):
+        """
+        Smallest bin edge below which at least q of the values lie
+        """
+
+        if self.total <= 0:
+            return 0.0
+        target = q * self.total
+        # Fenwick descent
+        position = 0
+        remaining = target
+        step = 1 << (self.bins.bit_length() - 1)
+        while step > 0:
+            if position + step <= self.bins and self.tree[position + step] < remaining:
+                position += step
+                remaining -= self.tree[position]
+            step >>= 1
+        return min(position + 1, self.bins) / float(self.bins)
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event driven backtest of the TradeManager loop.
+
+    python -m simulation.backtest ticks.npy [--books books.npy] [--units 1000000] [--loop-interval 5]
+"""
+
+import time
+import logging
+import argparse
+import itertools
+import numpy as np
+from config.settings import settings
+from exchange.chart import CHART
+from exchange.fill_analytics import FillAnalytics
+from exchange.risk import RiskEngine
+from simulation.data import load_ticks, load_books
+from simulation.matching import BUY, SELL, SimulatedMatchingEngine, SimulatedAccount
+from trade_manager import TradeManager
+from utils.math import tickLog
+
+
+class SimulatedExchangeInterface(object):
+    """
+    Stands in for ExchangeInterface. Market data is pushed in with on_trade/on_book by the Backtester,
+    orders go to a SimulatedMatchingEngine. Only the inverse XBTUSD style contract is modelled.
+    """
+
+    def __init__(self, logger, symbol=None, units=None, tick_size=0.5, balance=1.0, order_latency=None,
+                 cancel_latency=None, maker_fee=None, default_queue=None, chart=None):
+        self.logger = logger
+        self.symbol = symbol or settings.BITMEX_BTC_SYMBOL
+        self.tick_size = tick_size
+        self.default_queue = settings.SIM_DEFAULT_QUEUE if default_queue is None else default_queue
+        self.engine = SimulatedMatchingEngine(
+            settings.SIM_ORDER_LATENCY if order_latency is None else order_latency,
+            settings.SIM_CANCEL_LATENCY if cancel_latency is None else cancel_latency,
+            settings.SIM_MAKER_FEE if maker_fee is None else maker_fee,
+            self.default_queue)
+        self.account = SimulatedAccount(balance)
+        self.chart = chart if chart is not None else CHART(self.symbol, units or settings.CHART_UNITS)
+        self.lastPrice = None
+        self.bookSequence = 0
+        self.orderIDs = itertools.count()
+
+        self.risk = None
+        if settings.RISK_ENABLED:
+            self.risk = RiskEngine(settings.MIN_POSITION, settings.MAX_POSITION,
+                                   settings.RISK_MAX_OPEN_NOTIONAL * settings.XBt_TO_XBT, settings.RISK_PRICE_BAND,
+                                   settings.CHECK_POSITION_LIMITS)
+            self.risk.on_instrument([{'multiplier': -settings.XBt_TO_XBT, 'initMargin': 0.01}])
+
+        self.ordersSubmitted = 0
+        self.ordersAmended = 0
+        self.ordersCanceled = 0
+        self.fills = []
+        self.fillAnalytics = FillAnalytics(settings.FILL_MARKOUT_HORIZONS, settings.FILL_VPIN_BUCKETS,
+                                           settings.FILL_STORE_RETENTION)
+
+    #
+    # Market data
+    #
+
+    def on_trade(self, now, price, size, side):
+        self.engine.on_trade(now, price, size, side)
+        if self.engine.fills:
+            vpin, vpin_cdf = self.chart.latest_vpin()
+            for fill in self.engine.drain_fills():
+                self.account.apply(fill)
+                self.fills.append(fill)
+                self.fillAnalytics.on_fill(now, fill.side, fill.price, fill.qty, fill.fee * settings.XBt_TO_XBT,
+                                           vpin, vpin_cdf)
+        self.chart.make_bar(now, price, side, size)
+        self.lastPrice = price
+        if self.engine.book is None:
+            self.bookSequence += 1
+        self.fillAnalytics.on_mid(now, self.mark_price())
+
+    def on_book(self, now, book):
+        self.engine.on_book(now, book)
+        self.bookSequence += 1
+
+    #
+    # ExchangeInterface
+    #
+
+    def exit(self):
+        pass
+
+    def is_ws_open(self):
+        return True
+
+    def is_ws_synced(self):
+        return True
+
+    def is_feed_fresh(self):
+        return True
+
+    def set_feed_stale_callback(self, callback):
+        pass
+
+    def check_market_not_open(self, symbol):
+        return False
+
+    def check_if_orderbook_empty(self, symbol):
+        return self.engine.bestBid is None or self.engine.bestAsk is None
+
+    def get_latest_candle(self):
+        return self.chart.candles[-1]
+
+    def get_candle_history(self, units=None, time=False):
+        return self.chart.history
+
+    def get_latest_vpin(self):
+        cur_candle = self.chart.candles[-1]
+        return cur_candle.vpinShort, cur_candle.bounceShort
+
+    def get_vpin_percentile(self):
+        cur_candle = self.chart.candles[-1]
+        return cur_candle.vpin, cur_candle.vpinCdf
+
+    def get_reference_price(self, max_age=None):
+        return None
+
+    def get_instrument(self, symbol):
+        ticker = self.get_ticker(symbol)
+        return {'symbol': self.symbol, 'state': 'Open', 'tickSize': self.tick_size,
+                'tickLog': tickLog(self.tick_size),
+                'multiplier': -settings.XBt_TO_XBT, 'initMargin': 0.01, 'maintMargin': 0.005,
+                'isQuanto': False, 'isInverse': True, 'midPrice': ticker['mid'] or None,
+                'bidPrice': ticker['buy'], 'askPrice': ticker['sell'], 'lastPrice': ticker['last'],
+                'markPrice': ticker['mid']}
+
+    def get_ticker(self, symbol):
+        bid = self.engine.bestBid or self.lastPrice or 0.0
+        ask = self.engine.bestAsk or self.lastPrice or 0.0
+        return {'last': self.lastPrice or 0.0, 'buy': bid, 'sell': ask, 'mid': (bid + ask) / 2}
+
+    def get_market_depth(self, symbol):
+        book = self.engine.book
+        if book is not None:
+            return {'symbol': self.symbol,
+                    'bids': [[p, s] for p, s in zip(book['bidPrice'], book['bidSize']) if s > 0],
+                    'asks': [[p, s] for p, s in zip(book['askPrice'], book['askSize']) if s > 0]}
+
+        # Without recorded books assume default_queue contracts at the touch
+        ticker = self.get_ticker(symbol)
+        return {'symbol': self.symbol,
+                'bids': [[ticker['buy'], self.default_queue]],
+                'asks': [[ticker['sell'], self.default_queue]]}
+
+    def get_market_depth_if_changed(self, symbol, since):
+        if self.bookSequence <= since:
+            return None, self.bookSequence
+        return self.get_market_depth(symbol), self.bookSequence
+
+    def mark_price(self):
+        return self.get_ticker(self.symbol)['mid'] or self.lastPrice
+
+    def get_margin(self):
+        return {'marginBalance': self.account.balance(self.mark_price()) * settings.XBt_TO_XBT}
+
+    def get_position(self, symbol):
+        position = self.account.position
+        avg_entry = position / self.account.costBasis if position and self.account.costBasis else 0
+        return {'symbol': self.symbol, 'currentQty': position, 'markPrice': self.mark_price(),
+                'avgEntryPrice': avg_entry, 'marginCallPrice': 0}
+
+    def get_delta(self, symbol):
+        return self.account.position
+
+    def calc_delta(self):
+        mark = self.mark_price()
+        delta = self.account.position / mark if mark else 0.0
+        instrument = self.get_instrument(self.symbol)
+        return {'spot': delta, 'mark_price': delta, 'basis': 0.0,
+                'init_margin': abs(delta) * instrument['initMargin'],
+                'maint_margin': abs(delta) * instrument['maintMargin']}
+
+    def get_orders(self):
+        return [self.order_dict(o) for o in self.engine.open_orders()]
+
+    def order_dict(self, order):
+        return {'orderID': order.orderID, 'clOrdID': settings.BITMEX_ORDERID_PREFIX + str(order.orderID),
+                'symbol': self.symbol, 'side': 'Buy' if order.side == BUY else 'Sell',
+                'orderQty': order.orderQty, 'leavesQty': order.leavesQty, 'cumQty': order.cumQty,
+                'price': order.price, 'ordStatus': order.status}
+
+    def get_highest_buy(self):
+        buys = [o for o in self.get_orders() if o['side'] == 'Buy']
+        if not len(buys):
+            return {'price': -2**32, 'orderQty': 0}
+        return max(buys, key=lambda o: o['price'])
+
+    def get_lowest_sell(self):
+        sells = [o for o in self.get_orders() if o['side'] == 'Sell']
+        if not len(sells):
+            return {'price': 2**32, 'orderQty': 0}
+        return min(sells, key=lambda o: o['price'])
+
+    def check_risk(self, orders, amend=False):
+        """
+        Same gate as the live exchange. The matching engine has no order events, so the risk engine is resynced
+        from its state first, like from a partial.
+        """
+
+        if self.risk is None:
+            return
+        self.risk.on_position([{'currentQty': self.account.position}])
+        self.risk.on_order([self.order_dict(o) for o in self.engine.open_orders()], partial=True)
+        self.risk.check_orders(orders, self.get_ticker(self.symbol)['mid'], amend)
+
+    def get_fill_analytics(self):
+        return self.fillAnalytics
+
+    def get_risk_exposure(self):
+        return self.risk.exposure() if self.risk is not None else None
+
+    def create_bulk_orders(self, orders):
+        order_ids = [next(self.orderIDs) for _ in orders]
+        for order, order_id in zip(orders, order_ids):
+            order['clOrdID'] = settings.BITMEX_ORDERID_PREFIX + str(order_id)
+        self.check_risk(orders)
+
+        created = []
+        for order, order_id in zip(orders, order_ids):
+            side = BUY if order['side'] == 'Buy' else SELL
+            sim_order = self.engine.submit(order_id, side, abs(order['orderQty']), order['price'])
+            self.ordersSubmitted += 1
+            created.append(self.order_dict(sim_order))
+        return created
+
+    def amend_bulk_orders(self, orders):
+        self.check_risk(orders, amend=True)
+
+        amended = []
+        for order in orders:
+            qty = order.get('orderQty')
+            if qty is None and 'leavesQty' in order:
+                sim_order = self.engine.orders.get(order['orderID'])
+                qty = sim_order.cumQty + order['leavesQty'] if sim_order is not None else None
+            sim_order = self.engine.amend(order['orderID'], qty, order.get('price'))
+            if sim_order is not None:
+                self.ordersAmended += 1
+                amended.append(self.order_dict(sim_order))
+        return amended
+
+    def cancel_bulk_orders(self, orders):
+        for order in orders:
+            self.cancel_order(self.symbol, order)
+
+    def cancel_order(self, symbol, order):
+        self.engine.cancel(order['orderID'])
+        self.ordersCanceled += 1
+
+    def cancel_all_orders(self, symbol):
+        for order in self.engine.open_orders():
+            self.engine.cancel(order.orderID)
+            self.ordersCanceled += 1
+
+
+class BacktestReport(object):
+    def __init__(self, interface, inventory_times, inventory, sim_seconds, wall_seconds, throttle=None):
+        account = interface.account
+        mark = interface.mark_price()
+        fills = interface.fills
+
+        self.pnl = account.pnl(mark)
+        self.pnlUSD = self.pnl * mark if mark else 0.0
+        self.fees = account.fees
+        self.position = account.position
+        self.inventoryTimes = np.asarray(inventory_times)
+        self.inventory = np.asarray(inventory)
+        self.maxInventory = int(np.abs(self.inventory).max()) if len(self.inventory) else 0
+        self.fillCount = len(fills)
+        self.buyFills = sum(1 for f in fills if f.side == BUY)
+        self.sellFills = self.fillCount - self.buyFills
+        self.fillVolume = account.volume
+        self.ordersSubmitted = interface.ordersSubmitted
+        self.ordersAmended = interface.ordersAmended
+        self.ordersCanceled = interface.ordersCanceled
+        self.candles = interface.chart.history.next_index() + 1
+        self.fillAnalytics = interface.fillAnalytics
+        self.throttle = throttle
+        self.simSeconds = sim_seconds
+        self.wallSeconds = wall_seconds
+
+    def summary(self):
+        speedup = self.simSeconds / self.wallSeconds if self.wallSeconds > 0 else float('inf')
+        return '\n'.join([
+            "PnL: %.8f XBT (%.2f USD), Fees: %.8f XBT" % (self.pnl, self.pnlUSD, self.fees),
+            "Position: %d, Max Inventory: %d" % (self.position, self.maxInventory),
+            "Fills: %d (Buy %d / Sell %d), Volume: %d Contracts" %
+            (self.fillCount, self.buyFills, self.sellFills, self.fillVolume),
+            "Orders: %d submitted, %d amended, %d canceled" %
+            (self.ordersSubmitted, self.ordersAmended, self.ordersCanceled)] +
+            ([self.throttle.report()] if self.throttle is not None and self.throttle.cycles else []) +
+            (self.fillAnalytics.report() if self.fillCount else []) + [
+            "Simulated %.1f hours in %.2f seconds (%.0fx real time)" %
+            (self.simSeconds / 3600.0, self.wallSeconds, speedup)])
+
+
+class Backtester(object):
+    """
+    Replays recorded trades (and optionally orderBook10 snapshots) into a SimulatedExchangeInterface
+    and runs TradeManager.run_once every loop_interval seconds of market time.
+    """
+
+    def __init__(self, ticks, books=None, logger=None, loop_interval=None, chart=None, **interface_args):
+        self.ticks = ticks
+        self.books = books
+        self.loop_interval = settings.LOOP_INTERVAL if loop_interval is None else loop_interval
+        self.interface_args = interface_args
+        self.chart = chart
+
+        if logger is None:
+            logger = logging.getLogger('backtest')
+            logger.setLevel(logging.WARNING)
+        self.logger = logger
+
+    def run(self):
+        started = time.time()
+        interface = SimulatedExchangeInterface(self.logger, chart=self.chart, **self.interface_args)
+        trade_manager = TradeManager(self.logger, interface)
+
+        timestamps = self.ticks['timestamp'].tolist()
+        prices = self.ticks['price'].tolist()
+        sizes = self.ticks['size'].tolist()
+        sides = self.ticks['side'].tolist()
+        book_times = self.books['timestamp'].tolist() if self.books is not None else []
+        books = self.books
+        n_books = len(book_times)
+        book_cursor = 0
+
+        inventory_times = []
+        inventory = []
+        initialized = False
+        next_loop = timestamps[0] + self.loop_interval if timestamps else 0
+
+        for t, price, size, side in zip(timestamps, prices, sizes, sides):
+            while book_cursor < n_books and book_times[book_cursor] <= t:
+                interface.on_book(book_times[book_cursor], books[book_cursor])
+                book_cursor += 1
+
+            interface.on_trade(t, price, size, side)
+
+            if t >= next_loop:
+                next_loop += self.loop_interval * max(1, int((t - next_loop) // self.loop_interval) + 1)
+                if not initialized:
+                    trade_manager.init()
+                    initialized = True
+                inventory_times.append(t)
+                inventory.append(interface.account.position)
+                if not trade_manager.run_once():
+                    break
+
+        sim_seconds = timestamps[-1] - timestamps[0] if timestamps else 0.0
+        return BacktestReport(interface, inventory_times, inventory, sim_seconds, time.time() - started,
+                              trade_manager.throttle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest the market making loop on recorded trades.')
+    parser.add_argument('ticks', help='recorded trades (.npy, simulation.data.TICK_DTYPE)')
+    parser.add_argument('--books', default=None, help='recorded orderBook10 snapshots (.npy)')
+    parser.add_argument('--units', type=float, default=settings.CHART_UNITS)
+    parser.add_argument('--loop-interval', type=float, default=settings.LOOP_INTERVAL)
+    parser.add_argument('--order-latency', type=float, default=settings.SIM_ORDER_LATENCY)
+    parser.add_argument('--cancel-latency', type=float, default=settings.SIM_CANCEL_LATENCY)
+    parser.add_argument('--maker-fee', type=float, default=settings.SIM_MAKER_FEE)
+    args = parser.parse_args()
+
+    books = load_books(args.books) if args.books else None
+    backtester = Backtester(load_ticks(args.ticks), books, loop_interval=args.loop_interval, units=args.units,
+                            order_latency=args.order_latency, cancel_latency=args.cancel_latency,
+                            maker_fee=args.maker_fee)
+    print(backtester.run().summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+Conformance check and benchmark of the chart engines against the scalar CHART.make_bar.
+
+    python -m simulation.conformance [--cases 200] [--seed 0] [--benchmark 200000]
+
+Every case draws a random tick stream (sizes from one contract to several buckets, runs of equal prices,
+ticks ending exactly on bucket boundaries) and runs it through CHART, CHARTSET and columnar_chart, with and
+without bulk volume classification. Every BAR field must match bit for bit. A failing case is shrunk to the
+shortest failing prefix and reported with its seed so it can be replayed.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+from exchange.chart import CHART, TIMECHART
+from exchange.chart_set import CHARTSET
+from exchange.chart_columnar import columnar_chart
+
+FIELDS = ['start_time', 'end_time', 'openPrice', 'highPrice', 'lowPrice', 'closePrice',
+          'totalCnt', 'totalVolume', 'totalAmt', 'askCnt', 'bidCnt', 'askVolume', 'bidVolume', 'askAmt', 'bidAmt',
+          'bounceCnt', 'priceLong', 'priceShort', 'vpinLong', 'vpinShort', 'bounceLong', 'bounceShort',
+          'vpin', 'vpinCdf']
+
+
+def random_ticks(rng, n, units):
+    """
+    (timestamps, prices, sides, sizes) with integer contract sizes
+    """
+
+    timestamps = 1574000000.0 + np.cumsum(rng.exponential(rng.uniform(0.01, 2.0), n))
+    moves = rng.choice([-1.0, 0.0, 1.0], n, p=[0.2, 0.6, 0.2]) * rng.choice([0.5, 1.0, 5.0])
+    prices = 9000.0 + np.cumsum(moves)
+    sides = np.where(rng.rand(n) < rng.uniform(0.2, 0.8), 1, -1)
+
+    # Mostly small trades, some spanning several buckets, some filling the bucket exactly
+    sizes = np.maximum(1, np.round(rng.lognormal(np.log(units) - rng.uniform(1, 6), 2.0, n)))
+    exact = rng.rand(n) < 0.05
+    sizes[exact] = units * rng.randint(1, 3, exact.sum())
+    return timestamps, prices, sides, sizes
+
+
+def record(chart):
+    """
+    Keep every candle the chart creates (CHART itself only keeps the last ones)
+    """
+
+    candles = []
+    create_bar = chart.create_bar
+
+    def recording_create_bar(tick_seconds, tick_price):
+        create_bar(tick_seconds, tick_price)
+        candles.append(chart.candles[-1])
+
+    chart.create_bar = recording_create_bar
+    return candles
+
+
+def candle_columns(candles):
+    return dict((name, np.array([getattr(c, name) for c in candles], dtype=float)) for name in FIELDS)
+
+
+def run_scalar(ticks, units, bvc):
+    chart = CHART('', units, bvc=bvc)
+    candles = record(chart)
+    for tick in zip(*[column.tolist() for column in ticks]):
+        chart.make_bar(*tick)
+    return candle_columns(candles)
+
+
+def run_chart_set(ticks, units, bvc):
+    chart_set = CHARTSET('', [units // 10, units * 3], [], units)
+    candles = {}
+    for chart in chart_set.volume.values():
+        chart.useBVC = bvc
+        candles[chart.units] = record(chart)
+    for tick in zip(*[column.tolist() for column in ticks]):
+        chart_set.make_bar(*tick)
+    chart_set.flush()
+    return dict((units, candle_columns(c)) for units, c in candles.items())
+
+
+def run_columnar(ticks, units, bvc):
+    timestamps, prices, sides, sizes = ticks
+    columns = columnar_chart(timestamps, prices, sides, sizes, units, bvc=bvc)
+    return dict((name, np.asarray(columns[name], dtype=float)) for name in FIELDS)
+
+
+def compare(expected, actual):
+    """
+    First difference as (field, index, expected, actual), or None
+    """
+
+    for name in FIELDS:
+        a = expected[name]
+        b = actual[name]
+        if len(a) != len(b):
+            return name, min(len(a), len(b)), len(a), len(b)
+        diff = np.flatnonzero(a != b)
+        if len(diff):
+            i = diff[0]
+            return name, i, float(a[i]), float(b[i])
+    return None
+
+
+def check(ticks, units, bvc):
+    """
+    List of (engine, difference) against the scalar path
+    """
+
+    expected = run_scalar(ticks, units, bvc)
+    failures = []
+
+    difference = compare(expected, run_columnar(ticks, units, bvc))
+    if difference:
+        failures.append(('columnar_chart', difference))
+
+    for chart_units, actual in run_chart_set(ticks, units, bvc).items():
+        reference = expected if chart_units == units else run_scalar(ticks, chart_units, bvc)
+        difference = compare(reference, actual)
+        if difference:
+            failures.append(('CHARTSET[%d]' % chart_units, difference))
+
+    return failures
+
+
+def shrink(ticks, units, bvc):
+    """
+    Shortest prefix of the stream that still fails
+    """
+
+    low, high = 1, len(ticks[0])
+    while low < high:
+        middle = (low + high) // 2
+        if check([column[:middle] for column in ticks], units, bvc):
+            high = middle
+        else:
+            low = middle + 1
+    return high
+
+
+def run_cases(cases, seed):
+    failed = 0
+    for case in range(cases):
+        case_seed = seed + case
+        rng = np.random.RandomState(case_seed)
+        units = int(rng.choice([10, 1000, 100000, 1000000]))
+        bvc = bool(rng.rand() < 0.5)
+        ticks = random_ticks(rng, int(rng.randint(1, 3000)), units)
+
+        failures = check(ticks, units, bvc)
+        if failures:
+            failed += 1
+            length = shrink(ticks, units, bvc)
+            for engine, (name, index, expected, actual) in failures:
+                print('case seed=%d units=%d bvc=%s ticks=%d (fails from %d): %s %s[%d] expected %r got %r' %
+                      (case_seed, units, bvc, len(ticks[0]), length, engine, name, index, expected, actual))
+
+    print('%d / %d cases conform' % (cases - failed, cases))
+    return failed == 0
+
+
+def benchmark(n, seed):
+    rng = np.random.RandomState(seed)
+    units = 1000000
+    ticks = random_ticks(rng, n, units)
+    rows = list(zip(*[column.tolist() for column in ticks]))
+
+    def timed(label, function):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        print('%-28s %8.3f s %10.0f ticks/s' % (label, elapsed, n / elapsed if elapsed > 0 else float('inf')))
+
+    def scalar():
+        chart = CHART('', units)
+        for row in rows:
+            chart.make_bar(*row)
+
+    def chart_set():
+        charts = CHARTSET('', [units // 10, units * 10], [60], units)
+        for row in rows:
+            charts.make_bar(*row)
+        charts.flush()
+
+    def separate():
+        charts = [CHART('', units // 10), CHART('', units), CHART('', units * 10), TIMECHART('', 60)]
+        for row in rows:
+            for chart in charts:
+                chart.make_bar(*row)
+
+    timed('CHART.make_bar', scalar)
+    timed('CHARTSET (3 volume, 1 time)', chart_set)
+    timed('separate CHARTs (same 4)', separate)
+    timed('columnar_chart', lambda: columnar_chart(*(ticks + (units,))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check chart engines against CHART.make_bar and benchmark them.')
+    parser.add_argument('--cases', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmark', type=int, default=200000, help='ticks to benchmark with, 0 to skip')
+    args = parser.parse_args()
+
+    ok = run_cases(args.cases, args.seed)
+    if args.benchmark > 0:
+        benchmark(args.benchmark, args.seed)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from exchange.tick_store import TICK_DTYPE, parse_timestamp
+
+# Recorded orderBook10 snapshots.
+BOOK_DEPTH = 10
+BOOK_DTYPE = np.dtype([('timestamp', 'f8'),
+                       ('bidPrice', 'f8', (BOOK_DEPTH,)), ('bidSize', 'f8', (BOOK_DEPTH,)),
+                       ('askPrice', 'f8', (BOOK_DEPTH,)), ('askSize', 'f8', (BOOK_DEPTH,))])
+
+
+def ticks_from_trades(trades):
+    """
+    Convert BitMEX trade table rows to a TICK_DTYPE array
+    """
+
+    ticks = np.empty(len(trades), dtype=TICK_DTYPE)
+    for i, trade in enumerate(trades):
+        ticks[i] = (parse_timestamp(trade['timestamp']), trade['price'], trade['size'],
+                    1 if trade['side'] == 'Buy' else -1)
+    return ticks
+
+
+def books_from_order_books(order_books):
+    """
+    Convert BitMEX orderBook10 rows to a BOOK_DTYPE array
+    """
+
+    books = np.zeros(len(order_books), dtype=BOOK_DTYPE)
+    for i, order_book in enumerate(order_books):
+        books[i]['timestamp'] = parse_timestamp(order_book['timestamp'])
+        bids = np.asarray(order_book['bids'], dtype=float).reshape(-1, 2)[:BOOK_DEPTH]
+        asks = np.asarray(order_book['asks'], dtype=float).reshape(-1, 2)[:BOOK_DEPTH]
+        books[i]['bidPrice'][:len(bids)] = bids[:, 0]
+        books[i]['bidSize'][:len(bids)] = bids[:, 1]
+        books[i]['askPrice'][:len(asks)] = asks[:, 0]
+        books[i]['askSize'][:len(asks)] = asks[:, 1]
+    return books
+
+
+def save_ticks(path, ticks):
+    np.save(path, np.asarray(ticks, dtype=TICK_DTYPE))
+
+
+def load_ticks(path, mmap_mode='r'):
+    """
+    Load a TICK_DTYPE .npy file. Memory mapped by default so several processes share the pages.
+    """
+
+    ticks = np.load(path, mmap_mode=mmap_mode)
+    if ticks.dtype != TICK_DTYPE:
+        raise ValueError("%s is not a tick file (dtype %s)" % (path, ticks.dtype))
+    return ticks
+
+
+def save_books(path, books):
+    np.save(path, np.asarray(books, dtype=BOOK_DTYPE))
+
+
+def load_books(path, mmap_mode='r'):
+    books = np.load(path, mmap_mode=mmap_mode)
+    if books.dtype != BOOK_DTYPE:
+        raise ValueError("%s is not a book file (dtype %s)" % (path, books.dtype))
+    return books
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import numpy as np
+from config.settings import settings
+from exchange.chart import CHART
+from agent.policy import ACTION_STOP, N_FEATURES, fill_features
+from simulation.data import load_ticks, load_books
+from simulation.matching import BUY, SELL, SimulatedMatchingEngine, SimulatedAccount
+from utils.math import tick_grid
+
+
+class MarketMakingEnv(object):
+    """
+    Gym style market making environment replaying recorded trades through CHART.
+
+    One step lasts one CHART bucket. The action is the (sell_action, buy_action) pair of the live loop:
+    each side quotes one ParticipateDoNotInitiate order of order_size contracts, backed off from the touch
+    by that many ticks, and a sell_action of ACTION_STOP ends the episode. Quotes are filled by a
+    SimulatedMatchingEngine. The observation is the agent.policy feature vector of the latest candle and
+    the reward is the change in mark to market PnL (in USD) minus inventory_penalty * |position|.
+    """
+
+    def __init__(self, ticks, books=None, units=None, tick_size=0.5, order_size=None,
+                 min_position=None, max_position=None, episode_buckets=200, inventory_penalty=0.0,
+                 order_latency=None, cancel_latency=None, maker_fee=None, default_queue=None, seed=None):
+        self.units = units or settings.CHART_UNITS
+        self.tick_size = tick_size
+        self.grid = tick_grid(tick_size)
+        self.order_size = order_size or settings.ORDER_START_SIZE
+        self.min_position = settings.MIN_POSITION if min_position is None else min_position
+        self.max_position = settings.MAX_POSITION if max_position is None else max_position
+        self.episode_buckets = episode_buckets
+        self.inventory_penalty = inventory_penalty
+        self.engine_args = (settings.SIM_ORDER_LATENCY if order_latency is None else order_latency,
+                            settings.SIM_CANCEL_LATENCY if cancel_latency is None else cancel_latency,
+                            settings.SIM_MAKER_FEE if maker_fee is None else maker_fee,
+                            settings.SIM_DEFAULT_QUEUE if default_queue is None else default_queue)
+
+        # Plain lists are much faster than numpy scalars in the per tick loop
+        self.timestamps = ticks['timestamp'].tolist()
+        self.prices = ticks['price'].tolist()
+        self.sizes = ticks['size'].tolist()
+        self.sides = ticks['side'].tolist()
+        self.books = books
+        self.bookTimes = books['timestamp'].tolist() if books is not None else []
+
+        self.random = np.random.RandomState(seed)
+        self.observation_size = N_FEATURES
+        self.orderIDs = itertools.count()
+
+        self.chart = None
+        self.engine = None
+        self.account = None
+        self.quotes = {}
+        self.cursor = 0
+        self.bookCursor = 0
+        self.buckets = 0
+        self.lastPrice = None
+
+    def seed(self, seed=None):
+        self.random = np.random.RandomState(seed)
+
+    def reset(self, start=None):
+        """
+        Start an episode at tick index start (random by default). Returns the first observation.
+        """
+
+        if start is None:
+            start = self.random.randint(0, max(1, len(self.prices) // 2))
+        self.cursor = start
+        self.bookCursor = int(np.searchsorted(self.bookTimes, self.timestamps[start])) if self.bookTimes else 0
+
+        self.chart = CHART('', self.units)
+        self.engine = SimulatedMatchingEngine(*self.engine_args)
+        self.account = SimulatedAccount()
+        self.quotes = {SELL: None, BUY: None}
+        self.buckets = 0
+        self.lastPrice = self.prices[start]
+
+        # Fill the first bucket so the observation has a candle behind it
+        self.advance_bucket()
+        return self.observation()
+
+    def step(self, action):
+        sell_action, buy_action = action
+        if sell_action == ACTION_STOP:
+            return self.observation(), 0.0, True, self.info()
+
+        self.quote(SELL, sell_action)
+        self.quote(BUY, buy_action)
+
+        pnl = self.account.pnl(self.lastPrice) * self.lastPrice
+        exhausted = not self.advance_bucket()
+        self.buckets += 1
+
+        reward = self.account.pnl(self.lastPrice) * self.lastPrice - pnl - \
+            self.inventory_penalty * abs(self.account.position)
+        done = exhausted or self.buckets >= self.episode_buckets
+        return self.observation(), reward, done, self.info()
+
+    def observation(self, out=None):
+        if out is None:
+            out = np.zeros(N_FEATURES)
+        if len(self.chart.candles) > 0:
+            fill_features(self.chart.candles[-1], self.account.position, out)
+        return out
+
+    def info(self):
+        return {'position': self.account.position,
+                'pnl': self.account.pnl(self.lastPrice),
+                'fills': self.account.fillCount,
+                'time': self.engine.now}
+
+    def quote(self, side, action):
+        """
+        Keep one order on side, action ticks behind the touch. Respects the position limits.
+        """
+
+        engine = self.engine
+        order = self.quotes[side]
+        touch = engine.bestAsk if side == SELL else engine.bestBid
+        position = self.account.position
+        blocked = (side == BUY and position >= self.max_position) or (side == SELL and position <= self.min_position)
+
+        if touch is None or blocked:
+            if order is not None and order.is_open():
+                engine.cancel(order.orderID)
+            self.quotes[side] = None
+            return
+
+        # In integer ticks, so backing off never leaves the tick grid
+        ticks = self.grid.to_ticks(touch)
+        price = self.grid.to_price(ticks - action if side == BUY else ticks + action)
+        if order is not None and order.is_open():
+            if order.price != price:
+                engine.amend(order.orderID, price=price)
+        else:
+            self.quotes[side] = engine.submit(next(self.orderIDs), side, self.order_size, price)
+
+    def advance_bucket(self):
+        """
+        Replay ticks until CHART opens a new bucket. Returns False when the data is exhausted.
+        """
+
+        timestamps, prices, sizes, sides = self.timestamps, self.prices, self.sizes, self.sides
+        book_times, books = self.bookTimes, self.books
+        engine, chart, account = self.engine, self.chart, self.account
+        n = len(prices)
+        n_books = len(book_times)
+
+        cursor = self.cursor
+        while cursor < n:
+            t = timestamps[cursor]
+            while self.bookCursor < n_books and book_times[self.bookCursor] <= t:
+                engine.on_book(book_times[self.bookCursor], books[self.bookCursor])
+                self.bookCursor += 1
+
+            price = prices[cursor]
+            side = sides[cursor]
+            engine.on_trade(t, price, sizes[cursor], side)
+            if engine.fills:
+                for fill in engine.drain_fills():
+                    account.apply(fill)
+
+            is_new = chart.make_bar(t, price, side, sizes[cursor])
+            cursor += 1
+            if is_new and cursor - 1 > self.cursor:
+                self.cursor = cursor
+                self.lastPrice = price
+                return True
+
+        self.cursor = cursor
+        self.lastPrice = prices[n - 1]
+        return False
+
+
+def make_env(tick_path, book_path=None, **kwargs):
+    """
+    Build an environment over memory mapped recordings. Picklable through functools.partial,
+    so it can be handed to SubprocVectorEnv.
+    """
+
+    books = load_books(book_path) if book_path else None
+    return MarketMakingEnv(load_ticks(tick_path), books, **kwargs)
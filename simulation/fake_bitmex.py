@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local fake of the BitMEX realtime websocket, and a check of the redundant market data connections against two
+of them.
+
+    python -m simulation.fake_bitmex [--trades 2000] [--rate 500] [--stall 6.0] [--seed 0]
+
+Both servers publish the same trade and orderBook10 stream, each with its own random latency. Halfway through,
+the primary connection's server stops sending (pongs included) for --stall seconds, long enough for the heartbeat to
+reconnect it (WS_PING_INTERVAL + WS_PONG_TIMEOUT) while the redundant connection carries the data. Trades keep
+coming past --trades until the primary connection is back, and the check fails if it never reconnected. Every trade has to reach the tick store exactly
+once, the order book has to end on the last snapshot, and the latency of the merged stream is compared to the
+latency of each connection.
+"""
+
+import sys
+import json
+import time
+import base64
+import heapq
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+import numpy as np
+from datetime import datetime
+from config.settings import settings
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def iso_timestamp(seconds):
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeBitMEXServer(object):
+    """
+    Unauthenticated realtime endpoint on 127.0.0.1. A client gets the partials of the topics in its url
+    (?subscribe=table:symbol,...) from the current tables, then everything published. 'ping' is answered
+    with 'pong'. Messages are delivered after the latency given to publish, in order of delivery time.
+    """
+
+    KEYS = {'trade': [], 'orderBook10': ['symbol'], 'quote': [], 'instrument': ['symbol']}
+
+    def __init__(self, port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+
+        self.tables = {}
+        self.clients = []
+        self.connections = 0
+        # While stalled nothing is sent and pings are not answered, like a silently dead route
+        self.stalled = False
+        self.closed = False
+
+        self.lock = threading.Condition()
+        self.queue = []
+        self.sequence = 0
+
+        for target in (self.__accept, self.__deliver):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def url(self):
+        return 'ws://127.0.0.1:%d' % self.port
+
+    def close(self):
+        self.closed = True
+        self.drop()
+        self.sock.close()
+        with self.lock:
+            self.lock.notify_all()
+
+    def drop(self):
+        """ close every client connection without a close frame """
+
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+            except OSError:
+                pass
+
+    def publish(self, table, action, rows, latency=0.0):
+        """
+        Apply rows to the tables partials are served from and send them to every client after latency seconds
+        """
+
+        with self.lock:
+            if action == 'insert' and table == 'trade':
+                self.tables.setdefault(table, []).extend(rows)
+            elif action in ('partial', 'insert', 'update'):
+                current = dict((row.get('symbol'), row) for row in self.tables.get(table, []))
+                current.update((row.get('symbol'), row) for row in rows)
+                self.tables[table] = list(current.values())
+
+            message = json.dumps({'table': table, 'action': action, 'data': rows})
+            heapq.heappush(self.queue, (time.time() + latency, self.sequence, message))
+            self.sequence += 1
+            self.lock.notify_all()
+
+    def __deliver(self):
+        while not self.closed:
+            with self.lock:
+                while not self.closed and (not self.queue or self.queue[0][0] > time.time()):
+                    self.lock.wait(self.queue[0][0] - time.time() if self.queue else None)
+                if self.closed:
+                    return
+                _, _, message = heapq.heappop(self.queue)
+                clients = list(self.clients) if not self.stalled else []
+            for client in clients:
+                self.send(client, message)
+
+    def send(self, client, text):
+        data = text.encode('utf-8')
+        n = len(data)
+        if n < 126:
+            header = struct.pack('!BB', 0x81, n)
+        elif n < 65536:
+            header = struct.pack('!BBH', 0x81, 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, n)
+        try:
+            client.sendall(header + data)
+        except OSError:
+            pass
+
+    def __accept(self):
+        while not self.closed:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.__serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def __serve(self, client):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            data = client.recv(4096)
+            if not data:
+                return
+            request += data
+
+        lines = request.decode('utf-8').split('\r\n')
+        path = lines[0].split()[1]
+        key = [line.split(':', 1)[1].strip() for line in lines if line.lower().startswith('sec-websocket-key')][0]
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('utf-8')).digest()).decode('utf-8')
+        client.sendall(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                        'Sec-WebSocket-Accept: %s\r\n\r\n' % accept).encode('utf-8'))
+
+        topics = path.split('subscribe=', 1)[1].split(',') if 'subscribe=' in path else []
+        with self.lock:
+            self.send(client, json.dumps({'info': 'Welcome to the fake BitMEX Realtime API.'}))
+            for topic in topics:
+                table, _, symbol = topic.partition(':')
+                rows = [row for row in self.tables.get(table, []) if not symbol or row.get('symbol') == symbol]
+                self.send(client, json.dumps({'table': table, 'action': 'partial', 'keys': self.KEYS.get(table, []),
+                                              'data': rows, 'filter': {'symbol': symbol} if symbol else {}}))
+            self.clients.append(client)
+            self.connections += 1
+
+        self.__read(client)
+
+    def __read(self, client):
+        """ client frames (always masked): answer pings, stop on close """
+
+        buf = b''
+        while True:
+            while True:
+                if len(buf) >= 2:
+                    n = buf[1] & 0x7f
+                    offset = 2 + (2 if n == 126 else 8 if n == 127 else 0)
+                    if len(buf) >= offset:
+                        if n == 126:
+                            n = struct.unpack('!H', buf[2:4])[0]
+                        elif n == 127:
+                            n = struct.unpack('!Q', buf[2:10])[0]
+                        if len(buf) >= offset + 4 + n:
+                            break
+                try:
+                    data = client.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+
+            opcode = buf[0] & 0x0f
+            mask = buf[offset:offset + 4]
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(buf[offset + 4:offset + 4 + n]))
+            buf = buf[offset + 4 + n:]
+
+            if opcode == 0x8:
+                return
+            if opcode == 0x1 and payload == b'ping' and not self.stalled:
+                self.send(client, 'pong')
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return 'p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms' % (np.percentile(values, 50), np.percentile(values, 99),
+                                                         values.max())
+
+
+def check_redundancy(trades, rate, stall, seed):
+    from exchange.bitmex_exchange import BitMEXExchange
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger('fake_bitmex')
+
+    rng = np.random.RandomState(seed)
+    symbol = settings.BITMEX_BTC_SYMBOL
+    servers = [FakeBitMEXServer(), FakeBitMEXServer()]
+
+    settings.CANDLE_ARCHIVE_DIR = ''
+    settings.CONTRACTS = [symbol]
+    settings.WS_SUBSCRIPTION_PROFILE = 'market_maker'
+    settings.WS_REDUNDANT_URLS = [servers[1].url()]
+    settings.WS_TABLE_MAX_AGE = {}
+
+    start = time.time()
+    book = {'symbol': symbol, 'timestamp': iso_timestamp(start), 'bids': [[9000.0, 100]], 'asks': [[9000.5, 100]]}
+    for server in servers:
+        server.publish('instrument', 'partial', [{'symbol': symbol, 'state': 'Open'}])
+        server.publish('orderBook10', 'partial', [book])
+
+    exchange = BitMEXExchange(logger, None, servers[0].url(), symbol, should_ws_auth=False)
+    exchange.connect_websocket()
+
+    # Arrival time of every trade on the merged stream
+    arrivals = {}
+    on_trades = exchange.on_trades
+
+    def record(rows):
+        now = time.time()
+        for row in rows:
+            arrivals.setdefault(row['trdMatchID'], []).append(now)
+        on_trades(rows)
+    exchange.on_trades = record
+
+    sent = {}
+    latencies = [[], []]
+    stall_at = trades // 2
+    stall_end = deadline = None
+    price = 9000.0
+    # Past --trades, keep publishing until the stall is over and the heartbeat reconnected the primary connection
+    i = 0
+    while i < trades or servers[0].stalled or servers[0].connections < 2:
+        if i == stall_at:
+            servers[0].stalled = True
+            stall_end = time.time() + stall
+            deadline = stall_end + settings.WS_PING_INTERVAL + settings.WS_PONG_TIMEOUT + 10
+        if servers[0].stalled and time.time() >= stall_end:
+            servers[0].stalled = False
+        if deadline is not None and time.time() >= deadline:
+            break
+
+        now = time.time()
+        price += rng.choice([-0.5, 0.0, 0.5])
+        trade = {'timestamp': iso_timestamp(now), 'symbol': symbol, 'side': 'Buy' if rng.rand() < 0.5 else 'Sell',
+                 'size': int(rng.randint(1, 1000)), 'price': price, 'trdMatchID': 'trade-%08d' % i}
+        book = {'symbol': symbol, 'timestamp': iso_timestamp(now), 'bids': [[price - 0.5, int(rng.randint(1, 1e5))]],
+                'asks': [[price, int(rng.randint(1, 1e5))]]}
+        sent[trade['trdMatchID']] = now
+        for n, server in enumerate(servers):
+            # Mostly fast, with the occasional slow message on either route
+            latency = rng.exponential(0.002) + (rng.exponential(0.05) if rng.rand() < 0.05 else 0.0)
+            if not (n == 0 and server.stalled):
+                latencies[n].append(latency)
+            server.publish('trade', 'insert', [trade], latency)
+            server.publish('orderBook10', 'update', [book], latency)
+        time.sleep(rng.exponential(1.0 / rate))
+        i += 1
+    trades = i
+
+    deadline = time.time() + settings.WS_PONG_TIMEOUT + 5
+    while time.time() < deadline and (len(arrivals) < trades or not exchange.is_synced()):
+        time.sleep(0.05)
+    time.sleep(0.2)
+
+    duplicates = sum(1 for times in arrivals.values() if len(times) > 1)
+    missing = trades - len(arrivals)
+    merged = [min(times) - sent[trade_id] for trade_id, times in arrivals.items()]
+    last_book = exchange.get_ws_market_depth(symbol)
+
+    print('trades %d, ticks stored %d, missing %d, charted twice %d, duplicates dropped %d' %
+          (trades, len(exchange.ticks), missing, duplicates, exchange.merger.duplicates))
+    print('primary connections %d, redundant connections %d' % (servers[0].connections, servers[1].connections))
+    print('primary   %s' % percentiles(latencies[0]))
+    print('redundant %s' % percentiles(latencies[1]))
+    print('merged    %s' % percentiles(merged))
+
+    reconnected = servers[0].connections >= 2
+    ok = missing == 0 and duplicates == 0 and len(exchange.ticks) == trades and last_book == book and reconnected
+    print('book %s' % ('matches the last snapshot' if last_book == book else 'MISMATCH: %s' % last_book))
+    if not reconnected:
+        print('primary connection was NOT reconnected during the stall')
+
+    exchange.disconnect_websocket()
+    for server in servers:
+        server.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check redundant market data connections against two fake servers.')
+    parser.add_argument('--trades', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=500, help='trades per second')
+    parser.add_argument('--stall', type=float, default=6.0, help='seconds the primary server stops sending')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ok = check_redundancy(args.trades, args.rate, args.stall, args.seed)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""
+Convert the bot logs (logs/vpin_YYYY_MM_DD.log) into typed columns, one .npz per converted segment, and query
+them by timestamp.
+
+    python -m simulation.log_dataset [logs/vpin_*.log ...] [--out data/logs] [--processes 8] [--segment-mb 4]
+
+Every line the bot writes with numbers in it (balance, position, delta, ticker, executions, ...) becomes a row
+of its table, with the log timestamp in seconds (the clock of the bot, as written). Other lines go to the events
+table. Files are cut into newline aligned segments that are parsed in a process pool; manifest.json records the
+converted byte ranges with their first / last timestamp and row counts, so later runs only parse what was
+appended since, and queries only open the segments overlapping the requested time range:
+
+    dataset = LogDataset('data/logs')
+    balance = dataset.read('balance', start, end)   # {'timestamp': ..., 'balance': ...}
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import calendar
+import argparse
+import multiprocessing
+import numpy as np
+from config.settings import settings
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+NUMBER = r'(-?[0-9.]+(?:e[-+]?[0-9]+)?)'
+
+# table -> (message prefix, regex of the whole message, columns after timestamp)
+TABLES = {
+    'balance': ('Current XBT Balance', r'Current XBT Balance: ' + NUMBER, [('balance', 'f8')]),
+    'position': ('Current Contract Position', r'Current Contract Position: ' + NUMBER, [('position', 'f8')]),
+    'traded': ('Contracts Traded This Run', r'Contracts Traded This Run: ' + NUMBER, [('traded', 'f8')]),
+    'delta': ('Total Contract Delta', r'Total Contract Delta: ' + NUMBER + ' XBT', [('delta', 'f8')]),
+    'limits': ('Position limits', r'Position limits: ' + NUMBER + ' / ' + NUMBER,
+               [('minPosition', 'f8'), ('maxPosition', 'f8')]),
+    'entry': ('Avg Entry Price', r'Avg Entry Price: ' + NUMBER, [('avgEntryPrice', 'f8')]),
+    'mark': ('Avg Market Price', r'Avg Market Price: ' + NUMBER, [('markPrice', 'f8')]),
+    'margin_call': ('Margin Call Price', r'Margin Call Price: ' + NUMBER, [('marginCallPrice', 'f8')]),
+    'open_orders': ('Open Orders', r'Open Orders: ' + NUMBER + ' buy / ' + NUMBER + ' sell, Cost ' + NUMBER +
+                    ' XBT, Margin ' + NUMBER + ' XBT',
+                    [('openBuy', 'f8'), ('openSell', 'f8'), ('openCost', 'f8'), ('openMargin', 'f8')]),
+    'position_margin': ('Position Margin', r'Position Margin: ' + NUMBER + ' XBT initial, ' + NUMBER +
+                        ' XBT maintenance', [('initMargin', 'f8'), ('maintMargin', 'f8')]),
+    'reference': ('Reference Fair Value', r'Reference Fair Value: ' + NUMBER + r' \(Bithumb ' + NUMBER +
+                  ' USD, Premium ' + NUMBER + r'%\)', [('fairValue', 'f8'), ('usdPrice', 'f8'), ('premium', 'f8')]),
+    'ticker': ('XBTUSD Ticker', r'\S+ Ticker: Buy: ' + NUMBER + ', Sell: ' + NUMBER, [('buy', 'f8'), ('sell', 'f8')]),
+    'start_positions': ('Start Positions', r'Start Positions: Buy: ' + NUMBER + ', Sell: ' + NUMBER + ', Mid: ' +
+                        NUMBER, [('buy', 'f8'), ('sell', 'f8'), ('mid', 'f8')]),
+    'bid_liquidity': ('Bid Liquidity', r'Bid Liquidity: ' + NUMBER + ' Contracts', [('contracts', 'f8')]),
+    'ask_liquidity': ('Ask Liquidity', r'Ask Liquidity: ' + NUMBER + ' Contracts', [('contracts', 'f8')]),
+    'execution': ('Execution', r'Execution: (Buy|Sell) ' + NUMBER + r' Contracts of \S+ at ' + NUMBER,
+                  [('side', 'i1'), ('qty', 'f8'), ('price', 'f8')]),
+}
+EVENTS = 'events'
+PREFIXES = dict((prefix, table) for table, (prefix, _, _) in TABLES.items())
+PATTERNS = dict((table, re.compile(pattern + '$')) for table, (_, pattern, _) in TABLES.items())
+
+# Bump when parsing changes, so converted segments are redone
+DATASET_VERSION = 1
+
+_days = {}
+
+
+def parse_log_time(line):
+    """
+    '2019-11-06 02:23:43,609' at the start of a line to seconds, the day part cached
+    """
+
+    day = line[:10]
+    base = _days.get(day)
+    if base is None:
+        base = _days[day] = calendar.timegm((int(day[:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    return base + int(line[11:13]) * 3600 + int(line[14:16]) * 60 + int(line[17:19]) + int(line[20:23]) / 1000.0
+
+
+def table_dtype(table):
+    if table == EVENTS:
+        return [('timestamp', 'f8'), ('level', 'i1'), ('message', 'U')]
+    return [('timestamp', 'f8')] + TABLES[table][2]
+
+
+def parse_lines(lines):
+    """
+    Rows per table, as lists of tuples, of the lines 'YYYY-MM-DD HH:MM:SS,mmm - LEVEL - message'
+    """
+
+    rows = {}
+    for line in lines:
+        parts = line.rstrip('\r\n').split(' - ', 2)
+        if len(parts) < 3 or len(parts[0]) != 23:
+            continue
+        try:
+            timestamp = parse_log_time(parts[0])
+        except ValueError:
+            continue
+        message = parts[2]
+
+        table = PREFIXES.get(message.split(':', 1)[0])
+        if table is None and message.endswith(' Ticker', 0, message.find(':')):
+            table = 'ticker'
+        match = PATTERNS[table].match(message) if table is not None else None
+        if match is None:
+            rows.setdefault(EVENTS, []).append((timestamp, LEVELS.get(parts[1], 0), message))
+            continue
+
+        values = list(match.groups())
+        if table == 'execution':
+            values[0] = 1 if values[0] == 'Buy' else -1
+        rows.setdefault(table, []).append(tuple([timestamp] + values))
+    return rows
+
+
+def to_columns(table, rows):
+    dtype = table_dtype(table)
+    if table == EVENTS:
+        width = max(len(row[2]) for row in rows)
+        dtype = dtype[:2] + [('message', 'U%d' % max(1, width))]
+    array = np.array(rows, dtype=dtype)
+    return dict((name, array[name]) for name, _ in dtype)
+
+
+def convert_segment(task):
+    """
+    Parse bytes [start, end) of a log into out_path. Returns the manifest entry of the segment.
+    """
+
+    path, start, end, out_path = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    rows = parse_lines(data.decode('utf-8', 'replace').splitlines())
+    arrays = {}
+    first, last = None, None
+    for table, table_rows in rows.items():
+        for name, column in to_columns(table, table_rows).items():
+            arrays[table + '/' + name] = column
+        times = arrays[table + '/timestamp']
+        first = times[0] if first is None else min(first, times[0])
+        last = times[-1] if last is None else max(last, times[-1])
+
+    with open(out_path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(out_path + '.tmp', out_path)
+
+    return {'start': start, 'end': end, 'path': os.path.basename(out_path),
+            'first': float(first) if first is not None else None, 'last': float(last) if last is not None else None,
+            'rows': dict((table, len(table_rows)) for table, table_rows in rows.items())}
+
+
+def find_newline(f, offset, size, block=1 << 16):
+    """ offset of the first newline at or after offset, -1 if none before size """
+
+    while offset < size:
+        f.seek(offset)
+        data = f.read(min(block, size - offset))
+        newline = data.find(b'\n')
+        if newline >= 0:
+            return offset + newline
+        offset += len(data)
+    return -1
+
+
+def segment_ranges(path, start, size, segment_bytes):
+    """
+    Newline aligned [start, end) ranges up to the last complete line, of about segment_bytes each
+    """
+
+    ranges = []
+    with open(path, 'rb') as f:
+        while start < size:
+            end = min(start + segment_bytes, size)
+            newline = find_newline(f, end - 1, size)
+            if newline >= 0:
+                end = newline + 1
+            else:
+                # Up to the last complete line, the unfinished one is converted once it is complete
+                f.seek(start)
+                end = start + f.read(end - start).rfind(b'\n') + 1
+                if end <= start:
+                    break
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+class LogDataset(object):
+    """
+    Converted segments of the logs under root, described by root/manifest.json
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifestPath = os.path.join(root, 'manifest.json')
+        self.manifest = {'version': DATASET_VERSION, 'files': {}}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == DATASET_VERSION:
+                self.manifest = manifest
+
+    def save_manifest(self):
+        with open(self.manifestPath + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(self.manifestPath + '.tmp', self.manifestPath)
+
+    def convert(self, paths, processes=None, segment_bytes=4 << 20):
+        """
+        Convert what was appended to paths since the last run. A file that shrank was rewritten and is redone.
+        Returns the number of new segments.
+        """
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        tasks = []
+        for path in sorted(paths):
+            name = os.path.basename(path)
+            size = os.path.getsize(path)
+            entry = self.manifest['files'].get(name)
+            if entry is None or entry['size'] > size:
+                entry = self.manifest['files'][name] = {'size': 0, 'segments': []}
+            converted = entry['segments'][-1]['end'] if entry['segments'] else 0
+            for start, end in segment_ranges(path, converted, size, segment_bytes):
+                out_path = os.path.join(self.root, '%s.%012d.npz' % (os.path.splitext(name)[0], start))
+                tasks.append((path, start, end, out_path))
+
+        if tasks:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for task, segment in zip(tasks, pool.imap(convert_segment, tasks)):
+                    entry = self.manifest['files'][os.path.basename(task[0])]
+                    entry['segments'].append(segment)
+                    entry['size'] = segment['end']
+            finally:
+                pool.close()
+                pool.join()
+            self.save_manifest()
+        return len(tasks)
+
+    def segments(self, start=None, end=None):
+        """ manifest entries of the segments with rows in [start, end), in time order """
+
+        found = []
+        for entry in self.manifest['files'].values():
+            for segment in entry['segments']:
+                if segment['first'] is None:
+                    continue
+                if (start is not None and segment['last'] < start) or (end is not None and segment['first'] >= end):
+                    continue
+                found.append(segment)
+        return sorted(found, key=lambda segment: segment['first'])
+
+    def tables(self):
+        counts = {}
+        for segment in self.segments():
+            for table, rows in segment['rows'].items():
+                counts[table] = counts.get(table, 0) + rows
+        return counts
+
+    def read(self, table, start=None, end=None):
+        """
+        Columns of table with timestamps in [start, end), in time order
+        """
+
+        parts = []
+        for segment in self.segments(start, end):
+            if not segment['rows'].get(table):
+                continue
+            with np.load(os.path.join(self.root, segment['path'])) as npz:
+                prefix = table + '/'
+                columns = dict((key[len(prefix):], npz[key]) for key in npz.files if key.startswith(prefix))
+            times = columns['timestamp']
+            lo = 0 if start is None else np.searchsorted(times, start, side='left')
+            hi = len(times) if end is None else np.searchsorted(times, end, side='left')
+            if hi > lo:
+                parts.append(dict((name, column[lo:hi]) for name, column in columns.items()))
+
+        if not parts:
+            return dict((name, np.zeros(0, dtype=dtype if dtype != 'U' else 'U1'))
+                        for name, dtype in table_dtype(table))
+        if len(parts) == 1:
+            return parts[0]
+        columns = dict((name, np.concatenate([part[name] for part in parts])) for name in parts[0])
+        order = np.argsort(columns['timestamp'], kind='stable')
+        return dict((name, column[order]) for name, column in columns.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert bot logs into columnar .npz segments.')
+    parser.add_argument('logs', nargs='*', help='log files (default: %s/%s_*.log)' %
+                        (settings.LOG_DIR, settings.LOG_NAME))
+    parser.add_argument('--out', default='data/logs')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--segment-mb', type=float, default=4)
+    args = parser.parse_args()
+
+    paths = args.logs or glob.glob(os.path.join(settings.LOG_DIR, settings.LOG_NAME + '_*.log'))
+    dataset = LogDataset(args.out)
+    started = time.time()
+    converted = dataset.convert(paths, args.processes, int(args.segment_mb * (1 << 20)))
+    print('%d new segments in %.2f seconds' % (converted, time.time() - started))
+    for table, rows in sorted(dataset.tables().items()):
+        print('%-16s %10d rows' % (table, rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+from collections import namedtuple
+
+BUY = 1
+SELL = -1
+
+Fill = namedtuple('Fill', ['time', 'orderID', 'side', 'price', 'qty', 'fee'])
+
+
+class SimOrder(object):
+    def __init__(self, order_id, side, qty, price):
+        self.orderID = order_id
+        self.side = side
+        self.price = price
+        self.orderQty = qty
+        self.leavesQty = qty
+        self.cumQty = 0
+        self.queueAhead = 0.0
+        self.status = 'Pending'
+
+    def is_open(self):
+        return self.status in ('Pending', 'New', 'PartiallyFilled')
+
+
+class SimulatedMatchingEngine(object):
+    """
+    Fills passive ParticipateDoNotInitiate orders against a recorded trade stream.
+
+    Orders become live order_latency seconds after submit and leave the book cancel_latency seconds after cancel.
+    A live order that would cross the spread is canceled, as BitMEX does with ParticipateDoNotInitiate.
+    Each live order tracks the volume queued ahead of it at its price: trades at the order price eat that
+    queue first, trades through the order price fill it completely. Book snapshots, when available,
+    shrink the queue to the displayed size (cancels ahead of us) and give the best bid/ask. Without books
+    the best bid/ask is taken from the last sell/buy aggressor trade and default_queue is used at the touch.
+
+    Fees are returned in XBT for the inverse XBTUSD contract: qty / price * fee_rate (negative = rebate).
+    """
+
+    def __init__(self, order_latency=0.05, cancel_latency=0.05, maker_fee=-0.00025, default_queue=0.0):
+        self.order_latency = order_latency
+        self.cancel_latency = cancel_latency
+        self.maker_fee = maker_fee
+        self.default_queue = default_queue
+
+        self.now = 0.0
+        self.bestBid = None
+        self.bestAsk = None
+        self.book = None
+
+        # Open (pending or live) orders by id, live orders in arrival order
+        self.orders = {}
+        self.live = []
+        self.pending = []
+        self.fills = []
+        self.sequence = itertools.count()
+
+    #
+    # Order entry
+    #
+
+    def submit(self, order_id, side, qty, price, now=None):
+        now = self.now if now is None else now
+        order = SimOrder(order_id, side, qty, price)
+        self.orders[order_id] = order
+        heapq.heappush(self.pending, (now + self.order_latency, next(self.sequence), 'new', order))
+        return order
+
+    def cancel(self, order_id, now=None):
+        now = self.now if now is None else now
+        order = self.orders.get(order_id)
+        if order is not None and order.is_open():
+            heapq.heappush(self.pending, (now + self.cancel_latency, next(self.sequence), 'cancel', order))
+
+    def amend(self, order_id, qty=None, price=None, now=None):
+        """
+        Amend price and/or total quantity. A price change loses queue priority, a size reduction keeps it.
+        """
+
+        now = self.now if now is None else now
+        order = self.orders.get(order_id)
+        if order is None or not order.is_open():
+            return None
+        heapq.heappush(self.pending, (now + self.order_latency, next(self.sequence), 'amend', (order, qty, price)))
+        return order
+
+    def open_orders(self):
+        return list(self.orders.values())
+
+    def drain_fills(self):
+        fills = self.fills
+        self.fills = []
+        return fills
+
+    #
+    # Market data
+    #
+
+    def advance(self, now):
+        """
+        Apply every order event that reached the exchange before now
+        """
+
+        self.now = now
+        pending = self.pending
+        while pending and pending[0][0] <= now:
+            _, _, action, payload = heapq.heappop(pending)
+            if action == 'new':
+                if payload.status == 'Pending':
+                    self.activate(payload)
+            elif action == 'cancel':
+                self.remove(payload, 'Canceled')
+            else:
+                order, qty, price = payload
+                if not order.is_open():
+                    continue
+                if qty is not None:
+                    order.leavesQty = qty - order.cumQty
+                    order.orderQty = qty
+                    if order.leavesQty <= 0:
+                        self.remove(order, 'Canceled')
+                        continue
+                if price is not None and price != order.price:
+                    order.price = price
+                    if order.status != 'Pending':
+                        self.remove(order, 'Pending')
+                        self.activate(order)
+
+    def activate(self, order):
+        if (order.side == BUY and self.bestAsk is not None and order.price >= self.bestAsk) or \
+                (order.side == SELL and self.bestBid is not None and order.price <= self.bestBid):
+            self.remove(order, 'Canceled')
+            return
+
+        order.queueAhead = self.queue_at(order.side, order.price)
+        order.status = 'New'
+        self.live.append(order)
+
+    def remove(self, order, status):
+        if order in self.live:
+            self.live.remove(order)
+        order.status = status
+        if not order.is_open():
+            self.orders.pop(order.orderID, None)
+
+    def queue_at(self, side, price):
+        """
+        Volume resting ahead of a new order at price
+        """
+
+        if self.book is not None:
+            prices, sizes = (self.book['bidPrice'], self.book['bidSize']) if side == BUY else \
+                (self.book['askPrice'], self.book['askSize'])
+            for level_price, level_size in zip(prices, sizes):
+                if level_price == price:
+                    return float(level_size)
+            return 0.0
+
+        touch = self.bestBid if side == BUY else self.bestAsk
+        if touch is not None and price == touch:
+            return self.default_queue
+        return 0.0
+
+    def on_book(self, now, book):
+        self.advance(now)
+        self.book = book
+        if book['bidSize'][0] > 0:
+            self.bestBid = float(book['bidPrice'][0])
+        if book['askSize'][0] > 0:
+            self.bestAsk = float(book['askPrice'][0])
+
+        for order in self.live:
+            displayed = self.queue_at(order.side, order.price)
+            if displayed < order.queueAhead:
+                order.queueAhead = displayed
+
+    def on_trade(self, now, price, size, side):
+        """
+        Match one recorded trade. side is the aggressor side (1 buy, -1 sell).
+        """
+
+        self.advance(now)
+        if side == BUY:
+            self.bestAsk = price
+        elif side == SELL:
+            self.bestBid = price
+
+        if not self.live:
+            return
+
+        for order in list(self.live):
+            # A buy aggressor can only fill resting sells and vice versa
+            if order.side == side:
+                continue
+            if order.side == SELL:
+                through = price > order.price
+                at = price == order.price
+            else:
+                through = price < order.price
+                at = price == order.price
+
+            if through:
+                self.fill(order, order.leavesQty)
+            elif at:
+                remaining = size - order.queueAhead
+                order.queueAhead = max(0.0, order.queueAhead - size)
+                if remaining > 0:
+                    self.fill(order, min(order.leavesQty, remaining))
+
+    def fill(self, order, qty):
+        order.leavesQty -= qty
+        order.cumQty += qty
+        fee = qty / order.price * self.maker_fee
+        self.fills.append(Fill(self.now, order.orderID, order.side, order.price, qty, fee))
+        if order.leavesQty <= 0:
+            self.remove(order, 'Filled')
+        else:
+            order.status = 'PartiallyFilled'
+
+
+class SimulatedAccount(object):
+    """
+    Position and PnL of an inverse (XBTUSD style) contract in XBT.
+    pnl = sum(side * qty / price) - position / mark - fees
+    """
+
+    def __init__(self, balance=1.0):
+        self.startBalance = balance
+        self.position = 0
+        self.costBasis = 0.0
+        self.fees = 0.0
+        self.volume = 0
+        self.fillCount = 0
+
+    def apply(self, fill):
+        self.position += fill.side * fill.qty
+        self.costBasis += fill.side * fill.qty / fill.price
+        self.fees += fill.fee
+        self.volume += fill.qty
+        self.fillCount += 1
+
+    def pnl(self, mark):
+        unwind = self.position / mark if mark else 0.0
+        return self.costBasis - unwind - self.fees
+
+    def balance(self, mark):
+        return self.startBalance + self.pnl(mark)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parameter sweep over VPIN bucket size and EMA windows on recorded trades.
+
+    python -m simulation.sweep ticks.npy --units 100000 1000000 --long 10 30 --short 3 5 [--processes 8]
+
+Every (units, long window, short window) configuration is evaluated in a process pool. Workers memory map
+the tick file, so the decoded arrays are shared through the page cache instead of being copied per worker.
+Results are cached as json under --cache-dir, keyed by the data files, the configuration and the settings, and
+cached configurations are skipped on the next run.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from config.settings import settings
+from exchange.chart import CHART
+from exchange.chart_columnar import columnar_chart
+from simulation.data import load_ticks, load_books
+
+# Bump when the evaluation changes so stale cache entries are ignored
+EVALUATION_VERSION = 1
+
+_ticks = None
+_books = None
+
+
+def init_worker(tick_path, book_path):
+    global _ticks, _books
+    _ticks = load_ticks(tick_path)
+    _books = load_books(book_path) if book_path else None
+
+
+def evaluate_vpin(ticks, units, long_window, short_window):
+    """
+    Bucket statistics and how well |VPIN| ranks the absolute return of the next bucket
+    """
+
+    columns = columnar_chart(ticks['timestamp'], ticks['price'], ticks['side'], ticks['size'],
+                             units, long_window, short_window)
+    if not columns or len(columns['closePrice']) < 3:
+        return {'buckets': len(columns.get('closePrice', []))}
+
+    close = columns['closePrice']
+    next_move = np.abs(np.diff(close) / close[:-1])
+    result = {'buckets': len(close)}
+    for name in ('vpinShort', 'vpinLong'):
+        vpin = np.abs(columns[name][:-1])
+        result[name + 'Mean'] = float(vpin.mean())
+        result[name + 'Std'] = float(vpin.std())
+        # Rank correlation: robust to the heavy tails of both series
+        ranks_vpin = vpin.argsort().argsort()
+        ranks_move = next_move.argsort().argsort()
+        corr = np.corrcoef(ranks_vpin, ranks_move)[0, 1]
+        result[name + 'NextMoveCorr'] = float(corr) if np.isfinite(corr) else 0.0
+    return result
+
+
+def evaluate_strategy(ticks, books, units, long_window, short_window):
+    from simulation.backtest import Backtester
+
+    report = Backtester(ticks, books, chart=CHART(settings.BITMEX_BTC_SYMBOL, units, long_window, short_window)).run()
+    return {'pnl': report.pnl, 'pnlUSD': report.pnlUSD, 'fees': report.fees, 'position': report.position,
+            'maxInventory': report.maxInventory, 'fills': report.fillCount, 'fillVolume': report.fillVolume}
+
+
+def evaluate(config):
+    units, long_window, short_window, backtest = config
+    result = {'units': units, 'long': long_window, 'short': short_window}
+    result.update(evaluate_vpin(_ticks, units, long_window, short_window))
+    if backtest:
+        result.update(evaluate_strategy(_ticks, _books, units, long_window, short_window))
+    return result
+
+
+def evaluate_with_config(config):
+    return config, evaluate(config)
+
+
+def file_identity(path):
+    """ path, size and modification time of a data file ('' without one) """
+
+    if not path:
+        return ''
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+
+def settings_identity():
+    """
+    Every setting (QUOTE_*, ORDER_*, SIM_*, VPIN_*, RISK_*, position limits, ...), since the chart, the quoting and
+    the simulated exchange all read them; credentials are left out
+    """
+
+    return sorted((name, repr(value)) for name, value in settings.items()
+                  if name.isupper() and not name.endswith(('_KEY', '_SECRET')))
+
+
+def cache_key(tick_path, book_path, config):
+    identity = [file_identity(tick_path), file_identity(book_path), list(config), settings_identity(),
+                EVALUATION_VERSION]
+    return hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()
+
+
+def run_sweep(tick_path, units, long_windows, short_windows, book_path=None, backtest=True, processes=None,
+              cache_dir='sweep_cache'):
+    """
+    Evaluate every configuration of the grid. Returns a list of result dicts (cached and new).
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    configs = [(u, l, s, backtest) for u, l, s in itertools.product(units, long_windows, short_windows) if s < l]
+    results = []
+    todo = []
+    for config in configs:
+        path = os.path.join(cache_dir, cache_key(tick_path, book_path, config) + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                results.append(json.load(f))
+        else:
+            todo.append((config, path))
+
+    if todo:
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(tick_path, book_path))
+        try:
+            paths = dict((config, path) for config, path in todo)
+            for config, result in pool.imap_unordered(evaluate_with_config, [config for config, _ in todo]):
+                with open(paths[config], 'w') as f:
+                    json.dump(result, f)
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep VPIN bucket size and EMA windows on recorded trades.')
+    parser.add_argument('ticks', help='recorded trades (.npy, simulation.data.TICK_DTYPE)')
+    parser.add_argument('--books', default=None, help='recorded orderBook10 snapshots (.npy)')
+    parser.add_argument('--units', type=float, nargs='+', default=[settings.CHART_UNITS])
+    parser.add_argument('--long', type=int, nargs='+', default=[settings.LONG_WINDOW_SIZE])
+    parser.add_argument('--short', type=int, nargs='+', default=[settings.SHORT_WINDOW_SIZE])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default='sweep_cache')
+    parser.add_argument('--no-backtest', action='store_true', help='only evaluate VPIN, skip the strategy')
+    args = parser.parse_args()
+
+    results = run_sweep(args.ticks, args.units, args.long, args.short, args.books, not args.no_backtest,
+                        args.processes, args.cache_dir)
+
+    key = 'pnl' if not args.no_backtest else 'vpinShortNextMoveCorr'
+    for result in sorted(results, key=lambda r: r.get(key, 0.0), reverse=True):
+        print('units=%-10d long=%-4d short=%-4d buckets=%-6d corr(short)=%6.3f corr(long)=%6.3f%s' %
+              (result['units'], result['long'], result['short'], result['buckets'],
+               result.get('vpinShortNextMoveCorr', 0.0), result.get('vpinLongNextMoveCorr', 0.0),
+               ' pnl=%.8f XBT fills=%d' % (result['pnl'], result['fills']) if 'pnl' in result else ''))
+
+
+if __name__ == '__main__':
+    main()
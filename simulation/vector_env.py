@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import numpy as np
+
+
+def worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == 'step':
+                observation, reward, done, info = env.step(data)
+                if done:
+                    # Auto reset, the last observation of the episode travels in info
+                    info['terminal_observation'] = observation
+                    observation = env.reset()
+                remote.send((observation, reward, done, info))
+            elif command == 'reset':
+                remote.send(env.reset())
+            elif command == 'seed':
+                env.seed(data)
+                remote.send(None)
+            elif command == 'close':
+                break
+            else:
+                raise NotImplementedError("Unknown command: %s" % command)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class SubprocVectorEnv(object):
+    """
+    Runs one environment per process and steps them in lock step.
+
+    env_fns are picklable callables returning an environment, e.g.
+    functools.partial(simulation.environment.make_env, 'ticks.npy'). Environments reset themselves
+    when an episode ends. Observations are stacked into a (n_envs, observation_size) array.
+    """
+
+    def __init__(self, env_fns, context=None):
+        ctx = multiprocessing.get_context(context)
+        self.n_envs = len(env_fns)
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.n_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn in zip(self.work_remotes, self.remotes, env_fns):
+            process = ctx.Process(target=worker, args=(work_remote, remote, env_fn))
+            process.daemon = True
+            process.start()
+            work_remote.close()
+            self.processes.append(process)
+        self.closed = False
+
+    def seed(self, seed):
+        for i, remote in enumerate(self.remotes):
+            remote.send(('seed', seed + i))
+        for remote in self.remotes:
+            remote.recv()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', tuple(action)))
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        observations, rewards, dones, infos = zip(*results)
+        return np.stack(observations), np.array(rewards), np.array(dones), list(infos)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
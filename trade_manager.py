@@ -5,12 +5,16 @@ import sys
 import atexit
 import signal
 import requests
+import threading
 import random
+import numpy as np
 from time import sleep
 from utils import errors, math
 from os.path import getmtime
 from config.settings import settings
 from exchange.exchange_interface import ExchangeInterface
+from agent.policy import ACTION_STOP, load_policy
+from agent.quoting import QuoteLadder, QuoteThrottle, ladder_orders
 
 
 class TradeManager(object):
@@ -18,11 +22,12 @@ class TradeManager(object):
     # Init
     ###
 
-    def __init__(self, logger):
+    def __init__(self, logger, interface=None):
         self.logger = logger
 
         self.symbol = settings.BITMEX_BTC_SYMBOL
-        self.interface = ExchangeInterface(self.logger)
+        self.policy = load_policy(settings.RL_MODEL_PATH)
+        self.interface = interface if interface is not None else ExchangeInterface(self.logger)
         self.watched_files_mtimes = [(f, getmtime(f)) for f in settings.WATCHED_FILES]
         self.starting_qty = 0
         self.running_qty = 0
@@ -33,6 +38,10 @@ class TradeManager(object):
         self.start_position_buy = 0
         self.start_position_sell = 0
         self.start_position_mid = 0
+        self.quotes = None
+        self.throttle = None
+        # Held while orders are sent, and by on_feed_stale while it cancels them
+        self.ordersLock = threading.Lock()
 
         # register exit handler that will always cancel orders on any error.
         atexit.register(self.exit)
@@ -52,9 +61,18 @@ class TradeManager(object):
         self.logger.info("Trade Manager initializing")
 
         self.instrument = self.interface.get_instrument(self.symbol)
+        self.quotes = QuoteLadder(self.instrument['tickSize'], settings.ORDER_PAIRS, settings.ORDER_START_SIZE,
+                                  settings.ORDER_STEP_SIZE, settings.INTERVAL, settings.MIN_SPREAD,
+                                  settings.MIN_POSITION, settings.MAX_POSITION, settings.CHECK_POSITION_LIMITS,
+                                  settings.QUOTE_INVENTORY_SKEW, settings.QUOTE_VPIN_WIDEN, settings.QUOTE_VPIN_SKEW,
+                                  settings.QUOTE_BOUNCE_SKEW, settings.QUOTE_BOUNCE_SCALE)
+        self.throttle = QuoteThrottle(self.instrument['tickSize'], settings.QUOTE_RELIST_TICKS,
+                                      settings.QUOTE_RELIST_DISTANCE, settings.RELIST_INTERVAL,
+                                      settings.QUOTE_SIZE_TOLERANCE, settings.QUOTE_VPIN_HYSTERESIS)
         self.starting_qty = self.interface.get_delta(self.symbol)
         self.running_qty = self.starting_qty
         self.interface.cancel_all_orders(self.symbol)
+        self.interface.set_feed_stale_callback(self.on_feed_stale)
 
     def exit(self):
         """
@@ -71,6 +89,20 @@ class TradeManager(object):
         except Exception as e:
             self.logger.info("Unable to cancel orders: %s" % e)
 
+    def on_feed_stale(self):
+        """
+        Market data went quiet: pull the quotes now instead of at the next loop.
+        """
+
+        self.logger.warn("Realtime data is stale, cancelling open orders.")
+        with self.ordersLock:
+            if self.throttle is not None:
+                self.throttle.reset()
+            try:
+                self.interface.cancel_all_orders(self.symbol)
+            except Exception as e:
+                self.logger.info("Unable to cancel orders: %s" % e)
+
     def restart(self):
         """
         Restart vpin market making trading system.
@@ -102,7 +134,27 @@ class TradeManager(object):
             self.logger.info("Avg Entry Price: %.2f" % float(position['avgEntryPrice']))
             self.logger.info("Margin Call Price: %.2f" % float(position['marginCallPrice']))
         self.logger.info("Contracts Traded This Run: %d" % (self.running_qty - self.starting_qty))
-        self.logger.info("Total Contract Delta: %.4f XBT" % self.interface.calc_delta()['spot'])
+
+        exposure = self.interface.get_risk_exposure()
+        if exposure is not None:
+            self.logger.info("Open Orders: %d buy / %d sell, Cost %.4f XBT, Margin %.4f XBT" %
+                             (exposure['openBuy'], exposure['openSell'], self.XBt_to_XBT(exposure['openCost']),
+                              self.XBt_to_XBT(exposure['margin'])))
+        if self.throttle is not None and self.throttle.cycles:
+            self.logger.info(self.throttle.report())
+        fill_analytics = self.interface.get_fill_analytics()
+        if fill_analytics is not None and len(fill_analytics.store):
+            for line in fill_analytics.report():
+                self.logger.info(line)
+        delta = self.interface.calc_delta()
+        self.logger.info("Total Contract Delta: %.4f XBT" % delta['spot'])
+        self.logger.info("Position Margin: %.4f XBT initial, %.4f XBT maintenance" %
+                         (delta['init_margin'], delta['maint_margin']))
+
+        reference = self.interface.get_reference_price(max_age=settings.LOOP_INTERVAL)
+        if reference is not None and reference.fair_value is not None:
+            self.logger.info("Reference Fair Value: %.2f (Bithumb %.2f USD, Premium %.3f%%)" %
+                             (reference.fair_value, reference.usd_price, reference.premium * 100.0))
 
     def run_loop(self):
         """
@@ -115,33 +167,49 @@ class TradeManager(object):
 
             sleep(settings.LOOP_INTERVAL)
 
-            # Check that websocket are still open.
+            # Check that websocket are still open. The connection reconnects by itself, restarting the
+            # process is the last resort once it gave up.
             if not self.interface.is_ws_open():
                 self.logger.error("Realtime data connection unexpectedly closed, restarting.")
                 self.restart()
 
-            # Print skew, delta, etc
-            self.print_status()
-
-            # Ensure market is still open.
-            if self.interface.check_market_not_open(self.symbol):
+            # Don't quote while reconnecting, resyncing tables or on a feed that went quiet
+            if not self.interface.is_feed_fresh():
+                self.logger.warn("Realtime data is stale or reconnecting, skipping this loop.")
                 continue
 
-            # Check if order book is empty - if so, can't quote.
-            if self.interface.check_if_orderbook_empty(self.symbol):
-                continue
+            if not self.run_once():
+                return
 
-            # Ensure enough liquidity on each side of the order book
-            if not self.enough_liquidity():
-                continue
+    def run_once(self):
+        """
+        One pass of the trading loop. Returns False when the agent asks to stop trading.
+        """
 
-            # Get signal from Reinforcement Learning Agent
-            sell_action, buy_action = self.get_rl_action()
-            if sell_action == 9:
-                return
+        # Print skew, delta, etc
+        self.print_status()
+
+        # Ensure market is still open.
+        if self.interface.check_market_not_open(self.symbol):
+            return True
+
+        # Check if order book is empty - if so, can't quote.
+        if self.interface.check_if_orderbook_empty(self.symbol):
+            return True
+
+        # Ensure enough liquidity on each side of the order book
+        if not self.enough_liquidity():
+            return True
+
+        # Get signal from Reinforcement Learning Agent
+        sell_action, buy_action = self.get_rl_action()
+        if sell_action == ACTION_STOP:
+            return False
 
-            # Creates desired orders and converges to existing orders
-            # self.place_orders()
+        # Creates desired orders and converges to existing orders
+        self.place_orders(sell_action, buy_action)
+
+        return True
 
     def check_file_change(self):
         """
@@ -193,14 +261,128 @@ class TradeManager(object):
         return position >= settings.MAX_POSITION
 
     def get_rl_action(self):
-        vpin, bounce = self.interface.get_latest_vpin()
-        print('vpin = %.2f bounce = %.2f' % (vpin, bounce))
+        candle = self.interface.get_latest_candle()
+        self.logger.debug('vpin = %.2f bounce = %.2f' % (candle.vpinShort, candle.bounceShort))
 
-        sell_action = 0
-        buy_action = 0
+        sell_action, buy_action = self.policy.act(candle, self.running_qty)
 
         return sell_action, buy_action
 
+    ###
+    # Orders
+    ###
+
+    def place_orders(self, sell_action=0, buy_action=0):
+        """
+        Create the desired order ladder from the ticker, VPIN / bounce, inventory and the agent's actions,
+        and converge the open orders to it when it changed materially (agent.quoting.QuoteThrottle).
+        Runs under ordersLock, so it never overlaps with on_feed_stale cancelling the orders.
+        """
+
+        with self.ordersLock:
+            # The feed may have turned stale (and the orders canceled) since the loop checked it
+            if not self.interface.is_feed_fresh():
+                return
+            self.update_orders(sell_action, buy_action)
+
+    def update_orders(self, sell_action, buy_action):
+        """ place_orders, with ordersLock held """
+
+        ticker = self.interface.get_ticker(self.symbol)
+        vpin, bounce = self.interface.get_latest_vpin()
+        existing_orders = self.interface.get_orders()
+
+        highest_buy = max([o['price'] for o in existing_orders if o['side'] == 'Buy'] or [None])
+        lowest_sell = min([o['price'] for o in existing_orders if o['side'] == 'Sell'] or [None])
+        if not settings.MAINTAIN_SPREADS:
+            highest_buy = lowest_sell = None
+
+        sizes = None
+        if settings.RANDOM_ORDER_SIZE:
+            sizes = np.array([random.randint(settings.MIN_ORDER_SIZE, settings.MAX_ORDER_SIZE)
+                              for _ in range(settings.ORDER_PAIRS)], dtype=np.float64)
+
+        self.start_position_buy, self.start_position_sell = self.quotes.start_prices(ticker['buy'], ticker['sell'],
+                                                                                     highest_buy, lowest_sell)
+        self.start_position_mid = ticker['mid']
+        ladder = self.quotes.ladder(ticker['buy'], ticker['sell'], self.running_qty,
+                                    self.throttle.filter_vpin(vpin / 100.0), bounce, sell_action, buy_action,
+                                    highest_buy, lowest_sell, sizes)
+
+        skew = self.quotes.skew()
+
+        open_buys = sum(1 for o in existing_orders if o['side'] == 'Buy')
+        if not self.throttle.material(ladder, skew, ticker['buy'], ticker['sell'], open_buys,
+                                      len(existing_orders) - open_buys):
+            return
+        if self.converge_orders(ladder_orders(*ladder), existing_orders):
+            self.throttle.on_sent(ladder, skew)
+        else:
+            # Part of it did not go out: compare the next ladder to nothing, not to prices that are not live
+            self.throttle.reset()
+
+    def converge_orders(self, orders, existing_orders):
+        """
+        Match the open orders of each side to the desired ones level by level, innermost first: amend the ones
+        that differ, create the missing levels and cancel the open orders left over. Returns False if a batch was
+        rejected.
+        """
+
+        tick_log = self.instrument['tickLog']
+        accepted = True
+        to_amend = []
+        to_create = []
+        to_cancel = []
+
+        for side in ('Buy', 'Sell'):
+            desired = [o for o in orders if o['side'] == side]
+            current = sorted([o for o in existing_orders if o['side'] == side], key=lambda o: o['price'],
+                             reverse=(side == 'Buy'))
+            for i, order in enumerate(current):
+                if i >= len(desired):
+                    to_cancel.append(order)
+                    continue
+                desired_order = desired[i]
+                if desired_order['orderQty'] != order['leavesQty'] or desired_order['price'] != order['price']:
+                    to_amend.append({'orderID': order['orderID'],
+                                     'orderQty': order['cumQty'] + desired_order['orderQty'],
+                                     'price': desired_order['price'], 'side': order['side']})
+            to_create.extend(desired[len(current):])
+
+        # Cancel first, so the room they free counts for the amended and new orders (the cancel releases it in
+        # the risk engine right away)
+        if len(to_cancel) > 0:
+            self.logger.info("Canceling %d orders:" % (len(to_cancel)))
+            for order in reversed(to_cancel):
+                self.logger.info("%4s %d @ %.*f" % (order['side'], order['leavesQty'], tick_log, order['price']))
+            self.interface.cancel_bulk_orders(to_cancel)
+
+        if len(to_amend) > 0:
+            for amended_order in reversed(to_amend):
+                self.logger.info("Amending %4s: %d @ %.*f" % (amended_order['side'], amended_order['orderQty'],
+                                                               tick_log, amended_order['price']))
+            try:
+                self.interface.amend_bulk_orders(to_amend)
+            except errors.RiskLimitError as e:
+                self.logger.warn("Amended orders rejected by the risk check: %s" % e)
+                accepted = False
+            except requests.exceptions.HTTPError as e:
+                # Typically an order that filled or was canceled since get_orders; requote from fresh order data
+                self.logger.warn("Amending failed, retrying with the next loop: %s" % e)
+                return False
+
+        if len(to_create) > 0:
+            self.logger.info("Creating %d orders:" % (len(to_create)))
+            for order in reversed(to_create):
+                self.logger.info("%4s %d @ %.*f" % (order['side'], order['orderQty'], tick_log, order['price']))
+            try:
+                self.interface.create_bulk_orders(to_create)
+            except errors.RiskLimitError as e:
+                self.logger.warn("New orders rejected by the risk check: %s" % e)
+                accepted = False
+
+        return accepted
+
     #
     # Helpers
     #
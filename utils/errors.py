@@ -9,3 +9,6 @@ class MarketClosedError(Exception):
 
 class MarketEmptyError(Exception):
     pass
+
+class RiskLimitError(Exception):
+    pass
@@ -1,11 +1,101 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 from decimal import Decimal
 
+# Largest integer up to which float64 holds every integer exactly
+EXACT_INT = 2 ** 53
+
+_grids = {}
+_tickLogs = {}
+
+
+class TickGrid(object):
+    """
+    Prices of one instrument as integer tick counts. The tick size is tickUnits / tickScale exactly (0.5 is 5 / 10,
+    0.01 is 1 / 100), so a price is ticks * tickUnits / tickScale: an exact integer product and one correctly
+    rounded division, the same float as the exact Decimal product, without building Decimals per price.
+
+    Tick counts are floats in the array versions so they stay on the float64 fast path; exact as long as
+    |ticks * tickUnits| < 2 ** 53, the Decimal path takes over beyond.
+    """
+
+    def __init__(self, tickSize):
+        sign, digits, exponent = Decimal(str(tickSize)).as_tuple()
+        self.tickSize = tickSize
+        self.tickDec = Decimal(str(tickSize))
+        self.tickUnits = int(''.join(map(str, digits))) * 10 ** max(exponent, 0)
+        self.tickScale = 10 ** max(-exponent, 0)
+
+    def to_ticks(self, price):
+        """ nearest tick count, half to even like toNearest """
+
+        return round(price / self.tickSize)
+
+    def to_price(self, ticks):
+        if abs(ticks) * self.tickUnits < EXACT_INT:
+            return ticks * self.tickUnits / self.tickScale
+        return float(Decimal(ticks) * self.tickDec)
+
+    def round(self, price):
+        """ toNearest(price, tickSize) """
+
+        ticks = round(price / self.tickSize, 0)
+        if abs(ticks) * self.tickUnits < EXACT_INT:
+            return ticks * self.tickUnits / self.tickScale
+        return float(Decimal(ticks) * self.tickDec)
+
+    def to_ticks_array(self, prices):
+        return np.rint(np.asarray(prices, dtype=np.float64) / self.tickSize)
+
+    def to_prices(self, ticks):
+        """ prices of an array of tick counts """
+
+        ticks = np.asarray(ticks, dtype=np.float64)
+        prices = ticks * self.tickUnits
+        big = ~(np.abs(prices) < EXACT_INT)
+        prices /= self.tickScale
+        if big.any():
+            prices[big] = [float(Decimal(t) * self.tickDec) for t in ticks[big].tolist()]
+        return prices
+
+    def round_array(self, prices):
+        """ toNearest of every price, vectorized """
+
+        return self.to_prices(self.to_ticks_array(prices))
+
+
+def tick_grid(tickSize):
+    """ TickGrid of a tick size, built once per tick size """
+
+    grid = _grids.get(tickSize)
+    if grid is None:
+        grid = _grids[tickSize] = TickGrid(tickSize)
+    return grid
+
+
+def tickLog(tickSize):
+    """ decimals of the tick size, like BitMEX instruments' tickLog, computed once per tick size """
+
+    # 1 and 1.0 have different tickLogs, so the type is part of the key
+    key = (tickSize.__class__, tickSize)
+    log = _tickLogs.get(key)
+    if log is None:
+        log = _tickLogs[key] = -Decimal(str(tickSize)).as_tuple().exponent
+    return log
+
+
 def toNearest(num, tickSize):
     """Given a number, round it to the nearest tick. Very useful for sussing float error
        out of numbers: e.g. toNearest(401.46, 0.01) -> 401.46, whereas processing is
        normally with floats would give you 401.46000000000004.
        Use this after adding/subtracting/multiplying numbers."""
-    tickDec = Decimal(str(tickSize))
-    return float((Decimal(round(num / tickSize, 0)) * tickDec))
\ No newline at end of file
+    grid = _grids.get(tickSize)
+    if grid is None:
+        grid = tick_grid(tickSize)
+    return grid.round(num)
+
+
+def toNearestArray(nums, tickSize):
+    """toNearest of every number in an array, bit for bit the same floats."""
+    return tick_grid(tickSize).round_array(nums)